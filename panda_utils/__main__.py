@@ -72,6 +72,11 @@ ArgumentDescriptions = {
     ),
     "truecenter": Argument("--truecenter", "Use true center for wide squished images", "-c", action="store_true"),
     "triplicate": Argument("--triplicate", "Add LOD names to the files", "-T", action="store_true"),
+    "ratios": Argument(
+        "--ratios",
+        "Decimate the LODs to these comma-separated triangle ratios (1000, 500, 250), such as 1,0.5,0.25.",
+        "-R",
+    ),
     "reverse": Argument("--reverse", "Copy from the project folder to the working folder", "-r", action="store_true"),
     "ignore_current_scale": Argument(
         "--ignore-current-scale",
@@ -79,6 +84,28 @@ ArgumentDescriptions = {
         "-I",
         action="store_true",
     ),
+    "fps": Argument(
+        "--fps", "Resample the animations to this frame rate, if they are faster.", "-F", type=float, default=0
+    ),
+    "tolerance": Argument(
+        "--tolerance",
+        "Drop the animation frames that play back within this error of the translations, in units.",
+        "-t",
+        type=float,
+        default=0,
+    ),
+    "angle_tolerance": Argument(
+        "--angle-tolerance", "The error allowed for the rotations, in degrees.", "-a", type=float, default=0
+    ),
+    "scale_tolerance": Argument(
+        "--scale-tolerance", "The error allowed for the scales, shears and morphs.", "-S", type=float, default=0
+    ),
+    "interpolated": Argument(
+        "--interpolated",
+        "Also drop the frames that interpolation rebuilds, the game must set interpolate-frames #t.",
+        "-i",
+        action="store_true",
+    ),
     "conversion_names": Argument(
         "conversion_names",
         "List of comma-separated joint pairs",
@@ -120,9 +147,10 @@ ContextCommands = {
     ),
     "abspath": ("Fixes absolute paths on a Egg file.", convert.patch_egg, "input"),
     "triplicate": (
-        "Copies a file for 1000, 500, and 250 LOD. Does not decimate the model.",
+        "Copies a file for 1000, 500, and 250 LOD. The model is only decimated with --ratios.",
         convert.build_lods,
         "input",
+        "ratios",
     ),
     "toonhead": ("Fixes toon head models for Toontown purposes.", toontown.toon_head, "input", "triplicate"),
     "animrename": (
@@ -131,6 +159,11 @@ ContextCommands = {
         "input",
         "output",
         "conversion_names",
+        "fps",
+        "tolerance",
+        "angle_tolerance",
+        "scale_tolerance",
+        "interpolated",
     ),
     "fromfile": ("Run a command written inside a text file.", None, "input"),
 }
@@ -3,30 +3,49 @@ import pathlib
 import shutil
 import subprocess
 
-from panda_utils import util
+from panda_utils import staging, util
 from panda_utils.assetpipeline.commons import AssetContext, preblend_regex
+from panda_utils.eggtree import gltf, obj
 from panda_utils.util import get_data_file_path
 
 logger = logging.getLogger("panda_utils.converter.blender")
 
 
-def run_blender_raw(cwd, file, script, *args):
-    args = [util.choose_binary("blender"), "--background", "--python", script, "--", *args]
+def get_blender_args(file, script, args) -> list:
+    command = [util.choose_binary("blender"), "--background", "--python", str(script), "--", *map(str, args)]
     if file is not None:
-        args.insert(1, file)
-    stdout_pipe = subprocess.DEVNULL if not util.get_debug(util.LoggingScope.BLENDER) else None
-    subprocess.run(args, stdout=stdout_pipe, cwd=cwd)
+        command.insert(1, str(file))
+    return command
+
+
+def get_blender_stdout():
+    return subprocess.DEVNULL if not util.get_debug(util.LoggingScope.BLENDER) else None
+
+
+def run_blender_raw(cwd, file, script, *args):
+    util.run_process(get_blender_args(file, script, args), cwd=cwd, stdout=get_blender_stdout(), capture_stderr=False)
 
 
 def run_blender(cwd, file, script, *args):
     run_blender_raw(cwd, file, get_data_file_path(script), *args)
 
 
+async def run_blender_raw_async(cwd, file, script, *args):
+    await util.stream_process(
+        get_blender_args(file, script, args), cwd=cwd, stdout=get_blender_stdout(), capture_stderr=False
+    )
+
+
+async def run_blender_async(cwd, file, script, *args):
+    await run_blender_raw_async(cwd, file, get_data_file_path(script), *args)
+
+
 def action_bscript(ctx: AssetContext, script):
     for file in ctx.files:
         if file.endswith(".blend"):
             logger.info("%s: Running bscript on file: %s", ctx.name, file)
-            run_blender_raw(ctx.cwd, ctx.cwd / file, ctx.cwd.parent.parent / "bscripts" / script)
+            staging.detach(ctx.cwd / file)
+            run_blender_raw(ctx.cwd, ctx.cwd / file, ctx.project_root / "bscripts" / script)
 
 
 def action_preblend(ctx: AssetContext):
@@ -34,7 +53,27 @@ def action_preblend(ctx: AssetContext):
     logger.info("%s: Converting to blend: %s", ctx.name, ", ".join(all_inputs))
 
     blend_filename = f"{ctx.model_name}.blend"
-    run_blender(ctx.cwd, None, "blender/import_model.py", pathlib.Path.cwd() / blend_filename, *all_inputs)
+    run_blender(ctx.cwd, None, "blender/import_model.py", ctx.path(blend_filename), *all_inputs)
+
+
+def action_obj2egg(ctx: AssetContext, flags=""):
+    """
+    Reads the OBJ inputs straight into the model egg, instead of importing them into Blender with preblend.
+    """
+    flags = flags.lower().split(",")
+    if "bullet" in flags:
+        logger.warning("%s: Bullet collision shapes are not supported by obj2egg, use preexport: blender", ctx.name)
+
+    all_inputs = sorted(file for file in ctx.files if file.endswith(".obj"))
+    logger.info("%s: Reading into egg: %s", ctx.name, ", ".join(all_inputs))
+    ctx.cache_eggs()
+    ctx.eggs[f"{ctx.model_name}.egg"] = obj.load_obj(
+        [ctx.path(file) for file in all_inputs],
+        ctx.model_name,
+        root=ctx.cwd,
+        srgb="srgb" in flags,
+        legacy_materials="legacy" in flags,
+    )
 
 
 def action_blendrename(ctx: AssetContext):
@@ -46,7 +85,7 @@ def action_blendrename(ctx: AssetContext):
                 blend_filename += f"-{count}"
             blend_filename += ".blend"
             count += 1
-            shutil.move(file, blend_filename)
+            shutil.move(ctx.path(file), ctx.path(blend_filename))
 
 
 def __make_blend2bam_args(binary, flags):
@@ -66,12 +105,13 @@ def __make_blend2bam_args(binary, flags):
 
 
 def __run_export_util(ctx: AssetContext, binary, input_file, output_file, flags):
-    res = subprocess.run(
-        [binary, *__make_blend2bam_args(binary, flags), input_file, output_file],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
-        cwd=ctx.cwd,
-    )
+    with util.track_subprocess():
+        res = subprocess.run(
+            [binary, *__make_blend2bam_args(binary, flags), input_file, output_file],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            cwd=ctx.cwd,
+        )
     err = res.stderr.decode("utf-8")
     if err and "KeyError: 'nodes'" in err:
         logger.error("%s: Blender output an empty model, aborting.", ctx.name)
@@ -81,6 +121,7 @@ def __run_export_util(ctx: AssetContext, binary, input_file, output_file, flags)
 def __run_blend2bam(ctx: AssetContext, file, flags):
     logger.info("%s: Patching texture paths: %s", ctx.name, file)
     full_path = pathlib.Path(ctx.cwd, file)
+    staging.detach(full_path)
     run_blender(ctx.cwd, full_path, "blender/patch_paths.py")
 
     logger.info("%s: Converting to bam: %s", ctx.name, file)
@@ -88,42 +129,70 @@ def __run_blend2bam(ctx: AssetContext, file, flags):
     __run_export_util(ctx, "blend2bam", file, bam_filename, flags)
 
 
-def __run_gltf2bam(ctx: AssetContext, file, flags):
+def __export_glb(ctx: AssetContext, file) -> str:
     logger.info("%s: Patching texture paths: %s", ctx.name, file)
     full_path = pathlib.Path(ctx.cwd, file)
+    staging.detach(full_path)
     run_blender(ctx.cwd, full_path, "blender/patch_paths.py")
 
     logger.info("%s: Exporting to GLTF: %s", ctx.name, file)
-    full_path = pathlib.Path(ctx.cwd, file)
     intermediate_file = file[:-5] + "glb"
-    bam_filename = file[:-5] + "bam"
-    target_path = pathlib.Path(ctx.cwd, intermediate_file)
-    run_blender(ctx.cwd, full_path, "blender/export_glb.py", target_path)
+    run_blender(ctx.cwd, full_path, "blender/export_glb.py", pathlib.Path(ctx.cwd, intermediate_file))
+    return intermediate_file
+
 
+def __run_gltf2bam(ctx: AssetContext, file, flags):
+    intermediate_file = __export_glb(ctx, file)
+    bam_filename = file[:-5] + "bam"
     logger.info("%s: Converting to bam: %s", ctx.name, intermediate_file)
     __run_export_util(ctx, "gltf2bam", intermediate_file, bam_filename, flags)
 
 
 def action_blend2bam(ctx: AssetContext, flags=""):
     flags = flags.lower().split(",")
-    for file in ctx.files:
-        if file.endswith(".blend"):
-            if "b2b" in flags:
-                __run_blend2bam(ctx, file, flags)
-            else:
-                __run_gltf2bam(ctx, file, flags)
+
+    def export(file):
+        if "b2b" in flags:
+            __run_blend2bam(ctx, file, flags)
+        else:
+            __run_gltf2bam(ctx, file, flags)
+
+    ctx.map_files(export, [file for file in ctx.files if file.endswith(".blend")])
+
+
+def action_gltf2egg(ctx: AssetContext, flags=""):
+    flags = flags.lower().split(",")
+    if "bullet" in flags:
+        logger.warning("%s: Bullet collision shapes are not supported by gltf2egg, use gltf2bam", ctx.name)
+
+    glb_files = ctx.map_files(lambda file: __export_glb(ctx, file), [f for f in ctx.files if f.endswith(".blend")])
+    ctx.cache_eggs()
+    for file in glb_files:
+        if not ctx.path(file).exists():
+            logger.error("%s: Blender output an empty model, aborting.", ctx.name)
+            ctx.valid = False
+            return
+
+        logger.info("%s: Reading %s into egg", ctx.name, file)
+        eggtree = gltf.load_gltf(ctx.path(file), srgb="srgb" in flags, legacy_materials="legacy" in flags)
+        ctx.eggs[file[:-3] + "egg"] = eggtree
 
 
 def action_yabee(ctx: AssetContext, **kwargs):
     args_converted = [f"{target_name}::{blender_name}" for target_name, blender_name in kwargs.items()]
-    for file in ctx.files:
-        if file.endswith(".blend"):
-            logger.info("%s: Exporting through YABEE: %s", ctx.name, file)
-            full_path = pathlib.Path(ctx.cwd, file)
-            egg_name = file[:-6] + ".egg"
-            run_blender(ctx.cwd, full_path, "blender/patch_paths.py")
-            run_blender(ctx.cwd, full_path, "blender/export_with_yabee.py", egg_name, *args_converted)
-
-            target_name = ctx.model_name + ".egg"
-            if egg_name != target_name:
-                shutil.move(egg_name, target_name)
+
+    def export(file):
+        logger.info("%s: Exporting through YABEE: %s", ctx.name, file)
+        full_path = pathlib.Path(ctx.cwd, file)
+        egg_name = file[:-6] + ".egg"
+        staging.detach(full_path)
+        run_blender(ctx.cwd, full_path, "blender/patch_paths.py")
+        run_blender(ctx.cwd, full_path, "blender/export_with_yabee.py", egg_name, *args_converted)
+        return egg_name
+
+    # The exports can run in parallel, but the renames must happen in order
+    egg_names = ctx.map_files(export, [file for file in ctx.files if file.endswith(".blend")])
+    target_name = ctx.model_name + ".egg"
+    for egg_name in egg_names:
+        if egg_name != target_name:
+            shutil.move(ctx.path(egg_name), ctx.path(target_name))
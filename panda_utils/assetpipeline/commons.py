@@ -5,12 +5,15 @@ import re
 
 import yaml
 
+from panda_utils import staging
+from panda_utils.assetpipeline import parallel
 from panda_utils.eggtree import eggparse
 from panda_utils.util import Context
 
 INPUT_FOLDER = pathlib.Path("input")
 INTERMEDIATE_FOLDER = pathlib.Path("intermediate")
 BUILT_FOLDER = pathlib.Path("built")
+CACHE_FOLDER = pathlib.Path("cache")
 YAML_CONFIG_FILENAME = "model-config.yml"
 logger = logging.getLogger("panda_utils.pipeline")
 preblend_regex = re.compile(r".*\.(fbx|obj)")
@@ -21,17 +24,24 @@ file_out_regex = re.compile(r".*((-[0-9]+)?|_palette_.+)\.(png|jpg|rgb)$")
 
 
 class AssetContext:
+    """
+    The state of a single model going through the pipeline.
+    All of the paths are absolute or relative to cwd (the intermediate folder of the model),
+    so the process working directory is never used, and multiple models can be built at the same time.
+    """
+
     cwd: pathlib.Path
     putil_ctx: Context
 
-    def __init__(self, input_folder, model_output, texture_output):
+    def __init__(self, input_folder, model_output, texture_output, project_root=None):
         self.input_folder = input_folder
         self.model_name = input_folder.name
+        self.project_root = pathlib.Path(project_root or os.getcwd()).absolute()
         self.output_model_rel = pathlib.Path(pathlib.PurePosixPath(model_output.replace("\\", "/")))
         self.output_texture_rel = pathlib.Path(pathlib.PurePosixPath(texture_output.replace("\\", "/")))
-        self.output_model = pathlib.Path(BUILT_FOLDER, self.output_model_rel).absolute()
-        self.output_texture = pathlib.Path(BUILT_FOLDER, self.output_texture_rel).absolute()
-        self.built_folder_absolute = pathlib.Path(BUILT_FOLDER).absolute()
+        self.built_folder_absolute = self.project_root / BUILT_FOLDER
+        self.output_model = self.built_folder_absolute / self.output_model_rel
+        self.output_texture = self.built_folder_absolute / self.output_texture_rel
         self.built_model_path = pathlib.Path(self.output_model_rel, self.model_name)
         self.relative_mode = False
 
@@ -48,11 +58,18 @@ class AssetContext:
 
         self.valid = True
 
-        self.initial_wd = os.getcwd()
+        self.cwd = self.project_root
         self.name = self.model_name.replace("-", " ").replace("_", " ").title()
         self.eggs = None
         self.copy_ignores = set()
         self.model_config = {}
+        self.file_locator = None
+
+    def path(self, file) -> pathlib.Path:
+        """
+        Resolves a file name (as returned by files) against the intermediate folder.
+        """
+        return self.cwd / file
 
     def cache_eggs(self):
         if self.eggs is not None:
@@ -61,7 +78,7 @@ class AssetContext:
         self.eggs = {}
         for file in self.files:
             if file.endswith(".egg"):
-                with open(file) as f:
+                with open(self.path(file)) as f:
                     tree = eggparse.egg_tokenize(f.readlines())
                 self.eggs[file] = tree
 
@@ -70,7 +87,8 @@ class AssetContext:
             return
 
         for file, tree in self.eggs.items():
-            with open(file, "w") as f:
+            staging.detach(self.path(file), keep_contents=False)
+            with open(self.path(file), "w") as f:
                 f.write(str(tree))
         self.eggs = None
 
@@ -83,7 +101,7 @@ class AssetContext:
         """
         output = []
         subfolders = []
-        for entry in os.scandir():
+        for entry in os.scandir(self.cwd):
             if entry.is_dir():
                 subfolders.append(entry.name)
             else:
@@ -92,16 +110,26 @@ class AssetContext:
         other_files = []
         for sf in sorted(subfolders):
             sf_items = []
-            for subpath, dirs, files in os.walk(sf):
+            for subpath, dirs, files in os.walk(self.path(sf)):
                 for file in files:
-                    sf_items.append(str(pathlib.Path(subpath) / file))
+                    sf_items.append(str(pathlib.Path(subpath, file).relative_to(self.cwd)))
             other_files.extend(sorted(sf_items))
 
         return sorted(output) + other_files
 
-    @staticmethod
-    def get_injection_path(name):
-        injections_base_path = pathlib.Path("..", "..", "common")
+    def locate_file(self, filename):
+        """
+        Finds a file anywhere in the intermediate folder by its name. The folder is only scanned once.
+        """
+        if self.file_locator is None:
+            self.file_locator = {}
+            for dirpath, dirs, files in os.walk(self.cwd):
+                for file in files:
+                    self.file_locator[file] = str(pathlib.Path(dirpath, file).relative_to(self.cwd))
+        return self.file_locator.get(filename)
+
+    def get_injection_path(self, name):
+        injections_base_path = self.project_root / "common"
         all_injections = os.listdir(injections_base_path)
         if name not in all_injections:
             return None
@@ -111,7 +139,7 @@ class AssetContext:
         if YAML_CONFIG_FILENAME not in self.files:
             data = {}
         else:
-            with open(YAML_CONFIG_FILENAME) as f:
+            with open(self.path(YAML_CONFIG_FILENAME)) as f:
                 data = yaml.safe_load(f) or {}
 
         if not isinstance(data, dict):
@@ -132,6 +160,13 @@ class AssetContext:
         else:
             self.run_action(action, args)
 
+    def map_files(self, function, files):
+        """
+        Runs the function for every file, in parallel if the model config allows that.
+        Only use this for independent operations, such as running a tool once per file.
+        """
+        return parallel.run_parallel(function, files, parallel.get_worker_count(self.model_config))
+
     def run_action(self, action, args, convert_list=False):
         if isinstance(args, dict):
             action(self, **args)
@@ -1,3 +1,5 @@
+import dataclasses
+import logging
 import os
 import pathlib
 import shutil
@@ -5,14 +7,44 @@ import sys
 
 import doit
 import yaml
-
-from panda_utils.assetpipeline.commons import BUILT_FOLDER, INPUT_FOLDER, file_out_regex, YAML_CONFIG_FILENAME
+from doit.tools import config_changed
+
+from panda_utils import util
+from panda_utils.assetpipeline.__main__ import setup_logging
+from panda_utils.assetpipeline.commons import (
+    BUILT_FOLDER,
+    CACHE_FOLDER,
+    INPUT_FOLDER,
+    file_out_regex,
+    YAML_CONFIG_FILENAME,
+)
+from panda_utils.assetpipeline.palettes import (
+    PAGE_CACHE_FOLDER,
+    build_shared_palette,
+    find_palette_images,
+    get_group_key,
+    get_group_manifest_path,
+    get_member_key,
+    get_member_manifest_path,
+    get_palette_downscales,
+    get_shared_page_names,
+)
+from panda_utils.assetpipeline.report import BuildReporter
+from panda_utils.assetpipeline.sync import sync_tree
+from panda_utils.assetpipeline.textures import DOWNSCALE_CACHE_FOLDER
 from panda_utils.assetpipeline.target_parser import StepContext, TargetsFile, make_pipeline
+from panda_utils.assetpipeline.workers import get_pool, warm_workers_enabled
 
+logger = logging.getLogger("panda_utils.pipeline.composer")
 PANDA_UTILS = [sys.executable, "-m", "panda_utils.assetpipeline"]
-DOIT_CONFIG = {"default_tasks": ["build"]}
+DOIT_CONFIG = {"default_tasks": ["build"], "reporter": BuildReporter}
 ALL_FILES = []
 COMMON_TS = []
+SHARED_PALETTES = {}
+SYNC_MANIFEST_FOLDER = CACHE_FOLDER / "sync"
+CACHE_DAYS_VARIABLE = "PANDA_UTILS_CACHE_DAYS"
+# The caches keyed by the contents of their inputs, which only grow unless their unused entries are pruned
+CONTENT_CACHE_FOLDERS = [DOWNSCALE_CACHE_FOLDER, PAGE_CACHE_FOLDER]
 
 
 def resolve_cwd(filename):
@@ -54,12 +86,6 @@ def load_from_file(filename, asset_markers=()):
                 dirs[:] = []
 
         for task in subtasks:
-            ctx = StepContext(os.listdir(task), tf.settings, tgt.import_method or tf.settings.default_import_method)
-            # Contains the pipeline steps per yaml config
-            pipeline_steps = make_pipeline(tgt, task.name, ctx)
-            if not pipeline_steps:
-                continue
-
             if tgt.copy_subdir != 0:
                 # We set up so if we are negative we work up from our file
                 # If we are positive we work down from input
@@ -81,6 +107,25 @@ def load_from_file(filename, asset_markers=()):
                 model_path = tgt.model_path
                 texture_path = tgt.texture_path
 
+            ctx = StepContext(os.listdir(task), tf.settings, tgt.import_method or tf.settings.default_import_method)
+            if tgt.shared_palette:
+                ctx.palette_group = get_group_key(texture_path)
+            # Contains the pipeline steps per yaml config
+            pipeline_steps = make_pipeline(tgt, task.name, ctx)
+            if not pipeline_steps:
+                continue
+
+            palette_member = None
+            if any(step.startswith("shared_palette") for step in pipeline_steps):
+                palette_member = (ctx.palette_group, get_member_key(model_path, task.name))
+                shared_palette = SHARED_PALETTES.setdefault(
+                    ctx.palette_group,
+                    {"texture_path": texture_path, "size": tgt.shared_palette, "members": {}, "downscales": {}},
+                )
+                shared_palette["size"] = max(shared_palette["size"], tgt.shared_palette)
+                shared_palette["members"][palette_member[1]] = find_palette_images(task)
+                shared_palette["downscales"][palette_member[1]] = get_palette_downscales(task, pipeline_steps)
+
             pipeline_args = [*PANDA_UTILS, task, model_path, texture_path, *pipeline_steps]
 
             # Does this config require us to use common textures?
@@ -91,15 +136,22 @@ def load_from_file(filename, asset_markers=()):
             rm_files = []
             path = BUILT_FOLDER / texture_path
             if path.exists():
+                # The shared palette pages may start with the name of the model, they belong to the whole group
+                shared_pages = get_shared_page_names(texture_path)
                 for file in os.listdir(path):
-                    if file.startswith(task.name) and file_out_regex.match(file):
+                    if file.startswith(task.name) and file_out_regex.match(file) and file not in shared_pages:
                         rm_files.append(path / file)
-            ALL_FILES.append((task, pipeline_args, target_model, requires_commons, rm_files))
+            ALL_FILES.append((task, pipeline_args, target_model, requires_commons, rm_files, palette_member))
+
+
+def get_manifest_path(kind, name):
+    return SYNC_MANIFEST_FOLDER / f"{kind}-{name}.json"
 
 
 def task_copy():
     """
     Copies the files from the built/ directory into the project directory.
+    Only the files that changed since the last copy are copied.
     """
 
     def copy_files():
@@ -108,7 +160,8 @@ def task_copy():
         panda_utils_ctx = make_context()
         target_path = panda_utils_ctx.resources_path
         for phase in os.listdir(BUILT_FOLDER):
-            shutil.copytree(pathlib.Path(BUILT_FOLDER, phase), target_path, dirs_exist_ok=True)
+            result = sync_tree(pathlib.Path(BUILT_FOLDER, phase), target_path, get_manifest_path("copy", phase))
+            logger.info("%s: %s", phase, result)
 
     return {
         "actions": [copy_files],
@@ -127,21 +180,81 @@ def check_target(task, values, callback):
 
 def task_copy_commons():
     """
-    Copies all commonly used textures.
+    Copies all commonly used textures. Only the files that changed since the last copy are copied.
     """
 
     def copy_files():
         for from_name, to_name in COMMON_TS:
             from_path = pathlib.Path("common", from_name)
             to_path = pathlib.Path(BUILT_FOLDER, pathlib.PurePosixPath(to_name))
-            shutil.rmtree(to_path, ignore_errors=True)
-            shutil.copytree(from_path, to_path)
+            sync_tree(from_path, to_path, get_manifest_path("commons", from_name))
 
     return {
         "actions": [copy_files],
     }
 
 
+def task_cache():
+    """
+    Removes the cache entries that no build used for PANDA_UTILS_CACHE_DAYS days (30 by default).
+    Cleaning this task empties the caches.
+    """
+    max_age = float(os.getenv(CACHE_DAYS_VARIABLE) or 30) * 24 * 60 * 60
+
+    def prune_caches():
+        for folder in CONTENT_CACHE_FOLDERS:
+            if removed := util.prune_cache(folder, max_age):
+                logger.info("Removed %d unused entries from %s", removed, folder)
+
+    def clear_caches():
+        for folder in CONTENT_CACHE_FOLDERS:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        "actions": [prune_caches],
+        "clean": [clear_caches],
+    }
+
+
+def task_palette():
+    """
+    Builds the palettes shared by every model with the same texture path.
+    Only the pages with changed images are written again.
+    """
+    for group, shared_palette in SHARED_PALETTES.items():
+        if shared_palette["size"] & (shared_palette["size"] - 1):
+            raise ValueError(f"The shared palette size for {shared_palette['texture_path']} must be a power of two!")
+
+        members, downscales = shared_palette["members"], shared_palette["downscales"]
+        layout = {
+            "size": shared_palette["size"],
+            "members": {member: sorted(images) for member, images in members.items()},
+            "downscales": {
+                member: [dataclasses.asdict(options) for options in member_downscales]
+                for member, member_downscales in downscales.items()
+            },
+        }
+        yield {
+            "name": group,
+            "actions": [
+                (build_shared_palette, [shared_palette["texture_path"], members, shared_palette["size"], downscales])
+            ],
+            "file_dep": [path for images in members.values() for path in images.values()],
+            "targets": [get_group_manifest_path(group)]
+            + [get_member_manifest_path(group, member) for member in members],
+            "uptodate": [config_changed(layout)],
+            "task_dep": ["cache"],
+            "verbosity": 2,
+        }
+
+
+def run_pipeline(callback):
+    """
+    Runs the pipeline in a warm worker process instead of starting a new interpreter for every model.
+    """
+    return get_pool().run(callback[len(PANDA_UTILS) :])
+
+
 def task_build():
     """
     Builds a model or all models. Only does so if something in the build process of the model changed.
@@ -151,16 +264,24 @@ def task_build():
         for file in files:
             file.unlink()
 
-    for folder, callback, target_model, requires_commons, tex_files in ALL_FILES:
+    use_workers = warm_workers_enabled()
+    for folder, callback, target_model, requires_commons, tex_files, palette_member in ALL_FILES:
+        pipeline_action = (run_pipeline, [callback]) if use_workers else callback
+        file_dep = [pathlib.Path(dirname) / file for dirname, dirs, files in os.walk(folder) for file in files]
+        task_dep = ["cache", "copy_commons"] if requires_commons else ["cache"]
+        if palette_member is not None:
+            # The model only depends on its own placements, not on the rest of the shared pages
+            file_dep.append(get_member_manifest_path(*palette_member))
+            task_dep.append(f"palette:{palette_member[0]}")
         yield {
             "name": folder.name,
-            "actions": [(rm_files, [tex_files]), callback],
-            "file_dep": [pathlib.Path(dirname) / file for dirname, dirs, files in os.walk(folder) for file in files],
+            "actions": [(rm_files, [tex_files]), pipeline_action],
+            "file_dep": file_dep,
             "targets": [target_model],
             "verbosity": 2,
             "uptodate": [(check_target, [callback])],
             "clean": True,
-            "task_dep": ["copy_commons"] if requires_commons else [],
+            "task_dep": task_dep,
         }
 
 
@@ -177,6 +298,8 @@ def task_rebuild():
 
 
 def main():
+    if util.get_debug(util.LoggingScope.PIPELINE):
+        setup_logging()
     resolve_cwd("targets.yml")
     load_from_file("targets.yml", {YAML_CONFIG_FILENAME})
     doit.run(globals())
@@ -1,21 +1,37 @@
 import importlib
 import logging
 import os
-import shutil
+import sys
+import threading
 
+from panda_utils import staging
 from panda_utils.assetpipeline.commons import AssetContext
 
 logger = logging.getLogger("panda_utils.pipeline.misc")
+# The working directory belongs to the whole process, the scripts of concurrent pipelines take turns to change it
+script_lock = threading.Lock()
 
 
 def action_script(ctx: AssetContext, script_file, *arguments):
     logger.info("%s: Running script %s", ctx.name, script_file)
+    # Scripts may modify any file in place, so none of them can stay linked to the input folder
+    staging.detach_tree(ctx.cwd)
+    # The project scripts are imported from the project root, the files of the model are found through ctx.cwd
+    if str(ctx.project_root) not in sys.path:
+        sys.path.insert(0, str(ctx.project_root))
     mod = importlib.import_module(f"scripts.{script_file}")
 
-    if script_file[-2:] in ("[]", "{}"):
-        ctx.run_action_through_config(mod.run, f"script/{script_file}", script_file[-2:] == "{}")
-    else:
-        ctx.run_action(mod.run, arguments, convert_list=True)
+    # Older scripts open the files of the model with relative paths, so they still run in the folder of the model
+    with script_lock:
+        previous_cwd = os.getcwd()
+        os.chdir(ctx.cwd)
+        try:
+            if script_file[-2:] in ("[]", "{}"):
+                ctx.run_action_through_config(mod.run, f"script/{script_file}", script_file[-2:] == "{}")
+            else:
+                ctx.run_action(mod.run, arguments, convert_list=True)
+        finally:
+            os.chdir(previous_cwd)
 
 
 def action_cts(ctx: AssetContext, injection_name):
@@ -24,9 +40,9 @@ def action_cts(ctx: AssetContext, injection_name):
         logger.warning("%s: Unable to find common texture set: %s", ctx.name, injection_name)
         return
 
-    for file_name in os.listdir(inject_path):
-        ctx.copy_ignores.add(file_name)
-        shutil.copy(inject_path / file_name, file_name)
+    file_names = os.listdir(inject_path)
+    ctx.copy_ignores.update(file_names)
+    staging.stage_files((inject_path / file_name, ctx.path(file_name)) for file_name in file_names)
     logger.info("%s: Copied common texture set %s", ctx.name, injection_name)
 
 
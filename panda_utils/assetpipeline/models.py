@@ -1,5 +1,5 @@
+import copy
 import fnmatch
-import functools
 import logging
 import os
 import pathlib
@@ -7,30 +7,37 @@ import platform
 import re
 import shutil
 
-from panda_utils import util
+from panda_utils import staging, util
+from panda_utils.assetpipeline import palettes
 from panda_utils.assetpipeline.commons import AssetContext
-from panda_utils.eggtree import eggparse, operations
-from panda_utils.tools.convert import bam2egg, egg2bam
-from panda_utils.tools.palettize import remove_palette_indices
+from panda_utils.eggtree import (
+    animation,
+    cleanup,
+    collision,
+    decimate,
+    eggparse,
+    flatten,
+    geometry,
+    operations,
+    optchar,
+    tangents,
+    vcache,
+)
+from panda_utils.tools.convert import LODs, bam2egg, egg2bam, parse_lod_ratios
+from panda_utils.tools.palettize import (
+    TextureResolver,
+    apply_palette,
+    find_unpalettizable_images,
+    get_palette_textures,
+    palettize_trees,
+    strip_palette_indices,
+)
 
 image_regex = re.compile(r".*\.(png|jpg|rgb)")
 logger = logging.getLogger("panda_utils.pipeline.models")
 joint_regex = re.compile(r"^(.+)\[([xyzhprijkabc]+)]$")
 
 
-@functools.cache
-def __file_locator():
-    locator = {}
-    for dirpath, dirs, files in os.walk("."):
-        for filename in files:
-            locator[filename] = str(pathlib.Path(dirpath) / filename)
-    return locator
-
-
-def __locate_file(filename):
-    return __file_locator().get(filename)
-
-
 def build_asset_mapper(assets, name):
     output = {}
     counter = 0
@@ -70,10 +77,11 @@ def __run_operator(operator, nodes):
 
 
 def action_bam2egg(ctx: AssetContext):
-    for file in ctx.files:
-        if file.endswith(".bam"):
-            logger.info("%s: Converting %s from Bam to Egg", ctx.name, file)
-            bam2egg(ctx.putil_ctx, file, ["no-copyerrors"])
+    def convert(file):
+        logger.info("%s: Converting %s from Bam to Egg", ctx.name, file)
+        bam2egg(ctx.putil_ctx, file, ["no-copyerrors"])
+
+    ctx.map_files(convert, [file for file in ctx.files if file.endswith(".bam")])
 
 
 def action_optimize(ctx: AssetContext, flags=""):
@@ -92,7 +100,7 @@ def action_optimize(ctx: AssetContext, flags=""):
     texture_mapper = build_asset_mapper(textures, ctx.model_name) if not keep_texture_names else {}
     for fnold, fnnew in texture_mapper.items():
         fnold = __patch_filename(fnold)
-        shutil.move(fnold, fnnew)
+        shutil.move(ctx.path(fnold), ctx.path(fnnew))
 
     for file, eggtree in ctx.eggs.items():
         logger.info("%s: Optimizing model: %s", ctx.name, file)
@@ -158,18 +166,20 @@ def action_model_parent(ctx: AssetContext):
 
 def action_transform(ctx: AssetContext, scale=None, rotate=None, translate=None):
     ctx.uncache_eggs()
-    for file in ctx.files:
-        if file.endswith(".egg"):
-            logger.info("%s: Transforming: %s", ctx.name, file)
-            options = []
-            for value, transflag in [(scale, "-TS"), (rotate, "-TR"), (translate, "-TT")]:
-                if value:
-                    options.append(transflag)
-                    options.append(str(value))
-            if options:
-                translated_file_name = f"translated-{file}"
-                util.run_panda(ctx.putil_ctx, "egg-trans", *options, "-o", translated_file_name, file)
-                os.replace(translated_file_name, file)
+    options = []
+    for value, transflag in [(scale, "-TS"), (rotate, "-TR"), (translate, "-TT")]:
+        if value:
+            options.append(transflag)
+            options.append(str(value))
+
+    def transform(file):
+        logger.info("%s: Transforming: %s", ctx.name, file)
+        if options:
+            translated_file_name = f"translated-{file}"
+            util.run_panda(ctx.putil_ctx, "egg-trans", *options, "-o", translated_file_name, file)
+            os.replace(ctx.path(translated_file_name), ctx.path(file))
+
+    ctx.map_files(transform, [file for file in ctx.files if file.endswith(".egg")])
 
 
 def action_rmmat(ctx: AssetContext):
@@ -187,8 +197,16 @@ def action_rmmat(ctx: AssetContext):
             uv.node_name = None
 
 
-def action_collide(ctx: AssetContext, flags="keep,descend", method="sphere", group_name=None, bitmask=None):
+def action_collide(
+    ctx: AssetContext, flags="keep,descend", method="sphere", group_name=None, bitmask=None, ratio="0.25"
+):
+    """
+    Tags the groups with <Collide>. The obb, hull, capsule and decimate methods instead add a simplified proxy
+    of the group geometry below each group, tagged with the collisions, and leave the group itself visible only.
+    The decimate method keeps the given ratio of the triangles.
+    """
     group_name = group_name or ctx.model_name
+    proxy_method = method.lower() if method.lower() in collision.PROXY_METHODS else None
     method = method.capitalize()
     flags = flags.replace(",", " ")
     ctx.cache_eggs()
@@ -218,124 +236,239 @@ def action_collide(ctx: AssetContext, flags="keep,descend", method="sphere", gro
                 logger.warning("Found non-polygon objects in '%s', removing...", group.node_name)
                 group.remove_nodes(set(nodes))
 
-        __run_operator(add_collisions, groups)
+        pools = geometry.get_vertex_pools(eggtree) if proxy_method else {}
+
+        def add_proxy(group, pools=pools):
+            name = f"{group.node_name}-collision"
+            proxy = collision.build_proxy(group, pools, proxy_method, name, float(ratio))
+            if proxy is None:
+                logger.warning("%s: '%s' has no polygons to build a collision proxy from", ctx.name, group.node_name)
+                return
+
+            # The proxy is never rendered, whatever the flags of the render geometry were
+            collide_type, mesh = proxy
+            proxy_flags = " ".join(flag for flag in flags.split() if flag != "keep")
+            children = [eggparse.EggLeaf("Collide", group_name, f"{collide_type} {proxy_flags}".strip())]
+            if bitmask is not None:
+                children.append(eggparse.EggLeaf("Scalar", "collide-mask", f"{bitmask:#010x}"))
+            group.add_child(eggparse.EggBranch("Group", name, eggparse.EggTree(*children, *mesh.children)))
+            logger.info("%s: Added a %s collision proxy to '%s'", ctx.name, proxy_method, group.node_name)
+
+        __run_operator(add_proxy if proxy_method else add_collisions, groups)
 
 
 def action_palettize(ctx: AssetContext, palette_size="1024", flags="", exclusions=""):
-    ctx.uncache_eggs()
     palette_size = int(palette_size)
     if palette_size & (palette_size - 1):
         raise ValueError("The palette size must be a power of two!")
 
     flag_list = flags.split(",")
-
-    logger.info("%s: Creating a TXA file...", ctx.name)
-    txa_text = f":palette {palette_size} {palette_size}\n:imagetype png\n:powertwo 1\n:group {ctx.model_name} dir .\n"
     if isinstance(exclusions, str):
         exclusions = list(filter(None, exclusions.split(",")))
 
     all_png_files = [file for file in ctx.files if file.endswith(".png")]
-    included_png_files, excluded_png_files = [], []
-    for file in all_png_files:
-        if any(fnmatch.fnmatch(file, exc) for exc in exclusions):
-            excluded_png_files.append(file)
-        else:
-            included_png_files.append(file)
-
+    included_png_files = [file for file in all_png_files if not any(fnmatch.fnmatch(file, exc) for exc in exclusions)]
     if not included_png_files:
         raise RuntimeError("No images were included in the palette!")
-    txa_text += " ".join(included_png_files) + " : force-rgba dual linear margin 5\n"
-    if excluded_png_files:
-        txa_text += " ".join(excluded_png_files) + " : omit\n"
-
-    with open("textures.txa", "w") as txa_file:
-        txa_file.write(txa_text)
-
-    all_eggs = [file for file in ctx.files if file.endswith(".egg")]
-
-    logger.info("%s: Palettizing %s...", ctx.name, ", ".join(all_eggs))
-    util.run_panda(
-        ctx.putil_ctx,
-        "egg-palettize",
-        "-opt",
-        "-redo",
-        "-nodb",
-        "-inplace",
-        *all_eggs,
-        "-dm",
-        "palette-temp",
-        "-tn",
-        f"{ctx.model_name}_palette_%p_%i",
-        timeout=60,
+
+    ctx.cache_eggs()
+    logger.info("%s: Palettizing %s...", ctx.name, ", ".join(ctx.eggs))
+    palettize_trees(
+        ctx.eggs.values(),
+        ctx.cwd,
+        included_png_files,
+        ctx.model_name,
+        palette_size,
+        margin=5,
+        cache_folder=ctx.project_root / palettes.PAGE_CACHE_FOLDER,
     )
 
     if "ordered" in flag_list:
-        for file in all_eggs:
-            remove_palette_indices(file)
-
-    logger.info("%s: Patching textures after palettization...", ctx.name)
+        for eggtree in ctx.eggs.values():
+            strip_palette_indices(eggtree)
+
+
+def action_shared_palette(ctx: AssetContext, flags=""):
+    """
+    Moves the textures into the palette pages shared by every model with the same texture path.
+    The pages are built by the composer, this only remaps the geometry of the model.
+    Without flags of its own, it uses the flags of the palettize entry of the model config.
+    """
+    palettize_config = ctx.model_config.get("palettize")
+    if not flags and isinstance(palettize_config, dict):
+        flags = palettize_config.get("flags", "")
+        for name in ("palette_size", "exclusions"):
+            if palettize_config.get(name):
+                logger.warning("%s: The palettize %s has no effect in the shared palette", ctx.name, name)
+
+    palette = palettes.load_member_palette(
+        ctx.project_root, ctx.output_texture_rel, ctx.output_model_rel, ctx.model_name
+    )
     ctx.cache_eggs()
+    logger.info("%s: Using the shared palette of %s", ctx.name, pathlib.PurePosixPath(ctx.output_texture_rel))
+    resolver = TextureResolver(ctx.cwd, palette.placements)
     for eggtree in ctx.eggs.values():
-        for texture in eggtree.findall("Texture"):
-            texture_name = texture.get_child(0)
-            texture_name.value = texture_name.value.replace("palette-temp/", "", 1)
-    palette_folder = pathlib.Path("palette-temp")
-    if palette_folder.exists():
-        for file in os.listdir(palette_folder):
-            if "_palette_" in file:
-                shutil.move(palette_folder / file, file)
-        shutil.rmtree(palette_folder)
-
-
-def action_optchar(ctx: AssetContext, flags="", expose="", zero=""):
-    ctx.uncache_eggs()
-    if isinstance(flags, str) and flags:
-        flags = flags.split(",")
-    if isinstance(expose, str) and expose:
-        expose = expose.split(",")
-    if isinstance(zero, str) and zero:
-        temp_zero = zero.split(",")
-        zero = []
-        for joint in temp_zero:
-            if m := joint_regex.match(joint):
-                joint, coords = m.group(1), m.group(2)
-                zero.append((joint, coords))
-            else:
-                zero.append((joint, ""))
+        textures = get_palette_textures(eggtree, resolver)
+        rejected = find_unpalettizable_images(eggtree, textures)
+        for image in sorted(rejected):
+            logger.warning("%s: %s has UVs outside of the texture, it can not use the shared palette", ctx.name, image)
+        apply_palette(eggtree, palette, {name: value for name, value in textures.items() if value[1] not in rejected})
+        if "ordered" in flags.split(","):
+            strip_palette_indices(eggtree)
+
+    # The pages are already in the built folder, they only have to be found by egg2bam
+    page_names = [palette.page_name(page) for page in palette.pages]
+    staging.stage_files((ctx.output_texture / page_name, ctx.path(page_name)) for page_name in page_names)
+    ctx.copy_ignores.update(page_names)
+    ctx.file_locator = None
+
+
+def action_optchar(ctx: AssetContext, flags="", expose="", zero="", keepall=True):
+    """
+    Runs the common egg-optchar operations on the model and every animation at once:
+    flag (group or group=name), expose, zero (joint or joint[components]),
+    and unless keepall is set, the removal of the joints that are never used.
+    """
+    if isinstance(flags, str):
+        flags = flags.split(",") if flags else []
+    if isinstance(expose, str):
+        expose = expose.split(",") if expose else []
+    if isinstance(zero, str):
+        zero = zero.split(",") if zero else []
+    if isinstance(keepall, str):
+        keepall = keepall.lower() not in ("false", "0", "no")
 
+    ctx.cache_eggs()
     file = ctx.model_name + ".egg"
-    main_file_processed = flags or expose
-    animations_processed = zero
+    model = ctx.eggs.get(file)
+    animations = [tree for egg_file, tree in ctx.eggs.items() if egg_file != file]
+
+    if model is not None:
+        flag_names = dict(flag.split("=", 1) if "=" in flag else (flag, flag) for flag in flags)
+        if flag_names:
+            count = optchar.flag_groups(model, flag_names)
+            logger.info("%s: Flagged %d primitives", ctx.name, count)
+        if expose:
+            optchar.expose_joints(model, expose)
+
+    for joint in zero:
+        if m := joint_regex.match(joint):
+            joint, coords = m.group(1), m.group(2)
+        else:
+            coords = ""
+        count = sum(optchar.zero_channels(tree, joint, coords) for tree in animations)
+        logger.info("%s: Zeroed %d animation channels of %s", ctx.name, count, joint)
+
+    if model is not None and not keepall:
+        removed = optchar.prune_joints(model, animations)
+        if removed:
+            logger.info("%s: Removed %d unused joints: %s", ctx.name, len(removed), ", ".join(removed))
+
+
+def action_animcompress(ctx: AssetContext, fps="", tolerance="", angle_tolerance="", scale_tolerance="", flags=""):
+    """
+    Compresses every animation: constant channels are stripped, the frame rate is lowered to fps if it is higher,
+    and frames are dropped as long as the animation still plays back within the tolerances: translations in units,
+    rotations in degrees, and scales as factors. The frames are held during playback, unless the interpolated flag
+    is given: then the frames that linear interpolation rebuilds are dropped too, which relies on interpolate-frames.
+    Panda3D turns it off by default, without it in the Config.prc of the game the animations play back choppy.
+    """
+    fps = float(fps) if fps else None
+    tolerances = [float(value) if value else 0 for value in (tolerance, angle_tolerance, scale_tolerance)]
+    interpolated = "interpolated" in flags.split(",")
+    if interpolated:
+        logger.info("%s: %s", ctx.name, animation.INTERPOLATION_NOTE)
+    ctx.cache_eggs()
+    for file, eggtree in ctx.eggs.items():
+        if not eggtree.findall("Bundle"):
+            continue
 
-    if main_file_processed:
-        if file in ctx.files:
-            # Process the main model file.
-            command = ["egg-optchar", file, "-inplace", "-keepall"]
+        frames, channels = animation.count_frames_and_channels(eggtree)
+        size = len(str(eggtree))
+        animation.compress_animation(eggtree, fps, *tolerances, interpolated=interpolated)
+        new_frames, new_channels = animation.count_frames_and_channels(eggtree)
+        logger.info(
+            "%s: Compressed %s from %d to %d frames and from %d to %d channels (%d to %d egg bytes)",
+            ctx.name,
+            file,
+            frames,
+            new_frames,
+            channels,
+            new_channels,
+            size,
+            len(str(eggtree)),
+        )
 
-            if flags:
-                for flag in flags:
-                    command.append("-flag")
-                    command.append(flag)
 
-            if expose:
-                for joint in expose:
-                    command.append("-expose")
-                    command.append(joint)
+def action_weld(ctx: AssetContext, flags=""):
+    """
+    Merges the duplicate vertices, then removes the vertices, textures and materials that nothing refers to.
+    The keep_textures flag leaves the textures and materials alone, for models whose code looks them up by name.
+    """
+    flags = flags.split(",")
+    ctx.cache_eggs()
+    for file, eggtree in ctx.eggs.items():
+        welded = cleanup.weld_vertices(eggtree)
+        pruned = cleanup.prune_vertices(eggtree)
+        logger.info("%s: Welded %d and removed %d unused vertices in %s", ctx.name, welded, pruned, file)
+        if "keep_textures" not in flags:
+            if removed := cleanup.prune_textures(eggtree):
+                logger.info("%s: Removed unused textures and materials from %s: %s", ctx.name, file, ", ".join(removed))
+
+
+def action_flatten(ctx: AssetContext, protected=""):
+    """
+    Merges the static groups that share their texture and render state, and combines their vertex pools,
+    so the model has fewer nodes and draw calls. Groups with collisions, transforms, tags or UV scrolling are kept,
+    as well as the ones matching the protected patterns. Animated models are left alone.
+    """
+    protected = [pattern for pattern in protected.split(",") if pattern]
+    ctx.cache_eggs()
+    for file, eggtree in ctx.eggs.items():
+        merged = flatten.flatten_groups(eggtree, protected)
+        combined = flatten.combine_pools(eggtree)
+        logger.info("%s: Merged %d groups and %d vertex pools in %s", ctx.name, merged, combined, file)
 
-            util.run_panda(ctx.putil_ctx, *command)
 
-    if animations_processed:
-        for eggfile in ctx.files:
-            # Process the model's animations.
-            if eggfile.endswith(".egg") and eggfile != file:
-                command = ["egg-optchar", eggfile, "-inplace", "-keepall"]
+def action_vcache(ctx: AssetContext):
+    """
+    Reorders the polygons and renumbers the vertices for the post-transform vertex cache.
+    Blended, binned and decal geometry keeps its order.
+    """
+    ctx.cache_eggs()
+    for file, eggtree in ctx.eggs.items():
+        before = vcache.get_acmr(eggtree)
+        moved, renumbered = vcache.optimize_vertex_cache(eggtree)
+        logger.info("%s: Reordered %d polygons and renumbered %d vertices in %s", ctx.name, moved, renumbered, file)
+        logger.info("%s: Cache misses per triangle %.3f -> %.3f", ctx.name, before, vcache.get_acmr(eggtree))
 
-                if zero:
-                    for joint, coords in zero:
-                        command.append("-zero")
-                        command.append(joint + ("," + coords if coords else ""))
 
-                util.run_panda(ctx.putil_ctx, *command)
+def action_lods(ctx: AssetContext, ratios="1,0.5,0.25"):
+    """
+    Adds the 1000, 500 and 250 LODs of every model, decimated to the given ratios of its triangles.
+    """
+    ratios = parse_lod_ratios(ratios)
+    ctx.cache_eggs()
+    for file, eggtree in list(ctx.eggs.items()):
+        if eggtree.findall("Bundle") or any(f"{lod}." in file for lod in LODs):
+            continue
+
+        lod_tree = copy.deepcopy(eggtree)
+        for lod, (original, after) in zip(LODs, decimate.decimate_levels(lod_tree, ratios)):
+            lod_file = f"{file[:-4]}{lod}.egg"
+            ctx.eggs[lod_file] = copy.deepcopy(lod_tree)
+            logger.info("%s: Decimated %s to %d of %d triangles", ctx.name, lod_file, after, original)
+
+
+def action_tbn(ctx: AssetContext, uv_names=""):
+    """
+    Computes the tangents and binormals for the given UV sets (all of them by default), like egg-trans -tbnall.
+    """
+    uv_names = uv_names.split(",") if uv_names else None
+    ctx.cache_eggs()
+    for file, eggtree in ctx.eggs.items():
+        count = tangents.compute_tangent_binormals(eggtree, uv_names)
+        logger.info("%s: Computed tangents and binormals of %d vertices in %s", ctx.name, count, file)
 
 
 def action_group_rename(ctx: AssetContext, **kwargs):
@@ -435,7 +568,7 @@ def action_egg2bam(ctx: AssetContext, flags="filter"):
                     resolution_paths.add(full_path)
 
         for full_path in resolution_paths:
-            filename = __locate_file(full_path.split("/")[-1])
+            filename = ctx.locate_file(full_path.split("/")[-1])
             if filename is None:
                 logger.error("%s: Texture %s was not found!", ctx.name, full_path)
                 continue
@@ -456,24 +589,24 @@ def action_egg2bam(ctx: AssetContext, flags="filter"):
     # Under no circumstances, we will be copying common texture set into the built/ folder.
     # This should be done by some other thing *before* we run the pipeline.
     copied_files = {cf: target for cf, target in copied_files.items() if cf not in ctx.copy_ignores}
+    staged_files = []
     for filename, target in copied_files.items():
         copy_path = pathlib.Path(ctx.built_folder_absolute, target)
         copy_path.parent.mkdir(parents=True, exist_ok=True)
         # logger.info("%s -> %s", filename, copy_path)
-        shutil.copy(filename, copy_path)
+        staged_files.append((ctx.path(filename), copy_path))
 
     ctx.uncache_eggs()
     for file in ctx.files:
         if file.endswith(".egg"):
-            shutil.copy(file, pathlib.Path(ctx.output_model, file))
+            staged_files.append((ctx.path(file), pathlib.Path(ctx.output_model, file)))
+    staging.stage_files(staged_files)
 
-    os.chdir(ctx.output_model)
-    os.chdir(ctx.putil_ctx.resources_path)
-    ctx.putil_ctx.working_path = ctx.putil_ctx.resources_path
+    # egg2bam resolves the texture paths against the built folder, so it runs from there
+    resources_ctx = copy.copy(ctx.putil_ctx)
+    resources_ctx.working_path = str(ctx.putil_ctx.resources_path)
     for file in files:
         if file.endswith(".egg"):
             logger.info("%s: Converting %s to bam", ctx.name, file)
-            egg2bam(ctx.putil_ctx, str(pathlib.Path(ctx.output_model_rel, file)), flags=flags)
+            egg2bam(resources_ctx, str(pathlib.Path(ctx.output_model_rel, file)), flags=flags)
             os.unlink(pathlib.Path(ctx.output_model, file))
-    os.chdir(ctx.cwd)
-    ctx.putil_ctx.working_path = ctx.cwd
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import fnmatch
+import json
+import logging
+import os
+import pathlib
+
+import yaml
+
+from panda_utils import staging, util
+from panda_utils.assetpipeline.commons import BUILT_FOLDER, CACHE_FOLDER, YAML_CONFIG_FILENAME
+from panda_utils.assetpipeline.textures import DOWNSCALE_CACHE_FOLDER, get_downscale_options
+from panda_utils.tools.downscale import DownscaleOptions, downscale_image
+from panda_utils.tools.palettize import Palette, read_image_sizes
+
+logger = logging.getLogger("panda_utils.pipeline.palettes")
+PALETTE_FOLDER = CACHE_FOLDER / "palettes"
+# The pages of the models palettized by themselves, by the contents of their images and the palette options
+PAGE_CACHE_FOLDER = CACHE_FOLDER / "palette_pages"
+SHARED_PALETTE_MARGIN = 5
+
+
+def get_group_key(texture_path) -> str:
+    return pathlib.PurePath(texture_path).as_posix().replace("/", "__")
+
+
+def get_member_key(model_path, model_name: str) -> str:
+    return pathlib.PurePath(model_path, model_name).as_posix().replace("/", "__")
+
+
+def get_group_manifest_path(group: str) -> pathlib.Path:
+    return PALETTE_FOLDER / f"{group}.json"
+
+
+def get_member_manifest_path(group: str, member: str) -> pathlib.Path:
+    return PALETTE_FOLDER / group / f"{member}.json"
+
+
+def get_shared_page_names(texture_path) -> set:
+    """
+    The names of the shared palette pages last written to built/{texture_path}, from the manifest of its group.
+    """
+    group = get_group_key(texture_path)
+    manifest_path = get_group_manifest_path(group)
+    if not manifest_path.exists():
+        return set()
+    palette = Palette(group.replace("__", "_"), SHARED_PALETTE_MARGIN, {}, {})
+    return {palette.page_name(int(page)) for page in json.loads(manifest_path.read_text()).get("pages", {})}
+
+
+def read_model_config(folder: pathlib.Path) -> dict:
+    config_path = folder / YAML_CONFIG_FILENAME
+    if not config_path.exists():
+        return {}
+    with open(config_path) as f:
+        config = yaml.safe_load(f) or {}
+    return config if isinstance(config, dict) else {}
+
+
+def get_palette_exclusions(folder: pathlib.Path) -> list:
+    """
+    Reads the palettize exclusions from the model-config.yml of a model, if it has one.
+    """
+    entries = read_model_config(folder).get("palettize", [])
+    exclusions = []
+    for entry in entries if isinstance(entries, list) else [entries]:
+        value = entry.get("exclusions", "") if isinstance(entry, dict) else ""
+        exclusions += list(filter(None, value.split(","))) if isinstance(value, str) else value
+    return exclusions
+
+
+def find_palette_images(folder: pathlib.Path) -> dict[str, pathlib.Path]:
+    """
+    Returns the images of a model folder that go into a shared palette, by their path relative to the folder.
+    """
+    exclusions = get_palette_exclusions(folder)
+    images = {}
+    for dirpath, dirs, files in os.walk(folder):
+        for file in files:
+            path = pathlib.Path(dirpath, file)
+            name = str(path.relative_to(folder))
+            if file.endswith(".png") and not any(fnmatch.fnmatch(name, exc) for exc in exclusions):
+                images[name] = path
+    return dict(sorted(images.items()))
+
+
+def get_palette_downscales(folder: pathlib.Path, steps: list[str]) -> list[DownscaleOptions]:
+    """
+    The options of the downscale steps a model runs before its shared palette step, in order.
+    """
+    downscales = []
+    for step in " ".join(steps).split():
+        if step.startswith("shared_palette"):
+            break
+        if step in ("downscale[]", "downscale{}"):
+            entries = read_model_config(folder).get("downscale", [])
+            for entry in entries if isinstance(entries, list) else [entries]:
+                if isinstance(entry, dict):
+                    downscales.append(get_downscale_options(**entry))
+                elif isinstance(entry, (str, int)):
+                    downscales.append(get_downscale_options(entry))
+        elif step.split(":")[0] == "downscale":
+            downscales.append(get_downscale_options(*step.split(":")[1:]))
+    return downscales
+
+
+def downscale_member_images(
+    group: str, member: str, images: dict[str, pathlib.Path], downscales: list[DownscaleOptions]
+) -> dict[str, pathlib.Path]:
+    """
+    Runs the downscale steps of a member on copies of its images, so the pages hold the images at their final size.
+    Like the steps themselves, they only apply to the images at the top of the model folder.
+    """
+    if not downscales:
+        return images
+
+    folder = PALETTE_FOLDER / group / "images" / member
+    DOWNSCALE_CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+    downscaled = {}
+    for name, path in images.items():
+        target = folder / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        staging.stage_file(path, target, staging.StagingMode.REFLINK)
+        if len(pathlib.PurePath(name).parts) == 1:
+            for options in downscales:
+                if not options.pattern or fnmatch.fnmatch(name, options.pattern):
+                    message, _ = downscale_image(str(target), None, options, str(DOWNSCALE_CACHE_FOLDER))
+                    logger.debug("%s: %s", member, message)
+        downscaled[name] = target
+    return downscaled
+
+
+def write_json_if_changed(path: pathlib.Path, data: dict) -> bool:
+    """
+    Only touches the file if the data is different, so that the tasks depending on it are not rebuilt.
+    """
+    text = json.dumps(data, indent=2, sort_keys=True)
+    if path.exists() and path.read_text() == text:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return True
+
+
+def build_shared_palette(
+    texture_path: str,
+    members: dict[str, dict[str, pathlib.Path]],
+    palette_size: int,
+    downscales: dict[str, list[DownscaleOptions]] | None = None,
+) -> None:
+    """
+    Packs the images of every member model into a shared set of pages in built/{texture_path}.
+    The images of the members with downscale steps are packed at the size those steps give them.
+    Only the pages with changed images are written again, and every member gets a manifest with its own placements.
+    """
+    group = get_group_key(texture_path)
+    downscales = downscales or {}
+    members = {
+        member: downscale_member_images(group, member, images, downscales.get(member, []))
+        for member, images in members.items()
+    }
+    sources = {f"{member}/{name}": path for member, images in members.items() for name, path in images.items()}
+    sizes = read_image_sizes(".", sources.values())
+    image_sizes = {image: sizes[path] for image, path in sources.items()}
+    palette = Palette.pack(group.replace("__", "_"), image_sizes, palette_size, SHARED_PALETTE_MARGIN)
+    placements = palette.to_dict()["placements"]
+    hashes = {image: util.hash_file(sources[image]) for image in palette.placements}
+
+    manifest_path = get_group_manifest_path(group)
+    previous = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    target_folder = BUILT_FOLDER / texture_path
+    target_folder.mkdir(parents=True, exist_ok=True)
+    signatures = {}
+    for page, size in palette.pages.items():
+        signature = [
+            list(size),
+            [[image, placements[image], hashes[image]] for image in palette.images_on_page(page)],
+        ]
+        signatures[str(page)] = signature
+        page_path = target_folder / palette.page_name(page)
+        if previous.get("pages", {}).get(str(page)) == signature and page_path.exists():
+            continue
+        logger.info("%s: Writing palette page %s", texture_path, page_path.name)
+        palette.save_page(page, sources, target_folder)
+
+    for page in previous.get("pages", {}):
+        if int(page) not in palette.pages:
+            (target_folder / palette.page_name(int(page))).unlink(missing_ok=True)
+
+    for member, images in members.items():
+        member_palette = palette.subset(
+            {name: f"{member}/{name}" for name in images if f"{member}/{name}" in palette.placements}
+        )
+        write_json_if_changed(get_member_manifest_path(group, member), member_palette.to_dict())
+    write_json_if_changed(manifest_path, {"texture_path": texture_path, "pages": signatures})
+    logger.info("%s: %d images of %d models in %d pages", texture_path, len(hashes), len(members), len(palette.pages))
+
+
+def load_member_palette(project_root: pathlib.Path, texture_path, model_path, model_name) -> Palette:
+    group = get_group_key(texture_path)
+    path = project_root / get_member_manifest_path(group, get_member_key(model_path, model_name))
+    if not path.exists():
+        raise RuntimeError(f"The shared palette for {texture_path} was not built, run the composer palette task")
+    with open(path) as f:
+        return Palette.from_dict(json.load(f))
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+logger = logging.getLogger("panda_utils.pipeline.parallel")
+WORKERS_VARIABLE = "PANDA_UTILS_WORKERS"
+WORKERS_CONFIG_KEY = "workers"
+DEFAULT_MAX_WORKERS = 4
+_deferred = threading.local()
+
+
+def get_worker_count(model_config: dict | None = None) -> int:
+    """
+    The number of external tools a single pipeline may run at the same time.
+    Set through the `workers` key of model-config.yml, or PANDA_UTILS_WORKERS for all models.
+    """
+    value = (model_config or {}).get(WORKERS_CONFIG_KEY) or os.getenv(WORKERS_VARIABLE)
+    if value is None:
+        return min(DEFAULT_MAX_WORKERS, os.cpu_count() or 1)
+
+    try:
+        workers = int(value)
+    except ValueError:
+        logger.warning("Invalid worker count: %s, running sequentially", value)
+        return 1
+    return max(1, workers)
+
+
+class DeferredLogFilter(logging.Filter):
+    """
+    Holds back the log records emitted by the worker threads, so they can be replayed in a deterministic order.
+    """
+
+    def filter(self, record):
+        records = getattr(_deferred, "records", None)
+        if records is None:
+            return True
+        # The same record passes through every handler, it only has to be stored once
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+
+def _all_handlers():
+    loggers = [logging.getLogger()] + [
+        item for item in logging.Logger.manager.loggerDict.values() if isinstance(item, logging.Logger)
+    ]
+    return {handler for item in loggers for handler in item.handlers}
+
+
+def run_parallel(function: Callable, items: Iterable, workers: int | None = None) -> list:
+    """
+    Calls the function on every item using a bounded thread pool, and returns the results in the order of the items.
+    The log messages of every call are printed together, in the order of the items, and if any calls fail,
+    the exception of the first failed item is raised once all the calls have finished.
+    """
+    items = list(items)
+    workers = workers or get_worker_count()
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    def run_deferred(item):
+        _deferred.records = []
+        try:
+            return function(item), None, _deferred.records
+        except Exception as e:  # noqa: BLE001 - raised again by the caller, in the order of the items
+            return None, e, _deferred.records
+        finally:
+            _deferred.records = None
+
+    log_filter = DeferredLogFilter()
+    handlers = _all_handlers()
+    for handler in handlers:
+        handler.addFilter(log_filter)
+    try:
+        with ThreadPoolExecutor(min(workers, len(items))) as pool:
+            outcomes = list(pool.map(run_deferred, items))
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_filter)
+
+    results, first_error = [], None
+    for result, error, records in outcomes:
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        if error is not None and first_error is None:
+            first_error = error
+        results.append(result)
+
+    if first_error is not None:
+        raise first_error
+    return results
@@ -0,0 +1,277 @@
+import json
+import os
+import pathlib
+import time
+
+from doit.reporter import ConsoleReporter
+
+from panda_utils.assetpipeline.commons import CACHE_FOLDER
+
+REPORT_FOLDER = CACHE_FOLDER / "reports"
+
+
+class TaskRecord:
+    def __init__(self, name, task_dep, has_actions):
+        self.name = name
+        self.task_dep = list(task_dep)
+        self.has_actions = has_actions
+        self.status = "pending"
+        self.reason = None
+        self.selected = None
+        self.start = None
+        self.end = None
+        # When doit was done with the task, whether it was executed or skipped, so the tasks after it could start
+        self.finished = None
+        self.ready = None
+        self.lane = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    @property
+    def queued(self):
+        if self.start is None or self.ready is None:
+            return 0.0
+        return max(0.0, self.start - self.ready)
+
+
+def get_rebuild_reason(task) -> str:
+    if task.name.startswith("rebuild:"):
+        return "forced rebuild"
+    if not task.file_dep and not task.uptodate:
+        return "always runs"
+    missing_targets = [str(target) for target in task.targets if not os.path.exists(target)]
+    if missing_targets:
+        return "missing target: " + ", ".join(missing_targets)
+    changed = getattr(task, "dep_changed", None)
+    if changed:
+        files = ", ".join(str(file) for file in sorted(changed)[:5])
+        more = f" and {len(changed) - 5} more" if len(changed) > 5 else ""
+        return f"changed files: {files}{more}"
+    return "pipeline changed"
+
+
+class BuildReporter(ConsoleReporter):
+    """
+    Console reporter that also records the execution of every task.
+    After the run, writes a JSON build report and a Chrome trace (viewable in Perfetto or chrome://tracing)
+    into cache/reports.
+    """
+
+    desc = "console output with a build report"
+
+    def __init__(self, outstream, options):
+        super().__init__(outstream, options)
+        self.records = {}
+        self.run_start = time.time()
+
+    def _record(self, task):
+        record = self.records.get(task.name)
+        if record is None:
+            record = self.records[task.name] = TaskRecord(task.name, task.task_dep, bool(task.actions))
+        return record
+
+    def get_status(self, task):
+        super().get_status(task)
+        self._record(task).selected = time.time()
+
+    def execute_task(self, task):
+        super().execute_task(task)
+        record = self._record(task)
+        record.start = time.time()
+        record.status = "running"
+        record.reason = get_rebuild_reason(task)
+
+    def add_success(self, task):
+        super().add_success(task)
+        record = self._record(task)
+        record.end = record.finished = time.time()
+        record.status = "built"
+
+    def add_failure(self, task, fail):
+        super().add_failure(task, fail)
+        record = self._record(task)
+        record.end = record.finished = time.time()
+        record.status = "failed"
+        record.reason = f"{record.reason}; {fail.get_name()}" if record.reason else fail.get_name()
+
+    def skip_uptodate(self, task):
+        super().skip_uptodate(task)
+        record = self._record(task)
+        record.finished = time.time()
+        record.status = "skipped"
+        record.reason = "up-to-date"
+
+    def skip_ignore(self, task):
+        super().skip_ignore(task)
+        record = self._record(task)
+        record.finished = time.time()
+        record.status = "ignored"
+        record.reason = "ignored"
+
+    def complete_run(self):
+        super().complete_run()
+        # Group tasks (such as build) have no actions, and would only obscure the critical path
+        records = [record for record in self.records.values() if record.status != "pending" and record.has_actions]
+        if not records:
+            return
+
+        self._compute_ready_times()
+        self._assign_lanes(records)
+        REPORT_FOLDER.mkdir(parents=True, exist_ok=True)
+        report = self.make_report(records)
+        with open(REPORT_FOLDER / "build-report.json", "w") as f:
+            json.dump(report, f, indent=2)
+        with open(REPORT_FOLDER / "build-trace.json", "w") as f:
+            json.dump(self.make_trace(records), f)
+
+        self.write(self.format_report(report))
+        self.write(f"Build report written to {pathlib.Path(REPORT_FOLDER).absolute()}\n")
+
+    def get_dependencies(self, record, names):
+        """
+        The dependencies of the record among the given task names, looking through the tasks that are left out
+        (the group tasks).
+        """
+        dependencies, pending, seen = [], list(record.task_dep), set()
+        while pending:
+            dep = pending.pop(0)
+            if dep in seen or dep not in self.records:
+                continue
+            seen.add(dep)
+            if dep in names:
+                dependencies.append(dep)
+            else:
+                pending += self.records[dep].task_dep
+        return dependencies
+
+    def _compute_ready_times(self):
+        # A task is ready once doit is done with all of its dependencies, however long it then waits for a worker
+        for record in self.records.values():
+            dependency_ends = [
+                self.records[dep].finished or self.run_start for dep in record.task_dep if dep in self.records
+            ]
+            record.ready = max([self.run_start, *dependency_ends])
+
+    @staticmethod
+    def _assign_lanes(records):
+        # Greedy interval colouring, the reporter does not know which worker ran which task
+        lane_ends = []
+        for record in sorted((r for r in records if r.start is not None), key=lambda r: r.start):
+            end = record.end or record.start
+            for lane, lane_end in enumerate(lane_ends):
+                if lane_end <= record.start:
+                    lane_ends[lane] = end
+                    record.lane = lane
+                    break
+            else:
+                record.lane = len(lane_ends)
+                lane_ends.append(end)
+        return len(lane_ends)
+
+    def critical_path(self, records):
+        """
+        Returns the chain of dependent tasks with the largest total duration.
+        """
+        by_name = {record.name: record for record in records}
+        best = {}
+
+        def visit(name):
+            if name in best:
+                return best[name]
+            record = by_name[name]
+            best[name] = (record.duration, [name])  # protects against cycles
+            chains = [visit(dep) for dep in self.get_dependencies(record, by_name)]
+            length, chain = max(chains, default=(0.0, []), key=lambda item: item[0])
+            best[name] = (length + record.duration, chain + [name])
+            return best[name]
+
+        length, chain = max((visit(name) for name in by_name), default=(0.0, []), key=lambda item: item[0])
+        return length, chain
+
+    def make_report(self, records):
+        run_end = max([record.end or record.start or self.run_start for record in records] + [self.run_start])
+        executed = [record for record in records if record.start is not None]
+        critical_length, critical_chain = self.critical_path(records)
+        statuses = {}
+        for record in records:
+            statuses[record.status] = statuses.get(record.status, 0) + 1
+
+        return {
+            "started": self.run_start,
+            "wall_time": run_end - self.run_start,
+            "task_time": sum(record.duration for record in executed),
+            "queued_time": sum(record.queued for record in executed),
+            "max_concurrency": max((record.lane + 1 for record in executed), default=0),
+            "statuses": statuses,
+            "critical_path": {"duration": critical_length, "tasks": critical_chain},
+            "tasks": [
+                {
+                    "name": record.name,
+                    "status": record.status,
+                    "reason": record.reason,
+                    "duration": record.duration,
+                    "queued": record.queued,
+                    "start": record.start - self.run_start if record.start is not None else None,
+                    "task_dep": record.task_dep,
+                }
+                for record in sorted(records, key=lambda r: -r.duration)
+            ],
+        }
+
+    def make_trace(self, records):
+        events = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "running"}},
+            {"name": "process_name", "ph": "M", "pid": 2, "args": {"name": "queued"}},
+        ]
+        for record in records:
+            if record.start is None:
+                continue
+            args = {"status": record.status, "reason": record.reason}
+            events.append(
+                {
+                    "name": record.name,
+                    "cat": record.status,
+                    "ph": "X",
+                    "ts": (record.start - self.run_start) * 1e6,
+                    "dur": record.duration * 1e6,
+                    "pid": 1,
+                    "tid": record.lane,
+                    "args": args,
+                }
+            )
+            if record.queued:
+                events.append(
+                    {
+                        "name": record.name,
+                        "cat": "queued",
+                        "ph": "X",
+                        "ts": (record.ready - self.run_start) * 1e6,
+                        "dur": record.queued * 1e6,
+                        "pid": 2,
+                        "tid": record.lane,
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def format_report(report, top=10):
+        lines = [
+            "#" * 40,
+            (
+                f"Wall time: {report['wall_time']:.2f}s, task time: {report['task_time']:.2f}s, "
+                f"queued: {report['queued_time']:.2f}s, max concurrency: {report['max_concurrency']}"
+            ),
+            "Tasks: " + ", ".join(f"{count} {status}" for status, count in sorted(report["statuses"].items())),
+            f"Critical path ({report['critical_path']['duration']:.2f}s): "
+            + " -> ".join(report["critical_path"]["tasks"]),
+            "Slowest tasks:",
+        ]
+        for task in report["tasks"][:top]:
+            if task["status"] in ("skipped", "ignored"):
+                break
+            lines.append(f"  {task['duration']:8.2f}s  {task['name']} ({task['reason']})")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import logging
+import pathlib
+import shutil
+
+from panda_utils import staging
+from panda_utils.assetpipeline import imports
+from panda_utils.assetpipeline.commons import INTERMEDIATE_FOLDER, AssetContext, regex_mcf, regex_mcf_fallback
+from panda_utils.assetpipeline.telemetry import TelemetryWriter
+from panda_utils.util import Context
+
+logger = logging.getLogger("panda_utils.pipeline")
+
+
+def prepare_context(input_folder, model_output: str, texture_output: str, project_root=None) -> AssetContext:
+    """
+    Creates the context for a model and stages the input folder into its own intermediate folder.
+    Relative paths are resolved against the project root, which defaults to the current directory.
+    """
+    input_folder = pathlib.Path(input_folder)
+    ctx = AssetContext(input_folder, model_output, texture_output, project_root)
+    input_path = ctx.project_root / input_folder
+
+    intermediate_folder = ctx.project_root / INTERMEDIATE_FOLDER
+    intermediate_local = intermediate_folder / str(pathlib.PurePosixPath(ctx.built_model_path)).replace("/", "__")
+    intermediate_folder.mkdir(parents=True, exist_ok=True)
+    shutil.rmtree(intermediate_local, ignore_errors=True)
+    staging.stage_tree(input_path, intermediate_local)
+
+    ctx.output_model.mkdir(parents=True, exist_ok=True)
+    ctx.output_texture.mkdir(parents=True, exist_ok=True)
+    ctx.cwd = intermediate_local
+    ctx.putil_ctx = Context.from_config(
+        {"options": {"panda3d_path_inherit": 1}, "paths": {"resources": ctx.built_folder_absolute}}
+    )
+    ctx.putil_ctx.working_path = str(ctx.cwd)
+
+    ctx.load_model_config()
+    return ctx
+
+
+def run_method(ctx, action, method_name, args, use_config, use_fallback):
+    if use_config:
+        ctx.run_action_through_config(action, method_name, use_fallback)
+    else:
+        action(ctx, *args)
+
+
+def run_pipeline(ctx: AssetContext, steps: list[str], telemetry: TelemetryWriter | None = None) -> bool:
+    """
+    Runs the pipeline steps (in the same notation as the command line) on a prepared context.
+    Returns False if the context was aborted by one of the steps.
+    """
+    logger.info("Running Pipeline with parameters: %s", steps)
+    for method in steps:
+        if not ctx.valid:
+            logger.warning("The context for %s was aborted", ctx.name)
+            return False
+
+        mcf, mcf_fallback = regex_mcf.match(method), regex_mcf_fallback.match(method)
+        if mcf or mcf_fallback:
+            use_fallback = mcf_fallback
+            method_name = method[:-2]
+            args = ()
+            use_config = True
+        else:
+            method_name, *args = method.split(":")
+            use_config = use_fallback = False
+        action = imports.ALL_ACTIONS.get(method_name)
+        if not action:
+            logger.error("Action %s not found", method_name)
+            # exit(1)
+        elif telemetry is None:
+            run_method(ctx, action, method_name, args, use_config, use_fallback)
+        else:
+            model = str(pathlib.PurePosixPath(ctx.built_model_path))
+            with telemetry.record(model, method, method_name, ctx.cwd):
+                run_method(ctx, action, method_name, args, use_config, use_fallback)
+    return ctx.valid
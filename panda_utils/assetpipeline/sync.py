@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+from panda_utils import staging, util
+
+logger = logging.getLogger("panda_utils.pipeline.sync")
+MANIFEST_VERSION = 1
+
+
+@dataclasses.dataclass
+class SyncResult:
+    copied: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+    def __str__(self):
+        return f"{self.copied} copied, {self.deleted} deleted, {self.unchanged} unchanged"
+
+
+def _scan(root: pathlib.Path, prefix: str = ""):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            relative = f"{prefix}{entry.name}"
+            if entry.is_dir():
+                yield from _scan(pathlib.Path(entry.path), f"{relative}/")
+            else:
+                yield relative, entry.stat()
+
+
+def _load_manifest(manifest_path: pathlib.Path, target: pathlib.Path) -> dict:
+    try:
+        with open(manifest_path) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if data.get("version") != MANIFEST_VERSION or data.get("target") != str(target):
+        return {}
+    return data.get("files", {})
+
+
+def _target_matches(target_file: pathlib.Path, size: int) -> bool:
+    try:
+        return target_file.stat().st_size == size
+    except FileNotFoundError:
+        return False
+
+
+def _remove_empty_parents(path: pathlib.Path, root: pathlib.Path) -> None:
+    path = path.parent
+    while path != root and root in path.parents:
+        try:
+            path.rmdir()
+        except OSError:
+            return
+        path = path.parent
+
+
+def sync_tree(source, target, manifest_path, workers: int | None = None) -> SyncResult:
+    """
+    Makes the files of the target folder match the source folder, using a manifest of the previous sync.
+    Only the files that were added or changed since the previous sync are copied, and the files
+    that were synced before but no longer exist in the source are deleted. Files in the target folder
+    that were never synced are left alone.
+    The file contents are only hashed when the size or the modification time changed.
+    """
+    source, target, manifest_path = pathlib.Path(source), pathlib.Path(target), pathlib.Path(manifest_path)
+    old_files = _load_manifest(manifest_path, target)
+    new_files = {}
+    result = SyncResult()
+    candidates = []
+
+    if source.exists():
+        for relative, stat in _scan(source):
+            entry = old_files.get(relative)
+            target_file = target / relative
+            if (
+                entry
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime_ns
+                and _target_matches(target_file, stat.st_size)
+            ):
+                new_files[relative] = entry
+                result.unchanged += 1
+            else:
+                candidates.append((relative, stat))
+
+    def process(candidate):
+        relative, stat = candidate
+        source_file, target_file = source / relative, target / relative
+        file_hash = util.hash_file(source_file)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash}
+        old_entry = old_files.get(relative)
+        if old_entry and old_entry["hash"] == file_hash and _target_matches(target_file, stat.st_size):
+            return relative, entry, False
+
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        # Reflinks are copy-on-write, hardlinks would let the pipeline write into the synced files
+        staging.stage_file(source_file, target_file, staging.StagingMode.REFLINK)
+        return relative, entry, True
+
+    if candidates:
+        with ThreadPoolExecutor(workers) as pool:
+            for relative, entry, copied in pool.map(process, candidates):
+                new_files[relative] = entry
+                if copied:
+                    result.copied += 1
+                else:
+                    result.unchanged += 1
+
+    for relative in sorted(set(old_files) - set(new_files)):
+        target_file = target / relative
+        target_file.unlink(missing_ok=True)
+        _remove_empty_parents(target_file, target)
+        result.deleted += 1
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "target": str(target), "files": new_files}, f)
+    os.replace(temp_path, manifest_path)
+
+    logger.info("Synced %s into %s: %s", source, target, result)
+    return result
@@ -1,5 +1,6 @@
 import abc
 import dataclasses
+import logging
 import os
 from enum import Enum
 from typing import Union, List
@@ -8,6 +9,7 @@ from pydantic import BaseModel
 
 from panda_utils.assetpipeline.commons import command_regex, preblend_regex, regex_mcf, regex_mcf_fallback
 
+logger = logging.getLogger("panda_utils.pipeline.target_parser")
 IS_PRODUCTION = bool(os.getenv("PANDA_UTILS_PRODUCTION"))
 Parameter = Union[None, str, dict, list, bool]
 """
@@ -47,6 +49,9 @@ class ImportMethod(Enum):
     YABEE = "yabee"
     """Export using YABEE utility. Requires the use of our fork."""
 
+    GLTF2EGG = "gltf2egg"
+    """Export to GLTF, and read it directly into an egg tree, without the gltf2bam and bam2egg round-trip."""
+
 
 class CollisionSystem(Enum):
     BUILTIN = "builtin"
@@ -164,6 +169,13 @@ class SingleTarget(BaseModel):
     import_method: ImportMethod = None
     """Allows overriding the default_import_method set in settings."""
 
+    shared_palette: int = 0
+    """
+    Page size of the palette shared by every model with the same texture_path, or 0 to palettize every model separately.
+    With a shared palette, the palettize step only remaps the model, the pages are built from the input images
+    of all the models (after their downscale steps) before any of them is built.
+    """
+
 
 class TargetsFile(BaseModel):
     """The definition of targets.yml file as read by the Composer module."""
@@ -188,6 +200,8 @@ class StepContext:
     exporter: ImportMethod
     exporter_override: Union[ImportMethod, None] = None
     parameter: Parameter = None
+    palette_group: str = None
+    obj_import: bool = False
 
 
 class Step(abc.ABC):
@@ -222,12 +236,60 @@ class ParametrizedStep(Step):
         return self.name + stringify_param(param)
 
 
+class Palettize(ParametrizedStep):
+    """
+    Palettizes the model by itself, or moves it into the shared palette of its group.
+    The shared palette keeps the flags of the palettize parameter, its size and exclusions do not apply there.
+    """
+
+    def make_string(self, ctx: StepContext):
+        if ctx.palette_group is None:
+            return super().make_string(ctx)
+        if ctx.parameter is False or (ctx.parameter is True and self.default is False):
+            return ""
+        if ctx.parameter is True or ctx.parameter is None:
+            return "shared_palette{}"
+
+        if isinstance(ctx.parameter, str):
+            palette_size, flags, exclusions = (ctx.parameter.split(":") + ["", ""])[:3]
+        elif isinstance(ctx.parameter, dict):
+            palette_size, exclusions = ctx.parameter.get("palette_size"), ctx.parameter.get("exclusions")
+            flags = ctx.parameter.get("flags", "")
+        else:
+            return "shared_palette{}"
+
+        for name, value in (("palette_size", palette_size), ("exclusions", exclusions)):
+            if value:
+                logger.warning("The palettize %s has no effect in the shared palette %s", name, ctx.palette_group)
+        return f"shared_palette:{flags}" if flags else "shared_palette{}"
+
+
+def make_export_flags(ctx: StepContext, exporter: ImportMethod) -> list[str]:
+    flags = []
+    if exporter == ImportMethod.BLEND2BAM:
+        flags.append("b2b")
+    if ctx.settings.srgb_textures:
+        flags.append("srgb")
+    if ctx.settings.collision_system == CollisionSystem.BULLET:
+        flags.append("bullet")
+    if ctx.settings.legacy_materials:
+        flags.append("legacy")
+    return flags
+
+
 class Preexport(Step):
     name = "preexport"
 
     def make_string(self, ctx: StepContext):
+        ctx.obj_import = False
         if ctx.parameter is False:
             return ""
+        inputs = [f for f in ctx.files if preblend_regex.match(f) or f.endswith(".blend")]
+        # Models made only of OBJ files are read straight into egg, unless Blender is explicitly requested
+        if ctx.parameter != "blender" and inputs and all(f.endswith(".obj") for f in inputs):
+            ctx.obj_import = True
+            flags = [flag for flag in make_export_flags(ctx, ctx.exporter_override or ctx.exporter) if flag != "b2b"]
+            return "obj2egg:" + ",".join(flags)
         if any(preblend_regex.match(f) for f in ctx.files):
             return "preblend"
         return "blendrename"
@@ -237,20 +299,16 @@ class Export(Step):
     name = "blend2bam"
 
     def make_string(self, ctx: StepContext):
+        if ctx.obj_import:
+            return ""
         exporter = ctx.exporter_override or ctx.exporter
         if exporter == ImportMethod.YABEE:
             return "yabee{}"
         else:
-            cmd = "blend2bam"
-            flags = []
-            if exporter == ImportMethod.BLEND2BAM:
-                flags.append("b2b")
-            if ctx.settings.srgb_textures:
-                flags.append("srgb")
-            if ctx.settings.collision_system == CollisionSystem.BULLET:
-                flags.append("bullet")
-            if ctx.settings.legacy_materials:
-                flags.append("legacy")
+            cmd = "gltf2egg" if exporter == ImportMethod.GLTF2EGG else "blend2bam"
+            flags = make_export_flags(ctx, exporter)
+            if exporter == ImportMethod.GLTF2EGG:
+                return cmd + ":" + ",".join(flags)
             return cmd + ":" + ",".join(flags) + " bam2egg"
 
 
@@ -262,7 +320,7 @@ class PipelineBlockout:
 
 PIPELINE_BLOCKOUTS = {
     CallbackType.STANDARD: PipelineBlockout(
-        exporters=[ImportMethod.GLTF2BAM, ImportMethod.BLEND2BAM, ImportMethod.YABEE],
+        exporters=[ImportMethod.GLTF2BAM, ImportMethod.BLEND2BAM, ImportMethod.GLTF2EGG, ImportMethod.YABEE],
         steps=[
             ParametrizedStep("downscale"),
             ParametrizedStep("cts"),
@@ -272,7 +330,7 @@ PIPELINE_BLOCKOUTS = {
             ConstantStep("transform[]"),
             ConstantStep("group_rename[]"),
             ConstantStep("group_remove[]"),
-            ParametrizedStep("palettize"),
+            Palettize("palettize"),
             ParametrizedStep("optimize", default=None),
             ConstantStep("uvscroll[]"),
             ParametrizedStep("egg2bam", default=None),
@@ -289,7 +347,7 @@ PIPELINE_BLOCKOUTS = {
             ConstantStep("transform[]"),
             ConstantStep("group_rename[]"),
             ConstantStep("group_remove[]"),
-            ParametrizedStep("palettize"),
+            Palettize("palettize"),
             ParametrizedStep("optimize", default=None),
             ParametrizedStep("optchar", default=[]),
             ConstantStep("uvscroll[]"),
@@ -301,7 +359,7 @@ PIPELINE_BLOCKOUTS = {
         steps=[
             ParametrizedStep("downscale"),
             ParametrizedStep("texture_cards", default=None),
-            ParametrizedStep("palettize", default="1024"),
+            Palettize("palettize", default="1024"),
             ParametrizedStep("egg2bam", default=None),
         ],
     ),
@@ -0,0 +1,182 @@
+import argparse
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from panda_utils import util
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger("panda_utils.pipeline.telemetry")
+TELEMETRY_VARIABLE = "PANDA_UTILS_TELEMETRY"
+SUMMARY_FIELDS = ["wall_time", "cpu_time", "child_cpu_time", "child_wall_time", "child_count", "peak_rss_growth"]
+
+
+def tree_size(path) -> dict:
+    files = size = 0
+    for dirpath, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                continue
+            files += 1
+    return {"files": files, "bytes": size}
+
+
+def _usage():
+    if resource is None:
+        return {"cpu_time": time.process_time(), "child_cpu_time": 0.0, "peak_rss": None, "child_peak_rss": None}
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_multiplier = 1 if sys.platform == "darwin" else 1024
+    return {
+        "cpu_time": own.ru_utime + own.ru_stime,
+        "child_cpu_time": children.ru_utime + children.ru_stime,
+        "peak_rss": own.ru_maxrss * rss_multiplier,
+        "child_peak_rss": children.ru_maxrss * rss_multiplier,
+    }
+
+
+class TelemetryWriter:
+    """
+    Appends one JSON line per pipeline action to the file in PANDA_UTILS_TELEMETRY.
+    Running this module with the file path prints a per-model and per-step summary of the recorded events:
+        python -m panda_utils.assetpipeline.telemetry telemetry.jsonl
+
+    The times and counts of an event only cover its action. The operating system only keeps the peak memory use
+    of a process over its whole lifetime, so process_peak_rss includes everything the process ran before (the earlier
+    jobs of a warm worker too), and peak_rss_growth is how much of it was added during the action.
+    child_cpu_time covers every tool the process waited for during the action, even from other threads,
+    while child_count and child_wall_time only count the tools started by the action itself.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path).absolute()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        path = os.getenv(TELEMETRY_VARIABLE)
+        return cls(path) if path else None
+
+    def write(self, event: dict) -> None:
+        line = json.dumps(event) + "\n"
+        # Multiple pipelines may share the file, a single append per event keeps the lines intact
+        with self.lock, open(self.path, "a") as f:
+            f.write(line)
+
+    @contextmanager
+    def record(self, model: str, step: str, action: str, root):
+        usage_before = _usage()
+        tree_before = tree_size(root)
+        start_time, start = time.time(), time.perf_counter()
+        status = "ok"
+        with util.count_subprocesses() as children:
+            try:
+                yield
+            except BaseException:
+                status = "error"
+                raise
+            finally:
+                wall_time = time.perf_counter() - start
+                usage_after = _usage()
+                child_count, child_wall_time = children.snapshot()
+                peak_rss = usage_after["peak_rss"]
+                self.write_event(
+                    {
+                        "model": model,
+                        "step": step,
+                        "action": action,
+                        "status": status,
+                        "start": start_time,
+                        "wall_time": wall_time,
+                        "cpu_time": usage_after["cpu_time"] - usage_before["cpu_time"],
+                        "peak_rss_growth": None if peak_rss is None else peak_rss - usage_before["peak_rss"],
+                        "process_peak_rss": peak_rss,
+                        "child_cpu_time": usage_after["child_cpu_time"] - usage_before["child_cpu_time"],
+                        "child_wall_time": child_wall_time,
+                        "child_count": child_count,
+                        "process_child_peak_rss": usage_after["child_peak_rss"],
+                        "tree_before": tree_before,
+                        "tree_after": tree_size(root),
+                    }
+                )
+
+    def write_event(self, event: dict) -> None:
+        try:
+            self.write(event)
+        except OSError as e:
+            logger.warning("Unable to write telemetry: %s", e)
+
+
+def read_events(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    return events
+
+
+def summarize(events, key: str) -> dict:
+    """
+    Aggregates the events by the given key (model, step or action).
+    Each group contains the number of events, the sums of the timings and of the peak RSS growth,
+    and the largest process peak RSS.
+    """
+    summary = {}
+    for event in events:
+        group = summary.setdefault(
+            event[key], {"events": 0, "process_peak_rss": 0, **{field: 0 for field in SUMMARY_FIELDS}}
+        )
+        group["events"] += 1
+        for field in SUMMARY_FIELDS:
+            group[field] += event.get(field) or 0
+        group["process_peak_rss"] = max(group["process_peak_rss"], event.get("process_peak_rss") or 0)
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["wall_time"]))
+
+
+def format_summary(title: str, summary: dict) -> str:
+    lines = [
+        f"{title:<40} {'runs':>5} {'wall':>9} {'cpu':>9} {'tools':>9} {'tool cpu':>9} {'rss growth':>10}",
+    ]
+    for name, group in summary.items():
+        lines.append(
+            f"{name[:40]:<40} {group['events']:>5} {group['wall_time']:>8.2f}s {group['cpu_time']:>8.2f}s "
+            f"{group['child_wall_time']:>8.2f}s {group['child_cpu_time']:>8.2f}s "
+            f"{group['peak_rss_growth'] / 2**20:>8.1f}MB"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the pipeline telemetry.")
+    parser.add_argument("events", help="The JSON-lines file written by the pipeline")
+    parser.add_argument("--json", action="store_true", help="Output the summary as JSON")
+    ans = parser.parse_args()
+
+    events = read_events(ans.events)
+    per_model, per_step = summarize(events, "model"), summarize(events, "action")
+    if ans.json:
+        print(json.dumps({"models": per_model, "steps": per_step}, indent=2))
+    else:
+        print(format_summary("Model", per_model))
+        print()
+        print(format_summary("Step", per_step))
+
+
+if __name__ == "__main__":
+    main()
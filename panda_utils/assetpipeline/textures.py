@@ -1,13 +1,19 @@
 import logging
 
-from panda_utils import util
-from panda_utils.assetpipeline.commons import AssetContext
-from panda_utils.tools.downscale import downscale
+from panda_utils.assetpipeline import parallel
+from panda_utils.assetpipeline.commons import CACHE_FOLDER, AssetContext
+from panda_utils.eggtree import cards
+from panda_utils.tools.downscale import DownscaleOptions, downscale
+from panda_utils.tools.palettize import read_image_sizes
 
 logger = logging.getLogger("panda_utils.pipeline.textures")
+DOWNSCALE_CACHE_FOLDER = CACHE_FOLDER / "downscale"
 
 
-def action_downscale(ctx: AssetContext, size, bbox=-1, flags="", name=""):
+def get_downscale_options(size, bbox=-1, flags="", name="") -> DownscaleOptions:
+    """
+    The options of a downscale step, as the step itself passes them to the downscaler.
+    """
     target_size = int(size)
     if target_size & (target_size - 1):
         raise ValueError("The target size must be a power of two!")
@@ -15,12 +21,29 @@ def action_downscale(ctx: AssetContext, size, bbox=-1, flags="", name=""):
     bbox = int(bbox)
     flag_list = flags.split(",")
     force = bbox >= 0 or "truecenter" in flag_list or "force" in flag_list
-    downscale(ctx.putil_ctx, ".", target_size, force, bbox, "truecenter" in flag_list, False, name, False)
+    return DownscaleOptions(target_size, force, bbox, "truecenter" in flag_list, False, name)
+
+
+def action_downscale(ctx: AssetContext, size, bbox=-1, flags="", name=""):
+    options = get_downscale_options(size, bbox, flags, name)
+    downscale(
+        ctx.putil_ctx,
+        ".",
+        options.scale,
+        options.force,
+        options.bbox,
+        options.truecenter,
+        options.ignore_current_scale,
+        options.pattern,
+        False,
+        workers=parallel.get_worker_count(ctx.model_config),
+        cache_folder=ctx.project_root / DOWNSCALE_CACHE_FOLDER,
+    )
 
 
 def action_texture_cards(ctx: AssetContext, size=None):
-    args = ["-o", f"{ctx.model_name}.egg"]
-    if size:
-        args += ["-p", f"{size},{size}"]
-    args += [file for file in ctx.files if file.endswith(".png")]
-    util.run_panda(ctx.putil_ctx, "egg-texture-cards", *args)
+    ctx.cache_eggs()
+    images = [file for file in ctx.files if file.endswith(".png")]
+    pixel_size = (int(size), int(size)) if size else None
+    sizes = read_image_sizes(ctx.cwd, images) if pixel_size else None
+    ctx.eggs[f"{ctx.model_name}.egg"] = cards.make_texture_cards(images, sizes, pixel_size)
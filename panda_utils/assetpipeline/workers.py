@@ -0,0 +1,156 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+
+logger = logging.getLogger("panda_utils.pipeline.workers")
+WARM_WORKERS_VARIABLE = "PANDA_UTILS_WARM_WORKERS"
+
+
+def warm_workers_enabled() -> bool:
+    return os.getenv(WARM_WORKERS_VARIABLE, "1").lower() not in ("0", "false", "no", "off")
+
+
+def _reset_process_state(base_environ, base_path, base_cwd, base_handlers, base_level):
+    """
+    Undoes everything a pipeline run may have changed in the worker, so the next job starts clean.
+    """
+    os.environ.clear()
+    os.environ.update(base_environ)
+    sys.path[:] = base_path
+    os.chdir(base_cwd)
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        if handler not in base_handlers:
+            handler.close()
+    root_logger.handlers[:] = base_handlers
+    root_logger.setLevel(base_level)
+    # Project scripts are imported from the project root, they must not leak into the next project
+    for name in list(sys.modules):
+        if name == "scripts" or name.startswith("scripts."):
+            del sys.modules[name]
+
+
+def _worker_main(connection):
+    # Importing the pipeline pulls in yaml, numpy and every action module, this is the cost we only want to pay once
+    from panda_utils import util
+    from panda_utils.assetpipeline.__main__ import setup_logging
+    from panda_utils.assetpipeline.runner import prepare_context, run_pipeline
+    from panda_utils.assetpipeline.telemetry import TelemetryWriter
+
+    if util.get_debug(util.LoggingScope.PIPELINE):
+        setup_logging()
+
+    root_logger = logging.getLogger()
+    base_state = dict(os.environ), list(sys.path), os.getcwd(), list(root_logger.handlers), root_logger.level
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        success = True
+        try:
+            os.environ.update(job.get("environ", {}))
+            input_folder, model_output, texture_output, *steps = job["argv"]
+            ctx = prepare_context(input_folder, model_output, texture_output, project_root=job["cwd"])
+            run_pipeline(ctx, steps, TelemetryWriter.from_environment())
+        except SystemExit as e:
+            success = not e.code
+        except Exception:
+            logger.exception("The pipeline job %s failed", job["argv"])
+            success = False
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            _reset_process_state(*base_state)
+        connection.send(success)
+
+
+class PipelineWorker:
+    """
+    A long-lived process that runs pipeline jobs one at a time.
+    """
+
+    def __init__(self, mp_context):
+        self.mp_context = mp_context
+        self.process = None
+        self.connection = None
+        self.start()
+
+    def start(self):
+        parent_connection, child_connection = self.mp_context.Pipe()
+        self.process = self.mp_context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.connection = parent_connection
+
+    def run(self, job) -> bool:
+        try:
+            self.connection.send(job)
+            return self.connection.recv()
+        except (EOFError, OSError):
+            # The worker crashed (for example, a segfault in a native module), only this job is lost
+            self.process.join(timeout=5)
+            logger.error("Pipeline worker crashed with exit code %s, restarting", self.process.exitcode)
+            self.start()
+            return False
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (EOFError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class WorkerPool:
+    """
+    Runs pipeline jobs in warm worker processes. A new worker is only started when all the existing ones are busy.
+    """
+
+    def __init__(self):
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.idle = queue.SimpleQueue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> PipelineWorker:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            worker = PipelineWorker(self.mp_context)
+            with self.lock:
+                self.workers.append(worker)
+            return worker
+
+    def run(self, argv, cwd=None, environ=None) -> bool:
+        worker = self.acquire()
+        try:
+            return worker.run({"argv": [str(arg) for arg in argv], "cwd": cwd or os.getcwd(), "environ": environ or {}})
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+
+_pool = None
+
+
+def get_pool() -> WorkerPool:
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+        atexit.register(_pool.close)
+    return _pool
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.animation")
+INTERPOLATION_NOTE = (
+    "Frames are dropped where interpolation rebuilds them, the animations only play back smoothly with "
+    "interpolate-frames #t in the Config.prc (it is off by default)"
+)
+# The value of a missing channel, scale channels default to 1 and everything else to 0
+CHANNEL_DEFAULTS = {"i": 1.0, "j": 1.0, "k": 1.0}
+ANGLE_CHANNELS = "hpr"
+# Translations are in units and rotations in degrees, everything else (scales, shears, morph sliders) is a factor
+CHANNEL_KINDS = {**dict.fromkeys("xyz", "translate"), **dict.fromkeys(ANGLE_CHANNELS, "rotate")}
+# Values that differ by less than this are considered equal when no tolerance is given for their kind of channel
+EPSILON = 1e-6
+VALUES_PER_LINE = 8
+
+
+class Channel:
+    """
+    One <S$Anim> table of a bundle, with its values and the node holding its frame rate.
+    """
+
+    def __init__(self, node: eggparse.EggBranch, owner: eggparse.EggBranch, component: str, values):
+        self.node = node
+        self.owner = owner
+        self.component = component
+        self.values = values
+
+    @property
+    def is_angle(self) -> bool:
+        return self.component in ANGLE_CHANNELS
+
+    @property
+    def kind(self) -> str:
+        return CHANNEL_KINDS.get(self.component, "scale")
+
+    def get_curve(self):
+        # Angles are unwrapped, so going from 179 to -179 degrees is a small step
+        return np.unwrap(self.values, period=360) if self.is_angle else self.values
+
+
+def read_values(node) -> np.ndarray:
+    values = geometry.get_child_nodes(node, "V")
+    if not values:
+        return np.zeros(0)
+    if isinstance(values[0], eggparse.EggLeaf):
+        text = values[0].node_value
+    else:
+        text = " ".join(child.value for child in values[0].children if isinstance(child, eggparse.EggString))
+    return np.array(text.split(), dtype=float)
+
+
+def write_values(node, values) -> None:
+    texts = [geometry.format_float(value) for value in values]
+    if len(texts) <= VALUES_PER_LINE:
+        value_node = eggparse.EggLeaf("V", None, " ".join(texts))
+    else:
+        lines = [" ".join(texts[i : i + VALUES_PER_LINE]) for i in range(0, len(texts), VALUES_PER_LINE)]
+        value_node = eggparse.EggBranch("V", None, eggparse.EggTree(*map(eggparse.EggString, lines)))
+    others = [child for child in node.children if getattr(child, "node_type", None) != "V"]
+    node.children = eggparse.EggTree(*others, value_node)
+
+
+def get_channels(bundle) -> list[Channel]:
+    channels = []
+    for transform in bundle.findall("Xfm$Anim_S$"):
+        for node in geometry.get_child_nodes(transform, "S$Anim"):
+            channels.append(Channel(node, transform, node.node_name, read_values(node)))
+    # Morph sliders are scalar tables with their own frame rate
+    for table in bundle.findall("Table"):
+        for node in geometry.get_child_nodes(table, "S$Anim"):
+            channels.append(Channel(node, node, "", read_values(node)))
+    return channels
+
+
+def get_fps(channels: list[Channel]) -> float | None:
+    for channel in channels:
+        fps = geometry.get_scalar(channel.owner, "fps")
+        if fps is not None:
+            return float(fps)
+    return None
+
+
+def resample(curve, frame_count: int):
+    """
+    Linearly resamples the curve to the new number of frames. The first and last frames stay where they are,
+    so looping animations (whose last frame repeats the first) still loop.
+    """
+    return np.interp(np.linspace(0, len(curve) - 1, frame_count), np.arange(len(curve)), curve)
+
+
+def get_resample_error(curve, frame_count: int, interpolated: bool = False) -> float:
+    """
+    The largest difference between the curve and its resampled version, as it is played back at the original frames.
+    Without interpolate-frames, each original frame shows the last resampled frame before it.
+    """
+    samples = resample(curve, frame_count)
+    positions = np.arange(len(curve)) * (frame_count - 1) / (len(curve) - 1)
+    if interpolated:
+        played = np.interp(positions, np.arange(frame_count), samples)
+    else:
+        played = samples[np.floor(positions + EPSILON).astype(int)]
+    return float(np.max(np.abs(played - curve)))
+
+
+def choose_frame_count(
+    channels: list[Channel], frame_count: int, tolerances: dict[str, float], interpolated: bool = False
+) -> int:
+    """
+    Returns the lowest frame count that plays every channel back within the tolerance of its kind, trying every step
+    between frames until one fails. Steps that divide the animation evenly keep a subset of the original frames.
+    """
+    curves = [
+        (channel.get_curve(), tolerances[channel.kind]) for channel in channels if len(channel.values) == frame_count
+    ]
+    best = frame_count
+    for step in range(2, frame_count):
+        candidate = round((frame_count - 1) / step) + 1
+        if candidate >= best:
+            continue
+        if any(get_resample_error(curve, candidate, interpolated) > tolerance for curve, tolerance in curves):
+            break
+        best = candidate
+    return best
+
+
+def get_tolerances(tolerance: float = 0, angle_tolerance: float = 0, scale_tolerance: float = 0) -> dict[str, float]:
+    return {
+        "translate": tolerance or EPSILON,
+        "rotate": angle_tolerance or EPSILON,
+        "scale": scale_tolerance or EPSILON,
+    }
+
+
+def compress_bundle(
+    bundle, fps: float | None = None, tolerances: dict[str, float] | None = None, interpolated: bool = False
+) -> None:
+    channels = get_channels(bundle)
+    if not channels:
+        return
+
+    tolerances = tolerances or get_tolerances()
+    frame_count = max(len(channel.values) for channel in channels)
+    old_fps = get_fps(channels)
+    new_count = frame_count
+    if fps and old_fps and fps < old_fps and frame_count > 2:
+        new_count = max(2, round((frame_count - 1) * fps / old_fps) + 1)
+    if frame_count > 2:
+        new_count = min(new_count, choose_frame_count(channels, frame_count, tolerances, interpolated))
+
+    if new_count != frame_count:
+        for channel in channels:
+            if len(channel.values) == frame_count:
+                channel.values = resample(channel.get_curve(), new_count)
+        if old_fps:
+            # The duration stays the same, so the frame rate follows the number of frames
+            new_fps = geometry.format_float(old_fps * (new_count - 1) / (frame_count - 1))
+            for owner in {id(channel.owner): channel.owner for channel in channels}.values():
+                geometry.set_scalar(owner, "fps", new_fps)
+
+    removals = set()
+    for channel in channels:
+        values = channel.get_curve()
+        epsilon = tolerances[channel.kind]
+        if len(values) > 1 and np.ptp(values) <= epsilon:
+            channel.values = np.array([(values.min() + values.max()) / 2])
+        default = CHANNEL_DEFAULTS.get(channel.component, 0.0)
+        # Morph sliders must keep their table, even when it is zero
+        if channel.component and len(channel.values) == 1 and abs(channel.values[0] - default) <= epsilon:
+            removals.add(channel.node)
+        else:
+            write_values(channel.node, channel.values)
+
+    owners = {id(channel.owner): channel.owner for channel in channels if channel.node in removals}
+    for owner in owners.values():
+        owner.remove_nodes(removals)
+
+
+def count_frames_and_channels(tree) -> tuple[int, int]:
+    """
+    The number of frames of the longest channel and the number of channels, over every bundle of the tree.
+    """
+    frames = channels = 0
+    for bundle in tree.findall("Bundle"):
+        for channel in get_channels(bundle):
+            frames = max(frames, len(channel.values))
+            channels += 1
+    return frames, channels
+
+
+def compress_animation(
+    tree,
+    fps: float | None = None,
+    tolerance: float = 0,
+    angle_tolerance: float = 0,
+    scale_tolerance: float = 0,
+    interpolated: bool = False,
+) -> int:
+    """
+    Compresses every bundle of the tree. Constant channels are reduced to a single value, or removed when
+    they hold the default value. With a frame rate, the animation is resampled if it is faster.
+    The frames are also reduced as long as every channel still plays back within its tolerance: translations
+    in units, rotations in degrees and scales, shears and morph sliders as factors.
+    Playback holds each frame until the next one, unless interpolated is set: then the dropped frames are rebuilt
+    by linear interpolation, which needs interpolate-frames in the Config.prc of the game (Panda3D turns it off).
+    Returns the number of bundles.
+    """
+    tolerances = get_tolerances(tolerance, angle_tolerance, scale_tolerance)
+    bundles = tree.findall("Bundle")
+    for bundle in bundles:
+        compress_bundle(bundle, fps, tolerances, interpolated)
+    return len(bundles)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import logging
+import posixpath
+from collections.abc import Iterable
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.cards")
+# Left, right, bottom, top, the same default as egg-texture-cards -g
+DEFAULT_CARD_GEOMETRY = (-0.5, 0.5, -0.5, 0.5)
+# The corners of a card with their UVs, in the winding order of egg-texture-cards
+CARD_CORNERS = ((0, 3, "0 1"), (0, 2, "0 0"), (1, 2, "1 0"), (1, 3, "1 1"))
+
+
+def get_card_frame(
+    size: tuple[int, int] | None, pixel_size: tuple[int, int] | None, card_geometry=DEFAULT_CARD_GEOMETRY
+) -> tuple[float, float, float, float]:
+    """
+    Same as egg-texture-cards -p: an image of pixel_size pixels fills the card geometry,
+    and other images are scaled in proportion to their size.
+    """
+    if pixel_size is None or size is None:
+        return tuple(card_geometry)
+
+    left, right, bottom, top = card_geometry
+    x_scale, y_scale = size[0] / pixel_size[0], size[1] / pixel_size[1]
+    return left * x_scale, right * x_scale, bottom * y_scale, top * y_scale
+
+
+def make_texture_cards(
+    images: Iterable[str],
+    sizes: dict[str, tuple[int, int]] | None = None,
+    pixel_size: tuple[int, int] | None = None,
+    fps: int = 2,
+    card_geometry=DEFAULT_CARD_GEOMETRY,
+) -> eggparse.EggTree:
+    """
+    Builds the same tree as egg-texture-cards: a switch node with one textured card per image.
+    The sizes (in pixels) are only needed with a pixel size, and cards with the same frame share their vertices.
+    """
+    sizes = sizes or {}
+    vertices = eggparse.EggTree()
+    frames = {}
+    textures, groups = [], []
+    for image in images:
+        name = posixpath.splitext(posixpath.basename(image))[0]
+        if pixel_size is not None and image not in sizes:
+            logger.warning("Unable to read the size of %s, using the default card geometry", image)
+
+        frame = get_card_frame(sizes.get(image), pixel_size, card_geometry)
+        if frame not in frames:
+            frames[frame] = len(vertices.children)
+            for x, y, uv in CARD_CORNERS:
+                position = " ".join(geometry.format_float(value) for value in (frame[x], frame[y], 0))
+                vertex = eggparse.EggTree(eggparse.EggString(position), eggparse.EggLeaf("UV", None, uv))
+                vertices += eggparse.EggBranch("Vertex", str(len(vertices.children)), vertex)
+
+        first = frames[frame]
+        indices = " ".join(str(index) for index in range(first, first + len(CARD_CORNERS)))
+        polygon = eggparse.EggTree(
+            eggparse.EggLeaf("RGBA", None, "1 1 1 1"),
+            eggparse.EggLeaf("TRef", None, name),
+            eggparse.EggLeaf("VertexRef", None, f"{indices} <Ref> {{ vpool }}"),
+        )
+        texture_path = eggparse.EggString(eggparse.EggNode.convert_string_to_egg(image))
+        textures.append(eggparse.EggBranch("Texture", name, eggparse.EggTree(texture_path)))
+        groups.append(eggparse.EggBranch("Group", name, eggparse.EggTree(eggparse.EggBranch("Polygon", None, polygon))))
+
+    switch = []
+    # Like egg-texture-cards, a single card is not a flip book
+    if len(groups) > 1:
+        switch = [eggparse.EggLeaf("Switch", None, "1"), eggparse.EggLeaf("Scalar", "fps", str(fps))]
+    contents = eggparse.EggTree(*switch, eggparse.EggBranch("VertexPool", "vpool", vertices), *groups)
+    return eggparse.EggTree(*textures, eggparse.EggBranch("Group", None, contents))
@@ -0,0 +1,167 @@
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.cleanup")
+
+
+def get_joint_refs(tree) -> list[eggparse.EggNode]:
+    return [ref for joint in tree.findall("Joint") for ref in geometry.get_child_nodes(joint, "VertexRef")]
+
+
+def get_primitive_refs(tree) -> list[eggparse.EggNode]:
+    """
+    Every vertex reference that uses the vertices, rather than assigning them to a joint.
+    """
+    joint_refs = {id(ref) for ref in get_joint_refs(tree)}
+    return [ref for ref in tree.findall("VertexRef") if id(ref) not in joint_refs]
+
+
+def split_vertex(vertex) -> tuple[str, list[float]]:
+    """
+    Splits the contents of a vertex into its structure (the node types and names) and its numbers.
+    """
+    structure, values = [], []
+    for token in " ".join(repr(child) for child in vertex.children).split():
+        try:
+            values.append(float(token))
+        except ValueError:
+            structure.append(token)
+        else:
+            structure.append("#")
+    return " ".join(structure), values
+
+
+def remove_degenerate_polygons(tree, polygons: set[int]) -> int:
+    """
+    Drops the repeated corners of the given polygons, and the polygons that are left with less than three.
+    """
+    removals = set()
+    for polygon in tree.findall("Polygon"):
+        if id(polygon) not in polygons:
+            continue
+        ref, indices, _ = geometry.get_primitive_vertices(polygon)
+        corners = [index for offset, index in enumerate(indices) if index != indices[offset - 1]]
+        if len(set(corners)) < 3:
+            removals.add(polygon)
+        elif len(corners) != len(indices):
+            geometry.set_vertex_ref(ref, corners)
+    tree.remove_nodes(removals)
+    return len(removals)
+
+
+def weld_vertices(tree) -> int:
+    """
+    Merges the vertices of each pool that are identical: same position, normal, UVs, colors, morphs
+    and joint memberships. The references are remapped to the vertex with the lowest index.
+    Returns the number of vertices that were removed.
+    """
+    pools = {pool.node_name: pool for pool in tree.findall("VertexPool")}
+    memberships: dict[tuple[str, int], list[int]] = {}
+    for ref in get_joint_refs(tree):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        for index in indices:
+            memberships.setdefault((pool, index), []).append(id(ref))
+
+    remaps: dict[str, dict[int, int]] = {}
+    for name, vertices in geometry.get_vertex_pools(tree).items():
+        # The vertices can only be compared when they have the same kind of contents
+        layouts: dict[tuple, list[tuple[int, list[float]]]] = {}
+        for index in sorted(vertices):
+            structure, values = split_vertex(vertices[index])
+            key = (structure, tuple(sorted(memberships.get((name, index), []))))
+            layouts.setdefault(key, []).append((index, values))
+
+        remap = {}
+        for items in layouts.values():
+            if len(items) < 2:
+                continue
+            indices = np.array([index for index, _ in items])
+            values = np.array([values for _, values in items], dtype=float).reshape(len(items), -1)
+            # The first occurrence of every row is the one with the lowest index, since the rows are sorted
+            _, first, inverse = np.unique(values, axis=0, return_index=True, return_inverse=True)
+            targets = indices[first[inverse.reshape(-1)]]
+            remap.update((int(index), int(target)) for index, target in zip(indices, targets) if index != target)
+        if remap:
+            remaps[name] = remap
+
+    if not remaps:
+        return 0
+
+    for ref in tree.findall("VertexRef"):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        remap = remaps.get(pool)
+        if remap and any(index in remap for index in indices):
+            geometry.set_vertex_ref(ref, [remap.get(index, index) for index in indices])
+
+    # Joints list every vertex once, and welded vertices may have become repeated corners of a polygon
+    for ref in get_joint_refs(tree):
+        indices, _ = geometry.parse_vertex_ref(ref)
+        if len(set(indices)) != len(indices):
+            geometry.set_vertex_ref(ref, list(dict.fromkeys(indices)))
+    polygons = set()
+    for polygon in tree.findall("Polygon"):
+        _, indices, pool = geometry.get_primitive_vertices(polygon)
+        if pool in remaps and len(set(indices)) != len(indices):
+            polygons.add(id(polygon))
+    remove_degenerate_polygons(tree, polygons)
+
+    removals = set()
+    for name, remap in remaps.items():
+        vertices = geometry.get_child_nodes(pools[name], "Vertex")
+        removals.update(vertex for vertex in vertices if int(vertex.node_name) in remap)
+    tree.remove_nodes(removals)
+    return len(removals)
+
+
+def prune_vertices(tree) -> int:
+    """
+    Removes the vertices that no primitive uses, along with their joint memberships, and the pools that end up empty.
+    Returns the number of vertices that were removed.
+    """
+    used: dict[str, set[int]] = {}
+    for ref in get_primitive_refs(tree):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        used.setdefault(pool, set()).update(indices)
+
+    removed = 0
+    removals = set()
+    for pool in tree.findall("VertexPool"):
+        vertices = geometry.get_child_nodes(pool, "Vertex")
+        unused = [vertex for vertex in vertices if int(vertex.node_name) not in used.get(pool.node_name, ())]
+        removed += len(unused)
+        if unused and len(unused) == len(vertices):
+            removals.add(pool)
+        else:
+            removals.update(unused)
+
+    if not removed:
+        return 0
+
+    for ref in get_joint_refs(tree):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        kept = [index for index in indices if index in used.get(pool, ())]
+        if not kept:
+            removals.add(ref)
+        elif len(kept) != len(indices):
+            geometry.set_vertex_ref(ref, kept)
+    tree.remove_nodes(removals)
+    return removed
+
+
+def prune_textures(tree) -> list[str]:
+    """
+    Removes the textures and materials that no primitive refers to. Returns their names.
+    """
+    removed = []
+    for node_type, ref_type in (("Texture", "TRef"), ("Material", "MRef")):
+        used = {eggparse.sanitize_string(ref.node_value) for ref in tree.findall(ref_type)}
+        unused = {node for node in tree.findall(node_type) if node.node_name not in used}
+        removed += sorted(node.node_name for node in unused)
+        tree.remove_nodes(unused)
+    return removed
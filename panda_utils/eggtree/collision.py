@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import logging
+from collections.abc import Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import decimate, eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.collision")
+PROXY_METHODS = ("obb", "hull", "capsule", "decimate")
+# Convex hulls of smooth meshes keep most of their vertices, past this they are decimated as well
+MAX_HULL_TRIANGLES = 256
+CAPSULE_SEGMENTS = 8
+# The faces of a box, as corner bits: 1 for the maximum along the first axis, 2 along the second, 4 along the third
+BOX_FACES = [(0, 2, 3, 1), (4, 5, 7, 6), (0, 1, 5, 4), (2, 6, 7, 3), (0, 4, 6, 2), (1, 3, 7, 5)]
+
+Mesh = tuple["np.ndarray", list[Sequence[int]]]
+
+
+def get_principal_axes(points: np.ndarray) -> np.ndarray:
+    """
+    The principal axes of the points as the rows of a rotation matrix, the longest first.
+    """
+    _, vectors = np.linalg.eigh(np.cov(points - points.mean(axis=0), rowvar=False).reshape(3, 3))
+    axes = vectors[:, ::-1].T
+    # Keeps the axes right-handed, so the faces built from them wind the same way
+    if np.linalg.det(axes) < 0:
+        axes[2] = -axes[2]
+    return axes
+
+
+def orient_faces(vertices: np.ndarray, faces: list[Sequence[int]], center: np.ndarray) -> list[Sequence[int]]:
+    """
+    Winds every face counter-clockwise seen from outside, and drops the ones without an area.
+    """
+    oriented = []
+    for face in faces:
+        corners = vertices[list(face)]
+        normal = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+        if len(face) > 3:
+            normal += np.cross(corners[2] - corners[0], corners[3] - corners[0])
+        if np.linalg.norm(normal) <= 1e-12 * max(np.abs(vertices).max(), 1):
+            continue
+        oriented.append(tuple(face) if normal @ (corners.mean(axis=0) - center) >= 0 else tuple(face)[::-1])
+    return oriented
+
+
+def fit_box(points: np.ndarray) -> Mesh:
+    """
+    The box around the points, along their principal axes.
+    """
+    axes = get_principal_axes(points)
+    local = points @ axes.T
+    low, high = local.min(axis=0), local.max(axis=0)
+    corners = np.array([[(high if corner >> axis & 1 else low)[axis] for axis in range(3)] for corner in range(8)])
+    vertices = corners @ axes
+    return vertices, orient_faces(vertices, BOX_FACES, vertices.mean(axis=0))
+
+
+def get_hull_edges(faces: list[tuple[int, int, int]]) -> dict[tuple[int, int], int]:
+    return {(a, b): face for face, (i, j, k) in enumerate(faces) for a, b in ((i, j), (j, k), (k, i))}
+
+
+def convex_hull(points: np.ndarray) -> Mesh | None:
+    """
+    The convex hull of the points, built incrementally from the farthest points inwards.
+    Returns None when the points are flat or the hull does not come out closed.
+    """
+    scale = np.ptp(points, axis=0).max() if len(points) else 0
+    if len(points) < 4 or not scale:
+        return None
+    epsilon = scale * 1e-7
+
+    # The starting tetrahedron, from the extreme points
+    first = int(points[:, 0].argmin())
+    second = int(np.linalg.norm(points - points[first], axis=1).argmax())
+    line = points[second] - points[first]
+    third = int(np.linalg.norm(np.cross(points - points[first], line), axis=1).argmax())
+    normal = np.cross(line, points[third] - points[first])
+    heights = (points - points[first]) @ normal / (np.linalg.norm(normal) or 1)
+    fourth = int(np.abs(heights).argmax())
+    if abs(heights[fourth]) <= epsilon:
+        return None
+
+    simplex = [first, second, third, fourth]
+    tetrahedron = [(first, second, third), (first, second, fourth), (first, third, fourth), (second, third, fourth)]
+    faces = orient_faces(points, tetrahedron, points[simplex].mean(axis=0))
+
+    def get_planes(faces):
+        corners = points[np.array(faces)]
+        normals = decimate.get_normals(corners)
+        normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+        return normals, np.einsum("ij,ij->i", normals, corners[:, 0])
+
+    normals, offsets = get_planes(faces)
+    remaining = np.setdiff1d(np.arange(len(points)), simplex)
+    remaining = remaining[np.argsort(-np.linalg.norm(points[remaining] - points[simplex].mean(axis=0), axis=1))]
+    while len(remaining):
+        # The points inside the hull so far never need to be looked at again
+        outside = (points[remaining] @ normals.T - offsets > epsilon).any(axis=1)
+        remaining = remaining[outside]
+        for point in remaining[:32]:
+            distances = normals @ points[point] - offsets
+            if distances.max() <= epsilon:
+                continue
+            # The faces the point sees are grown from the farthest one, so they always make a single cap
+            edges = get_hull_edges(faces)
+            visible, pending = set(), [int(distances.argmax())]
+            while pending:
+                face = pending.pop()
+                if face in visible:
+                    continue
+                visible.add(face)
+                i, j, k = faces[face]
+                for a, b in ((i, j), (j, k), (k, i)):
+                    neighbor = edges.get((b, a))
+                    if neighbor is not None and neighbor not in visible and distances[neighbor] > epsilon:
+                        pending.append(neighbor)
+            horizon = [(a, b) for (a, b), face in edges.items() if face in visible and edges.get((b, a)) not in visible]
+            faces = [face for index, face in enumerate(faces) if index not in visible]
+            faces += [(a, b, int(point)) for a, b in horizon]
+            normals, offsets = get_planes(faces)
+        remaining = remaining[32:]
+
+    edges = get_hull_edges(faces)
+    if len(edges) != 3 * len(faces) or any((b, a) not in edges for a, b in edges):
+        return None
+    used = sorted({index for face in faces for index in face})
+    remap = {index: new_index for new_index, index in enumerate(used)}
+    return points[used], [tuple(remap[index] for index in face) for face in faces]
+
+
+def fit_capsule(points: np.ndarray) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    The capsule around the points along their longest axis, as the centers of its two ends and its radius.
+    """
+    axis = get_principal_axes(points)[0]
+    center = points.mean(axis=0)
+    heights = (points - center) @ axis
+    distances = np.linalg.norm(points - center - np.outer(heights, axis), axis=1)
+    radius = float(distances.max())
+    # Each end goes as far in as the points around it allow
+    reach = np.sqrt(np.maximum(radius**2 - distances**2, 0))
+    start, end = (heights + reach).min(), (heights - reach).max()
+    if end - start < radius * 1e-3:
+        start = end = (start + end) / 2
+        start, end = start - radius * 1e-3, end + radius * 1e-3
+    return center + axis * start, center + axis * end, radius
+
+
+def capsule_mesh(start: np.ndarray, end: np.ndarray, radius: float) -> Mesh:
+    """
+    A capsule as two rings joined by quads and closed by fans, Panda3D fits a Tube back from their vertices.
+    """
+    axis = (end - start) / np.linalg.norm(end - start)
+    side = np.cross(axis, [0, 0, 1] if abs(axis[2]) < 0.9 else [1, 0, 0])
+    side /= np.linalg.norm(side)
+    up = np.cross(axis, side)
+    angles = np.linspace(0, 2 * np.pi, CAPSULE_SEGMENTS, endpoint=False)
+    ring = radius * (np.outer(np.cos(angles), side) + np.outer(np.sin(angles), up))
+    # The poles make the axis the longest extent of the mesh, even for a capsule shorter than it is wide
+    vertices = np.vstack([start + ring, end + ring, [start - axis * radius, end + axis * radius]])
+    count = CAPSULE_SEGMENTS
+    faces = []
+    for index in range(count):
+        following = (index + 1) % count
+        faces.append((index, following, count + following, count + index))
+        faces.append((index, following, 2 * count))
+        faces.append((count + index, count + following, 2 * count + 1))
+    return vertices, orient_faces(vertices, faces, (start + end) / 2)
+
+
+def make_mesh_tree(name: str, vertices: np.ndarray, faces: list[Sequence[int]]) -> eggparse.EggTree:
+    """
+    A vertex pool of the given positions, followed by the polygons.
+    """
+    pool_name = eggparse.EggNode.convert_string_to_egg(name)
+    rows = geometry.format_rows(vertices)
+    pool_vertices = [
+        eggparse.EggBranch("Vertex", str(index), eggparse.EggTree(eggparse.EggString(row)))
+        for index, row in enumerate(rows)
+    ]
+    polygons = []
+    for face in faces:
+        vertex_ref = eggparse.EggLeaf("VertexRef", None, f"{' '.join(map(str, face))} <Ref> {{ {pool_name} }}")
+        polygons.append(eggparse.EggBranch("Polygon", None, eggparse.EggTree(vertex_ref)))
+    return eggparse.EggTree(eggparse.EggBranch("VertexPool", name, eggparse.EggTree(*pool_vertices)), *polygons)
+
+
+def decimate_mesh(vertices: np.ndarray, faces: list[Sequence[int]], target: int) -> Mesh:
+    """
+    Decimates a mesh of positions only, down to about the target number of triangles.
+    """
+    tree = make_mesh_tree("mesh", vertices, faces)
+    triangles = sum(len(face) - 2 for face in faces)
+    if triangles > target:
+        decimate.decimate(tree, target / triangles)
+
+    faces = [geometry.get_primitive_vertices(polygon)[1] for polygon in tree.findall("Polygon")]
+    used = sorted({index for face in faces for index in face})
+    remap = {index: new_index for new_index, index in enumerate(used)}
+    return vertices[used], [[remap[index] for index in face] for face in faces]
+
+
+def get_group_mesh(group, pools: dict[str, dict[int, eggparse.EggBranch]]) -> Mesh:
+    """
+    The polygons of the group as one mesh of positions, with the vertices at the same place merged.
+    """
+    collide_polygons = decimate.get_collide_polygons(group.children)
+    vertex_ids: dict[tuple[float, ...], int] = {}
+    faces = []
+    for polygon in group.findall("Polygon"):
+        if id(polygon) in collide_polygons:
+            continue
+        _, indices, pool = geometry.get_primitive_vertices(polygon)
+        face = []
+        for index in indices:
+            vertex = pools.get(pool, {}).get(index)
+            if vertex is None or not vertex.children or not isinstance(vertex.children[0], eggparse.EggString):
+                break
+            position = tuple(float(value) for value in vertex.children[0].value.split()[:3])
+            face.append(vertex_ids.setdefault(position, len(vertex_ids)))
+        if len(face) == len(indices) and len(set(face)) >= 3:
+            faces.append(face)
+    return np.array(list(vertex_ids), dtype=float).reshape(-1, 3), faces
+
+
+def build_proxy(
+    group, pools: dict[str, dict[int, eggparse.EggBranch]], method: str, name: str, ratio: float = 0.25
+) -> tuple[str, eggparse.EggTree] | None:
+    """
+    Builds the proxy of the group geometry with the given method: obb, hull, capsule or decimate.
+    Returns the type of collision solid to tag it with, and the vertex pool and polygons of the proxy,
+    or None when the group has no geometry.
+    """
+    points, faces = get_group_mesh(group, pools)
+    if not faces:
+        return None
+    if method == "decimate":
+        triangles = sum(len(face) - 2 for face in faces)
+        return "Polyset", make_mesh_tree(name, *decimate_mesh(points, faces, max(1, int(triangles * ratio))))
+    if method == "capsule":
+        return "Tube", make_mesh_tree(name, *capsule_mesh(*fit_capsule(points)))
+    if method == "hull":
+        if hull := convex_hull(points):
+            return "Polyset", make_mesh_tree(name, *decimate_mesh(*hull, MAX_HULL_TRIANGLES))
+        logger.warning("Could not build the convex hull of %s, using a box instead", group.node_name)
+    return "Polyset", make_mesh_tree(name, *fit_box(points))
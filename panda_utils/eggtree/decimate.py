@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import copy
+import heapq
+import logging
+import math
+from collections.abc import Iterable, Iterator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.decimate")
+
+
+def get_collide_polygons(tree) -> set[int]:
+    """
+    Collision geometry is left alone, it usually is as simple as it can get already.
+    """
+    polygons = set()
+    for group in tree.findall("Group"):
+        if geometry.get_child_nodes(group, "Collide"):
+            polygons.update(id(polygon) for polygon in group.findall("Polygon"))
+    return polygons
+
+
+def replace_polygons(tree, replacements: dict[int, list[eggparse.EggNode]]) -> None:
+    children = []
+    for child in tree.children:
+        if id(child) in replacements:
+            children += replacements[id(child)]
+            continue
+        if isinstance(child, eggparse.EggBranch):
+            replace_polygons(child.children, replacements)
+        children.append(child)
+    tree.children = children
+
+
+def get_normals(triangles):
+    """
+    The unnormalized normals of an array of triangles, with the shape (count, 3 corners, 3 coordinates).
+    """
+    u = triangles[:, 1] - triangles[:, 0]
+    v = triangles[:, 2] - triangles[:, 0]
+    return np.column_stack(
+        [
+            u[:, 1] * v[:, 2] - u[:, 2] * v[:, 1],
+            u[:, 2] * v[:, 0] - u[:, 0] * v[:, 2],
+            u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0],
+        ]
+    )
+
+
+class Decimator:
+    """
+    Collapses the edges of the triangulated polygons, cheapest first, into one of their endpoints.
+    The vertices themselves are never changed, so the UVs, colors, normals and joint memberships are kept as they are.
+    Vertices on borders, on seams (where the UVs, normals, colors or joint memberships change),
+    and between polygons with different attributes are never moved.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.pools = geometry.get_vertex_pools(tree)
+        self.vertex_keys: list[tuple[str, int]] = []
+        vertex_ids = {}
+        for pool, vertices in self.pools.items():
+            for index in vertices:
+                vertex_ids[(pool, index)] = len(self.vertex_keys)
+                self.vertex_keys.append((pool, index))
+
+        memberships: dict[tuple[str, int], list[int]] = {}
+        for joint in tree.findall("Joint"):
+            for ref in geometry.get_child_nodes(joint, "VertexRef"):
+                indices, pool = geometry.parse_vertex_ref(ref)
+                for index in indices:
+                    memberships.setdefault((pool, index), []).append(id(ref))
+
+        # Vertices with the same attributes at the same place can be used interchangeably
+        self.attributes = []
+        position_keys = {}
+        self.vertex_positions = []
+        positions = []
+        for pool, index in self.vertex_keys:
+            vertex = self.pools[pool][index]
+            children = list(vertex.children)
+            position = children[0].value if children and isinstance(children[0], eggparse.EggString) else "0 0 0"
+            values = tuple(float(value) for value in position.split()[:3])
+            if (pool, values) not in position_keys:
+                position_keys[(pool, values)] = len(positions)
+                positions.append(values + (0.0,) * (3 - len(values)))
+            self.vertex_positions.append(position_keys[(pool, values)])
+            attributes = tuple(repr(child) for child in children[1:])
+            self.attributes.append((attributes, tuple(sorted(memberships.get((pool, index), [])))))
+        self.positions = np.array(positions, dtype=float).reshape(-1, 3)
+
+        collide_polygons = get_collide_polygons(tree)
+        self.polygons = []
+        self.triangles: list[list[int]] = []
+        self.triangle_sources: list[int] = []
+        self.triangle_materials: list[str] = []
+        for polygon in tree.findall("Polygon"):
+            ref, indices, pool = geometry.get_primitive_vertices(polygon)
+            if len(indices) < 3 or pool not in self.pools or id(polygon) in collide_polygons:
+                continue
+            if any(index not in self.pools[pool] for index in indices):
+                continue
+            ids = [vertex_ids[(pool, index)] for index in indices]
+            material = "".join(repr(child) for child in polygon.children if child is not ref)
+            for offset in range(1, len(ids) - 1):
+                self.triangles.append([ids[0], ids[offset], ids[offset + 1]])
+                self.triangle_sources.append(len(self.polygons))
+                self.triangle_materials.append(material)
+            self.polygons.append((polygon, ref, pool))
+
+        self.alive = [True] * len(self.triangles)
+        self.changed = [False] * len(self.triangles)
+        self.position_triangles: list[set[int]] = [set() for _ in positions]
+        for triangle, vertices in enumerate(self.triangles):
+            for vertex in vertices:
+                self.position_triangles[self.vertex_positions[vertex]].add(triangle)
+        self.position_alive = [True] * len(positions)
+        self.versions = [0] * len(positions)
+        self.locked = self.find_locked()
+        self.quadrics = self.compute_quadrics()
+
+    def get_triangle_positions(self, triangle: int) -> list[int]:
+        return [self.vertex_positions[vertex] for vertex in self.triangles[triangle]]
+
+    def find_locked(self) -> list[bool]:
+        edge_counts: dict[tuple[int, int], int] = {}
+        for triangle in range(len(self.triangles)):
+            a, b, c = self.get_triangle_positions(triangle)
+            for edge in ((a, b), (b, c), (c, a)):
+                edge = (min(edge), max(edge))
+                edge_counts[edge] = edge_counts.get(edge, 0) + 1
+
+        locked = [False] * len(self.positions)
+        # Borders and non-manifold edges
+        for (a, b), count in edge_counts.items():
+            if count != 2:
+                locked[a] = locked[b] = True
+
+        for position, triangles in enumerate(self.position_triangles):
+            if locked[position] or not triangles:
+                continue
+            vertices = {vertex for triangle in triangles for vertex in self.triangles[triangle]}
+            attributes = {self.attributes[vertex] for vertex in vertices if self.vertex_positions[vertex] == position}
+            materials = {self.triangle_materials[triangle] for triangle in triangles}
+            locked[position] = len(attributes) > 1 or len(materials) > 1
+        return locked
+
+    def compute_quadrics(self):
+        quadrics = np.zeros((len(self.positions), 4, 4))
+        if not self.triangles:
+            return quadrics
+        triangles = np.array([self.get_triangle_positions(triangle) for triangle in range(len(self.triangles))])
+        p0, p1, p2 = (self.positions[triangles[:, corner]] for corner in range(3))
+        normals = get_normals(np.stack([p0, p1, p2], axis=1))
+        # The length of the cross product is twice the area, the planes are weighted by the area
+        areas = np.linalg.norm(normals, axis=1)
+        normals = np.divide(normals, areas[:, None], out=np.zeros_like(normals), where=areas[:, None] > 0)
+        planes = np.column_stack([normals, -np.sum(normals * p0, axis=1)])
+        plane_quadrics = planes[:, :, None] * planes[:, None, :] * (areas / 2)[:, None, None]
+        for corner in range(3):
+            np.add.at(quadrics, triangles[:, corner], plane_quadrics)
+        return quadrics
+
+    def get_neighbors(self, position: int) -> set[int]:
+        neighbors = set()
+        for triangle in self.position_triangles[position]:
+            neighbors.update(self.get_triangle_positions(triangle))
+        neighbors.discard(position)
+        return neighbors
+
+    def get_entries(self, edges: list[tuple[int, int]]) -> list:
+        """
+        The heap entries of the collapses, the cost is the error of the source and target planes at the target.
+        """
+        edges = [(source, target) for source, target in edges if not self.locked[source]]
+        if not edges:
+            return []
+        sources, targets = np.array(edges).T
+        points = np.column_stack([self.positions[targets], np.ones(len(edges))])
+        quadrics = self.quadrics[sources] + self.quadrics[targets]
+        costs = np.einsum("ni,nij,nj->n", points, quadrics, points)
+        versions = self.versions
+        return [
+            (cost, source, target, versions[source], versions[target])
+            for cost, (source, target) in zip(costs.tolist(), edges)
+        ]
+
+    def get_replacement(self, source: int, target: int) -> int | None:
+        """
+        The vertex at the target that takes the place of the source. The source is not a seam, so every triangle
+        across the collapsed edge uses the same one.
+        """
+        for triangle in self.position_triangles[source]:
+            for vertex in self.triangles[triangle]:
+                if self.vertex_positions[vertex] == target:
+                    return vertex
+        return None
+
+    def can_collapse(self, source: int, target: int) -> bool:
+        triangles = self.position_triangles[source]
+        shared = [triangle for triangle in triangles if target in self.get_triangle_positions(triangle)]
+        replacement = self.get_replacement(source, target)
+        if not shared or replacement is None:
+            return False
+
+        # Vertices only blend into vertices with the same joint memberships, so the skinning does not change
+        source_vertex = next(vertex for vertex in self.triangles[shared[0]] if self.vertex_positions[vertex] == source)
+        if self.attributes[source_vertex][1] != self.attributes[replacement][1]:
+            return False
+
+        # The link condition: the only common neighbors are the ones across the collapsed edge
+        opposite = {position for triangle in shared for position in self.get_triangle_positions(triangle)}
+        if (self.get_neighbors(source) & self.get_neighbors(target)) - opposite:
+            return False
+
+        # The triangles that stay must not flip over
+        corners = [self.get_triangle_positions(triangle) for triangle in triangles if triangle not in shared]
+        if not corners:
+            return True
+        old = self.positions[np.array(corners)]
+        new = old.copy()
+        new[np.array(corners) == source] = self.positions[target]
+        old_normals, new_normals = get_normals(old), get_normals(new)
+        flipped = (np.sum(old_normals * new_normals, axis=1) <= 0) & (np.sum(old_normals * old_normals, axis=1) > 0)
+        return not flipped.any()
+
+    def collapse(self, source: int, target: int) -> int:
+        """
+        Moves every triangle of the source onto the target, returns the number of triangles that were removed.
+        """
+        replacement = self.get_replacement(source, target)
+        removed = 0
+        for triangle in list(self.position_triangles[source]):
+            corners = self.get_triangle_positions(triangle)
+            if target in corners:
+                self.alive[triangle] = False
+                for position in corners:
+                    self.position_triangles[position].discard(triangle)
+                removed += 1
+                continue
+            self.triangles[triangle][corners.index(source)] = replacement
+            self.changed[triangle] = True
+            self.position_triangles[target].add(triangle)
+
+        self.position_triangles[source] = set()
+        self.position_alive[source] = False
+        self.quadrics[target] += self.quadrics[source]
+        self.versions[target] += 1
+        return removed
+
+    def run(self, target_count: int) -> int:
+        edges = [
+            (position, neighbor) for position in range(len(self.positions)) for neighbor in self.get_neighbors(position)
+        ]
+        heap = self.get_entries(edges)
+        heapq.heapify(heap)
+
+        count = len(self.triangles)
+        while heap and count > target_count:
+            _, source, target, source_version, target_version = heapq.heappop(heap)
+            if not (self.position_alive[source] and self.position_alive[target]):
+                continue
+            if source_version != self.versions[source] or target_version != self.versions[target]:
+                continue
+            if not self.can_collapse(source, target):
+                continue
+
+            count -= self.collapse(source, target)
+            neighbors = self.get_neighbors(target)
+            edges = [(target, neighbor) for neighbor in neighbors] + [(neighbor, target) for neighbor in neighbors]
+            for entry in self.get_entries(edges):
+                heapq.heappush(heap, entry)
+        return count
+
+    def write(self) -> None:
+        """
+        Replaces the polygons that changed with their remaining triangles.
+        """
+        triangles_by_polygon: dict[int, list[int]] = {}
+        for triangle, source in enumerate(self.triangle_sources):
+            triangles_by_polygon.setdefault(source, []).append(triangle)
+
+        replacements = {}
+        for source, triangles in triangles_by_polygon.items():
+            if all(self.alive[triangle] and not self.changed[triangle] for triangle in triangles):
+                continue
+            polygon, ref, pool = self.polygons[source]
+            others = [child for child in polygon.children if child is not ref]
+            nodes = []
+            for triangle in triangles:
+                if not self.alive[triangle]:
+                    continue
+                indices = " ".join(str(self.vertex_keys[vertex][1]) for vertex in self.triangles[triangle])
+                pool_name = eggparse.EggNode.convert_string_to_egg(pool)
+                vertex_ref = eggparse.EggLeaf("VertexRef", None, f"{indices} <Ref> {{ {pool_name} }}")
+                children = eggparse.EggTree(*copy.deepcopy(others), vertex_ref)
+                nodes.append(eggparse.EggBranch(polygon.node_type, polygon.node_name, children))
+            replacements[id(polygon)] = nodes
+        if replacements:
+            replace_polygons(self.tree, replacements)
+
+
+def decimate(tree, ratio: float) -> tuple[int, int]:
+    """
+    Reduces the number of triangles of the polygons to the given ratio, as far as the locked vertices allow.
+    Returns the number of triangles before and after.
+    """
+    decimator = Decimator(tree)
+    before = len(decimator.triangles)
+    if ratio >= 1 or not before:
+        return before, before
+
+    after = decimator.run(max(1, math.ceil(before * ratio)))
+    decimator.write()
+    return before, after
+
+
+def decimate_levels(tree, ratios: Iterable[float]) -> Iterator[tuple[int, int]]:
+    """
+    Decimates the tree to every ratio of its original triangles in turn, each level starting from the previous one.
+    Yields the number of original and remaining triangles once each level is done, while the tree holds that level.
+    """
+    original = current = None
+    for ratio in ratios:
+        before, after = decimate(tree, ratio * original / current if original else ratio)
+        original, current = original or before, after
+        yield original, current
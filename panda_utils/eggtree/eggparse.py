@@ -151,15 +151,32 @@ preline_regex = re.compile(r"<([A-Za-z0-9_$]+)> +([-a-z0-9A-Z_.<>\" ]+ )?\{([^\n
 recursive_nodes = ["VertexRef", "Distance"]
 
 
+def split_line_nodes(line: str) -> list[str]:
+    """
+    Splits a line into its top-level nodes, such as "<UV> { 0 0 } <Normal> { 0 0 1 }".
+    """
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(line):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                parts.append(line[start : index + 1].strip())
+                start = index + 1
+    return parts
+
+
 def subtree_tokenize(lines: List[str]):
     last_line = lines[-1].strip()
     if len(lines) == 1:
         if last_line.count("}") > 1 and not any(last_line.startswith(f"<{x}>") for x in recursive_nodes):
-            parts = [x + "}" for x in last_line.split("}")[:-1]]
-            nodes = []
-            for part in parts:
-                nodes += subtree_tokenize([part])
-            return nodes
+            parts = split_line_nodes(last_line)
+            if len(parts) > 1:
+                nodes = []
+                for part in parts:
+                    nodes += subtree_tokenize([part])
+                return nodes
 
         match = single_line_leaf_regex.match(last_line)
         if not match:
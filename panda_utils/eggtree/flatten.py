@@ -0,0 +1,226 @@
+import fnmatch
+import logging
+from collections.abc import Iterable
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.flatten")
+# Panda3D switches to 32-bit indices above this many vertices
+MAX_POOL_SIZE = 65535
+# The group entries that make a node of their own, or that code and collisions rely on
+PROTECTED_ENTRIES = {
+    "Collide",
+    "ObjectType",
+    "Transform",
+    "DCS",
+    "Model",
+    "Dart",
+    "Billboard",
+    "SwitchCondition",
+    "Tag",
+    "Instance",
+    "Joint",
+}
+PROTECTED_SCALARS = {"scroll_u", "scroll_v", "collide-mask", "from-collide-mask", "into-collide-mask", "visibility"}
+# The groups with these are kept as they are, their contents included
+SEALED_ENTRIES = {"Collide", "ObjectType"}
+SEALED_SCALARS = {"decal"}
+# Blended geometry is sorted back to front by node, merging it would break the sorting
+SORTED_ALPHA_MODES = {"on", "blend", "blend_no_occlude", "premultiplied"}
+# The entries a group may have besides its state scalars, the shared ones can go anywhere in the tree
+MOVABLE_ENTRIES = {"VertexPool", "Texture", "Material", "Comment", "CoordinateSystem"}
+
+
+def is_blended(node, textures: dict[str, eggparse.EggBranch]) -> bool:
+    nodes = [node, *(textures[name] for name in geometry.get_trefs(node) if name in textures)]
+    return any((geometry.get_scalar(item, "alpha") or "").lower() in SORTED_ALPHA_MODES for item in nodes)
+
+
+def has_primitives(node) -> bool:
+    return any(node.findall(primitive_type) for primitive_type in geometry.PRIMITIVE_TYPES)
+
+
+def get_node_type(node) -> str:
+    return getattr(node, "node_type", None)
+
+
+class GroupFlattener:
+    """
+    Moves the primitives of the groups that may be merged into one group per render state, for every parent that
+    has to stay. A group has to stay when it has a transform, collisions, flags, tags or a protected name,
+    when its geometry is blended, when it has no geometry at all (it costs nothing and may be a locator),
+    and when one of the groups below it has to stay, so their paths do not change.
+    """
+
+    def __init__(self, tree, protected_names: Iterable[str] = ()):
+        self.protected_names = list(protected_names)
+        self.textures = {texture.node_name: texture for texture in tree.findall("Texture")}
+        self.protected: dict[int, bool] = {}
+        self.merged = 0
+
+    def is_protected(self, group) -> bool:
+        if id(group) not in self.protected:
+            self.protected[id(group)] = self.check_protected(group)
+        return self.protected[id(group)]
+
+    def check_protected(self, group) -> bool:
+        if any(fnmatch.fnmatch(group.node_name, pattern) for pattern in self.protected_names):
+            return True
+        if not has_primitives(group) or is_blended(group, self.textures):
+            return True
+        for child in group.children:
+            node_type = get_node_type(child)
+            if isinstance(child, eggparse.EggString):
+                continue
+            if node_type in PROTECTED_ENTRIES:
+                return True
+            if node_type == "Scalar" and child.node_name in PROTECTED_SCALARS | SEALED_SCALARS:
+                return True
+            if node_type in geometry.PRIMITIVE_TYPES and is_blended(child, self.textures):
+                return True
+            if node_type == "Group" and self.is_protected(child):
+                return True
+            if node_type not in MOVABLE_ENTRIES | {"Group", "Scalar", *geometry.PRIMITIVE_TYPES}:
+                return True
+        return False
+
+    def is_sealed(self, group) -> bool:
+        return any(
+            get_node_type(child) in SEALED_ENTRIES
+            or (get_node_type(child) == "Scalar" and child.node_name in SEALED_SCALARS)
+            for child in group.children
+        )
+
+    def collect(self, group, name: str, state: dict[str, eggparse.EggNode], buckets, moved: list) -> None:
+        """
+        Sorts the contents of a group that is merged away into the primitive buckets of its state,
+        and the shared entries that go to the parent.
+        """
+        self.merged += 1
+        state = {**state, **{child.node_name: child for child in geometry.get_child_nodes(group, "Scalar")}}
+        key = tuple(sorted(repr(scalar) for scalar in state.values()))
+        for child in group.children:
+            node_type = get_node_type(child)
+            if node_type in geometry.PRIMITIVE_TYPES:
+                buckets.setdefault(key, (name, state, []))[2].append(child)
+            elif node_type == "Group":
+                self.collect(child, name, state, buckets, moved)
+            elif node_type not in (None, "Scalar"):
+                moved.append(child)
+
+    def flatten(self, parent):
+        """
+        Merges the groups below the parent (a group that stays, or the tree itself).
+        """
+        if isinstance(parent, eggparse.EggBranch) and self.is_sealed(parent):
+            return
+
+        buckets: dict[tuple[str, ...], tuple[str, dict, list]] = {}
+        kept, moved = [], []
+        for child in parent.children:
+            # Empty groups are parsed as leaves, there is nothing in them to flatten
+            if get_node_type(child) != "Group" or not isinstance(child, eggparse.EggBranch):
+                kept.append(child)
+            elif self.is_protected(child):
+                self.flatten(child)
+                kept.append(child)
+            else:
+                self.collect(child, child.node_name, {}, buckets, moved)
+
+        merged, groups = [], []
+        for key, (name, state, primitives) in buckets.items():
+            # Without a state of its own, the geometry can live in the group that stays
+            if not key and isinstance(parent, eggparse.EggBranch):
+                merged += primitives
+                continue
+            scalars = [eggparse.EggLeaf("Scalar", scalar.node_name, scalar.node_value) for scalar in state.values()]
+            groups.append(eggparse.EggBranch("Group", name, eggparse.EggTree(*scalars, *primitives)))
+            self.merged -= 1
+
+        # The shared entries go before the geometry that may refer to them
+        first = next((index for index, child in enumerate(kept) if get_node_type(child) == "Group"), len(kept))
+        nodes = kept[:first] + moved + merged + kept[first:] + groups
+        if isinstance(parent, eggparse.EggBranch):
+            parent.children = eggparse.EggTree(*nodes)
+        else:
+            parent.children = nodes
+
+
+def flatten_groups(tree, protected_names: Iterable[str] = ()) -> int:
+    """
+    Merges the static groups that share their render state. Returns the number of groups that were merged away.
+    Animated models are left alone.
+    """
+    if tree.findall("Dart") or tree.findall("Joint"):
+        return 0
+    flattener = GroupFlattener(tree, protected_names)
+    flattener.flatten(tree)
+    return flattener.merged
+
+
+def get_primitive_parents(node, parents: dict[int, list]) -> None:
+    for child in node.children:
+        if get_node_type(child) in geometry.PRIMITIVE_TYPES:
+            parents.setdefault(id(node), [node, []])[1].append(child)
+        elif isinstance(child, eggparse.EggBranch):
+            get_primitive_parents(child, parents)
+
+
+def get_vertex_layout(vertex) -> tuple[tuple[str, str], ...]:
+    return tuple(
+        (child.node_type, child.node_name or "")
+        for child in vertex.children
+        if isinstance(child, (eggparse.EggLeaf, eggparse.EggBranch))
+    )
+
+
+def combine_pools(tree) -> int:
+    """
+    Combines the vertex pools whose vertices have the same layout and that are only used by the primitives of one
+    group, since Panda3D makes a Geom for every vertex pool of a group. Returns the number of pools that were removed.
+    """
+    if tree.findall("Joint"):
+        return 0
+    parents: dict[int, list] = {}
+    get_primitive_parents(tree, parents)
+    pool_nodes = {pool.node_name: pool for pool in tree.findall("VertexPool")}
+    pool_vertices = geometry.get_vertex_pools(tree)
+    pool_users: dict[str, set] = {}
+    for parent_id, (_, primitives) in parents.items():
+        for primitive in primitives:
+            _, _, pool = geometry.get_primitive_vertices(primitive)
+            pool_users.setdefault(pool, set()).add(parent_id)
+
+    pool_layouts = {}
+    for name, vertices in pool_vertices.items():
+        layouts = {get_vertex_layout(vertex) for vertex in vertices.values()}
+        pool_layouts[name] = layouts.pop() if len(layouts) == 1 else None
+
+    removals = set()
+    for parent_id, (_, primitives) in parents.items():
+        layouts: dict[tuple, list[str]] = {}
+        for pool in dict.fromkeys(geometry.get_primitive_vertices(primitive)[2] for primitive in primitives):
+            if pool in pool_nodes and pool_layouts[pool] is not None and pool_users[pool] == {parent_id}:
+                layouts.setdefault(pool_layouts[pool], []).append(pool)
+
+        for pools in layouts.values():
+            # The pools are added to the first one as long as it stays under the size limit
+            target, remaps = pools[0], {}
+            size = max(pool_vertices[target], default=-1) + 1
+            for pool in pools[1:]:
+                count = max(pool_vertices[pool], default=-1) + 1
+                if size + count > MAX_POOL_SIZE:
+                    continue
+                remaps[pool] = size
+                for index, vertex in sorted(pool_vertices[pool].items()):
+                    vertex.node_name = str(index + size)
+                    pool_nodes[target].add_child(vertex)
+                removals.add(pool_nodes[pool])
+                size += count
+
+            for primitive in primitives:
+                ref, indices, pool = geometry.get_primitive_vertices(primitive)
+                if pool in remaps:
+                    geometry.set_vertex_ref(ref, [index + remaps[pool] for index in indices], target)
+    tree.remove_nodes(removals)
+    return len(removals)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import copy
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse
+
+PRIMITIVE_TYPES = ("Polygon", "TriangleFan", "TriangleStrip", "Patch", "Line", "PointLight")
+ref_regex = re.compile(r"<Ref>\s*\{\s*([^}]*?)\s*}")
+
+
+def find_primitives(tree) -> list[eggparse.EggBranch]:
+    primitives = []
+    for primitive_type in PRIMITIVE_TYPES:
+        primitives += tree.findall(primitive_type)
+    return primitives
+
+
+def get_vertex_pools(tree) -> dict[str, dict[int, eggparse.EggBranch]]:
+    """
+    Returns every vertex pool of the tree, mapping the vertex indices to the vertex nodes.
+    """
+    pools = {}
+    for pool in tree.findall("VertexPool"):
+        vertices = pools.setdefault(pool.node_name, {})
+        for vertex in pool.children:
+            if isinstance(vertex, eggparse.EggBranch) and vertex.node_type == "Vertex":
+                vertices[int(vertex.node_name)] = vertex
+    return pools
+
+
+def parse_vertex_ref(node) -> tuple[list[int], str | None]:
+    """
+    Returns the vertex indices and the name of the vertex pool of a <VertexRef>, in its single or multi-line form.
+    """
+    if isinstance(node, eggparse.EggLeaf):
+        indices, _, rest = node.node_value.partition("<")
+        pool = ref_regex.search("<" + rest)
+        return [int(index) for index in indices.split()], eggparse.sanitize_string(pool.group(1)) if pool else None
+
+    indices, pool = [], None
+    for child in node.children:
+        if isinstance(child, eggparse.EggString):
+            indices += [int(index) for index in child.value.split()]
+        elif isinstance(child, eggparse.EggLeaf) and child.node_type == "Ref":
+            pool = eggparse.sanitize_string(child.node_value)
+    return indices, pool
+
+
+def set_vertex_ref(node, indices: list[int], pool: str | None = None) -> None:
+    """
+    Replaces the vertex indices of a <VertexRef>, and the vertex pool it points to when one is given.
+    """
+    text = " ".join(str(index) for index in indices)
+    if isinstance(node, eggparse.EggLeaf):
+        _, _, rest = node.node_value.partition("<")
+        if pool is not None:
+            rest = f"Ref> {{ {eggparse.EggNode.convert_string_to_egg(pool)} }}"
+        node.node_value = f"{text} <{rest}"
+        return
+
+    others = [child for child in node.children if not isinstance(child, eggparse.EggString)]
+    if pool is not None:
+        for child in others:
+            if isinstance(child, eggparse.EggLeaf) and child.node_type == "Ref":
+                child.node_value = eggparse.EggNode.convert_string_to_egg(pool)
+    node.children = eggparse.EggTree(eggparse.EggString(text), *others)
+
+
+def get_primitive_vertices(primitive) -> tuple[eggparse.EggNode | None, list[int], str | None]:
+    for child in primitive.children:
+        if getattr(child, "node_type", None) == "VertexRef":
+            return child, *parse_vertex_ref(child)
+    return None, [], None
+
+
+def get_child_nodes(node, node_type: str, node_name: str | None = None) -> list[eggparse.EggNode]:
+    if not isinstance(node, eggparse.EggBranch):
+        return []
+    return [
+        child
+        for child in node.children
+        if getattr(child, "node_type", None) == node_type and (node_name is None or child.node_name == node_name)
+    ]
+
+
+def get_trefs(primitive) -> list[str]:
+    return [eggparse.sanitize_string(tref.node_value) for tref in get_child_nodes(primitive, "TRef")]
+
+
+def get_scalar(node, name: str) -> str | None:
+    scalars = get_child_nodes(node, "Scalar", name)
+    return eggparse.sanitize_string(scalars[0].node_value) if scalars else None
+
+
+def set_scalar(node, name: str, value: str) -> None:
+    scalars = get_child_nodes(node, "Scalar", name)
+    if scalars:
+        scalars[0].node_value = value
+    else:
+        node.add_child(eggparse.EggLeaf("Scalar", name, value))
+
+
+def get_uv_node(vertex, name: str | None = None) -> eggparse.EggNode | None:
+    nodes = get_child_nodes(vertex, "UV", name or "")
+    return nodes[0] if nodes else None
+
+
+def get_uv(vertex, name: str | None = None) -> list[float] | None:
+    node = get_uv_node(vertex, name)
+    if node is None:
+        return None
+    if isinstance(node, eggparse.EggLeaf):
+        return [float(value) for value in node.node_value.split()]
+    return [float(value) for value in node.get_child(0).value.split()]
+
+
+def set_uv(vertex, values: list[float], name: str | None = None) -> None:
+    node = get_uv_node(vertex, name)
+    text = " ".join(format_float(value) for value in values)
+    if isinstance(node, eggparse.EggLeaf):
+        node.node_value = text
+    else:
+        node.get_child(0).value = text
+
+
+def format_float(value: float) -> str:
+    text = f"{value:.8g}"
+    return "0" if text == "-0" else text
+
+
+def format_rows(values) -> list[str]:
+    """
+    Same as format_float, for every row of a 2D array at once.
+    """
+    # Adding zero turns -0 into 0
+    text = np.char.mod("%.8g", np.asarray(values, float) + 0.0)
+    return [" ".join(row) for row in text]
+
+
+class VertexDuplicator:
+    """
+    Copies vertices of a pool, keeping the joint memberships of the copies in sync with the original vertices.
+    """
+
+    def __init__(self, tree):
+        self.pools = {pool.node_name: pool for pool in tree.findall("VertexPool")}
+        self.vertices = get_vertex_pools(tree)
+        self.next_index = {name: max(vertices, default=-1) + 1 for name, vertices in self.vertices.items()}
+        self.memberships = {}
+        self.added_memberships = {}
+        for joint in tree.findall("Joint"):
+            for ref in get_child_nodes(joint, "VertexRef"):
+                indices, pool = parse_vertex_ref(ref)
+                for index in indices:
+                    self.memberships.setdefault((pool, index), []).append(ref)
+
+    def duplicate(self, pool: str, index: int) -> int:
+        new_index = self.next_index[pool]
+        self.next_index[pool] += 1
+        vertex = copy.deepcopy(self.vertices[pool][index])
+        vertex.node_name = str(new_index)
+        self.pools[pool].add_child(vertex)
+        self.vertices[pool][new_index] = vertex
+        for ref in self.memberships.get((pool, index), []):
+            self.added_memberships.setdefault(id(ref), (ref, []))[1].append(new_index)
+        return new_index
+
+    def finish(self) -> None:
+        """
+        Adds the copies to the joints of their original vertices.
+        """
+        for ref, new_indices in self.added_memberships.values():
+            indices, _ = parse_vertex_ref(ref)
+            set_vertex_ref(ref, indices + new_indices)
+        self.added_memberships = {}
@@ -0,0 +1,518 @@
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import pathlib
+import struct
+import urllib.parse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.gltf")
+GLB_MAGIC = b"glTF"
+JSON_CHUNK = 0x4E4F534A
+BIN_CHUNK = 0x004E4942
+COMPONENT_TYPES = {5120: "i1", 5121: "u1", 5122: "<i2", 5123: "<u2", 5125: "<u4", 5126: "<f4"}
+TYPE_SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT2": 4, "MAT3": 9, "MAT4": 16}
+WRAP_MODES = {33071: "clamp", 33648: "mirror", 10497: "repeat"}
+FILTER_MODES = {
+    9728: "nearest",
+    9729: "linear",
+    9984: "nearest_mipmap_nearest",
+    9985: "linear_mipmap_nearest",
+    9986: "nearest_mipmap_linear",
+    9987: "linear_mipmap_linear",
+}
+ALPHA_MODES = {"MASK": "binary", "BLEND": "blend"}
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg"}
+TRIANGLES, TRIANGLE_STRIP, TRIANGLE_FAN = 4, 5, 6
+# The buffers store 32-bit floats, anything below this is conversion noise
+DECIMALS = 6
+
+
+def y_up_to_z_up(points: np.ndarray) -> np.ndarray:
+    """
+    glTF is Y-up and Panda3D is Z-up: (x, y, z) becomes (x, -z, y).
+    """
+    return points[:, [0, 2, 1]] * np.array([1, -1, 1], points.dtype)
+
+
+def format_rows(values: np.ndarray) -> list[str]:
+    return geometry.format_rows(np.round(values, DECIMALS))
+
+
+# The same conversion for column-vector matrices, applied as C @ M @ C.T
+Y_UP_TO_Z_UP_MATRIX = ((1, 0, 0, 0), (0, 0, -1, 0), (0, 1, 0, 0), (0, 0, 0, 1))
+
+
+class GltfDocument:
+    """
+    The JSON part of a glTF file together with its binary buffers.
+    """
+
+    def __init__(self, data: dict, buffers: list[bytes], folder: pathlib.Path):
+        self.data = data
+        self.buffers = buffers
+        self.folder = folder
+
+    @classmethod
+    def load(cls, path) -> GltfDocument:
+        path = pathlib.Path(path)
+        with open(path, "rb") as f:
+            content = f.read()
+
+        embedded = None
+        if content[:4] == GLB_MAGIC:
+            _, version, length = struct.unpack_from("<4sII", content)
+            if version != 2:
+                raise ValueError(f"{path}: Unsupported glTF version {version}")
+            offset, data = 12, None
+            while offset < length:
+                chunk_length, chunk_type = struct.unpack_from("<II", content, offset)
+                chunk = content[offset + 8 : offset + 8 + chunk_length]
+                if chunk_type == JSON_CHUNK:
+                    data = json.loads(chunk)
+                elif chunk_type == BIN_CHUNK and embedded is None:
+                    embedded = chunk
+                offset += 8 + chunk_length
+        else:
+            data = json.loads(content)
+
+        buffers = []
+        for buffer in data.get("buffers", []):
+            uri = buffer.get("uri")
+            if uri is None:
+                buffers.append(embedded or b"")
+            else:
+                buffers.append(read_uri(path.parent, uri))
+        return cls(data, buffers, path.parent)
+
+    def get(self, kind: str, index: int) -> dict:
+        return self.data[kind][index]
+
+    def read_buffer_view(self, index: int) -> bytes:
+        view = self.get("bufferViews", index)
+        start = view.get("byteOffset", 0)
+        return self.buffers[view["buffer"]][start : start + view["byteLength"]]
+
+    def read_accessor(self, index: int) -> np.ndarray:
+        accessor = self.get("accessors", index)
+        if "sparse" in accessor:
+            raise ValueError("Sparse accessors are not supported")
+
+        dtype = np.dtype(COMPONENT_TYPES[accessor["componentType"]])
+        size = TYPE_SIZES[accessor["type"]]
+        count = accessor["count"]
+        if "bufferView" not in accessor:
+            values = np.zeros((count, size), dtype)
+        else:
+            view = self.get("bufferViews", accessor["bufferView"])
+            buffer = self.buffers[view["buffer"]]
+            offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+            stride = view.get("byteStride") or dtype.itemsize * size
+            # Interleaved attributes are read through strides, without copying the rest of the buffer
+            values = np.ndarray((count, size), dtype, buffer, offset, (stride, dtype.itemsize))
+
+        if accessor.get("normalized") and dtype.kind in "iu":
+            return np.maximum(values / np.iinfo(dtype).max, -1.0)
+        return values
+
+
+def read_uri(folder: pathlib.Path, uri: str) -> bytes:
+    if uri.startswith("data:"):
+        return base64.b64decode(uri.split(",", 1)[1])
+    with open(folder / urllib.parse.unquote(uri), "rb") as f:
+        return f.read()
+
+
+def get_node_matrix(node: dict) -> np.ndarray:
+    """
+    The local transform of a node, as a column-vector matrix in glTF coordinates.
+    """
+    if "matrix" in node:
+        return np.array(node["matrix"], float).reshape(4, 4).T
+
+    x, y, z, w = node.get("rotation", (0, 0, 0, 1))
+    rotation = np.array(
+        [
+            [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+        ]
+    )
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * np.array(node.get("scale", (1, 1, 1)), float)
+    matrix[:3, 3] = node.get("translation", (0, 0, 0))
+    return matrix
+
+
+def make_transform(matrix: np.ndarray) -> eggparse.EggBranch | None:
+    """
+    Converts a glTF column-vector matrix into a Z-up <Transform>, or None for the identity.
+    """
+    conversion = np.array(Y_UP_TO_Z_UP_MATRIX, float)
+    matrix = conversion @ matrix @ conversion.T
+    if np.allclose(matrix, np.eye(4), atol=1e-7):
+        return None
+    # Egg matrices are row-vector matrices, so they are stored transposed
+    rows = eggparse.EggTree(*(eggparse.EggString(text) for text in format_rows(matrix.T)))
+    return eggparse.EggBranch("Transform", None, eggparse.EggTree(eggparse.EggBranch("Matrix4", None, rows)))
+
+
+def make_scalars(values: dict[str, object]) -> list[eggparse.EggLeaf]:
+    scalars = []
+    for name, value in values.items():
+        if isinstance(value, float):
+            value = geometry.format_float(value)
+        scalars.append(eggparse.EggLeaf("Scalar", name, str(value)))
+    return scalars
+
+
+def triangulate(indices: np.ndarray, mode: int) -> np.ndarray | None:
+    if mode == TRIANGLES:
+        return indices[: len(indices) // 3 * 3].reshape(-1, 3)
+    if mode == TRIANGLE_STRIP:
+        triangles = np.stack([indices[:-2], indices[1:-1], indices[2:]], axis=1)
+        # Every other triangle of a strip has the opposite winding
+        triangles[1::2] = triangles[1::2, [1, 0, 2]]
+        return triangles
+    if mode == TRIANGLE_FAN:
+        return np.stack([np.full(len(indices) - 2, indices[0]), indices[1:-1], indices[2:]], axis=1)
+    return None
+
+
+class GltfEggBuilder:
+    """
+    Builds the egg tree of a glTF scene. Vertices are stored in the global coordinate space, like egg expects,
+    and every node keeps its own transform, so the loaded model has the same hierarchy as the glTF scene.
+    """
+
+    def __init__(self, document: GltfDocument, srgb: bool = False, legacy_materials: bool = False):
+        self.document = document
+        self.srgb = srgb
+        self.legacy_materials = legacy_materials
+        self.nodes = document.data.get("nodes", [])
+        self.parents = {child: index for index, node in enumerate(self.nodes) for child in node.get("children", [])}
+        self.world_matrices = {}
+        self.joint_nodes = {joint for skin in document.data.get("skins", []) for joint in skin["joints"]}
+        self.joint_memberships: dict[int, dict[float, list[int]]] = {}
+        self.textures: dict[tuple, str] = {}
+        self.texture_nodes = []
+        self.materials: dict[int, str] = {}
+        self.group_nodes: dict[int, eggparse.EggBranch] = {}
+        self.material_nodes = []
+        self.pool_name = "vpool"
+        self.vertices = eggparse.EggTree()
+
+    @staticmethod
+    def unique_name(name: str, fallback: str, used: set) -> str:
+        name = (name or fallback).replace('"', "")
+        result, index = name, 1
+        while result in used:
+            result = f"{name}.{index}"
+            index += 1
+        used.add(result)
+        return result
+
+    def get_world_matrix(self, index: int) -> np.ndarray:
+        if index not in self.world_matrices:
+            matrix = get_node_matrix(self.nodes[index])
+            if index in self.parents:
+                matrix = self.get_world_matrix(self.parents[index]) @ matrix
+            self.world_matrices[index] = matrix
+        return self.world_matrices[index]
+
+    def get_joint_ancestor(self, index: int) -> int | None:
+        while index in self.parents:
+            index = self.parents[index]
+            if index in self.joint_nodes:
+                return index
+        return None
+
+    def get_texture(self, info: dict, envtype: str | None = None, srgb_format: str | None = None) -> str:
+        key = (info["index"], envtype)
+        if key in self.textures:
+            return self.textures[key]
+
+        texture = self.document.get("textures", info["index"])
+        image_index = texture.get("source")
+        image = self.document.get("images", image_index) if image_index is not None else {}
+        if "uri" in image and not image["uri"].startswith("data:"):
+            path = urllib.parse.unquote(image["uri"])
+        else:
+            path = self.extract_image(image, image_index)
+        name = image.get("name") or pathlib.PurePosixPath(path).stem
+        name = self.unique_name(name, f"texture{info['index']}", set(self.textures.values()))
+
+        sampler = self.document.get("samplers", texture["sampler"]) if "sampler" in texture else {}
+        scalars = {}
+        if self.srgb and srgb_format:
+            scalars["format"] = srgb_format
+        scalars["wrapu"] = WRAP_MODES.get(sampler.get("wrapS", 10497), "repeat")
+        scalars["wrapv"] = WRAP_MODES.get(sampler.get("wrapT", 10497), "repeat")
+        if sampler.get("minFilter") in FILTER_MODES:
+            scalars["minfilter"] = FILTER_MODES[sampler["minFilter"]]
+        if sampler.get("magFilter") in FILTER_MODES:
+            scalars["magfilter"] = FILTER_MODES[sampler["magFilter"]]
+        if envtype:
+            scalars["envtype"] = envtype
+
+        children = [eggparse.EggString(eggparse.EggNode.convert_string_to_egg(path)), *make_scalars(scalars)]
+        self.texture_nodes.append(eggparse.EggBranch("Texture", name, eggparse.EggTree(*children)))
+        self.textures[key] = name
+        return name
+
+    def extract_image(self, image: dict, image_index) -> str:
+        """
+        Writes an image embedded into the buffers (or a data URI) next to the glTF file.
+        """
+        if "uri" in image:
+            mime, _, _ = image["uri"][5:].partition(";")
+            data = read_uri(self.document.folder, image["uri"])
+        else:
+            mime, data = image.get("mimeType"), self.document.read_buffer_view(image["bufferView"])
+        filename = f"{image.get('name') or f'image{image_index}'}{IMAGE_EXTENSIONS.get(mime, '.png')}"
+        path = self.document.folder / filename
+        if not path.exists() or path.read_bytes() != data:
+            path.write_bytes(data)
+        return filename
+
+    def get_material(self, index: int) -> str:
+        if index in self.materials:
+            return self.materials[index]
+
+        material = self.document.get("materials", index)
+        pbr = material.get("pbrMetallicRoughness", {})
+        base_color = pbr.get("baseColorFactor", (1, 1, 1, 1))
+        emission = material.get("emissiveFactor", (0, 0, 0))
+        if self.legacy_materials:
+            scalars = dict(zip(("diffr", "diffg", "diffb", "diffa"), base_color))
+        else:
+            scalars = dict(zip(("baser", "baseg", "baseb"), base_color[:3]))
+            if base_color[3] != 1:
+                scalars["basea"] = base_color[3]
+            scalars["roughness"] = pbr.get("roughnessFactor", 1)
+            scalars["metallic"] = pbr.get("metallicFactor", 1)
+        scalars.update(zip(("emitr", "emitg", "emitb"), emission))
+
+        name = self.unique_name(material.get("name"), f"material{index}", set(self.materials.values()))
+        scalars = make_scalars({key: float(value) for key, value in scalars.items()})
+        self.material_nodes.append(eggparse.EggBranch("Material", name, eggparse.EggTree(*scalars)))
+        self.materials[index] = name
+        return name
+
+    def get_primitive_attributes(self, primitive: dict) -> list[eggparse.EggNode]:
+        attributes = []
+        material = self.document.get("materials", primitive["material"]) if "material" in primitive else {}
+        pbr = material.get("pbrMetallicRoughness", {})
+        textures = [
+            (pbr.get("baseColorTexture"), None, "srgb-alpha"),
+            (material.get("normalTexture"), "normal", None),
+            (material.get("emissiveTexture"), "emission", "srgb"),
+        ]
+        for info, envtype, srgb_format in textures:
+            if info is not None:
+                attributes.append(eggparse.EggLeaf("TRef", None, self.get_texture(info, envtype, srgb_format)))
+        if "material" in primitive:
+            attributes.append(eggparse.EggLeaf("MRef", None, self.get_material(primitive["material"])))
+        if material.get("doubleSided"):
+            attributes.append(eggparse.EggLeaf("BFace", None, "1"))
+        if material.get("alphaMode") in ALPHA_MODES:
+            attributes.append(eggparse.EggLeaf("Scalar", "alpha", ALPHA_MODES[material["alphaMode"]]))
+        return attributes
+
+    def add_vertices(self, primitive: dict, node_index: int, skin: dict | None) -> int:
+        """
+        Adds the vertices of a primitive to the vertex pool, returns the index of the first one.
+        """
+        attributes = primitive["attributes"]
+        positions = self.document.read_accessor(attributes["POSITION"]).astype(float)
+        normals = self.document.read_accessor(attributes["NORMAL"]).astype(float) if "NORMAL" in attributes else None
+        joint_weights = None
+        if skin is not None and "JOINTS_0" in attributes and "WEIGHTS_0" in attributes:
+            joints = self.document.read_accessor(attributes["JOINTS_0"]).astype(int)
+            weights = self.document.read_accessor(attributes["WEIGHTS_0"]).astype(float)
+            weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+            joint_nodes = np.array(skin["joints"])
+            # The bind pose of every vertex, skinned meshes ignore the transform of their own node
+            if "inverseBindMatrices" in skin:
+                inverse_bind = self.document.read_accessor(skin["inverseBindMatrices"]).astype(float)
+                inverse_bind = inverse_bind.reshape(-1, 4, 4).transpose(0, 2, 1)
+            else:
+                inverse_bind = np.repeat(np.eye(4)[None], len(joint_nodes), axis=0)
+            joint_matrices = np.array([self.get_world_matrix(joint) for joint in joint_nodes]) @ inverse_bind
+            matrices = np.einsum("nk,nkij->nij", weights, joint_matrices[joints])
+            positions = np.einsum("nij,nj->ni", matrices[:, :3, :3], positions) + matrices[:, :3, 3]
+            if normals is not None:
+                normals = np.einsum("nij,nj->ni", matrices[:, :3, :3], normals)
+            joint_weights = (joint_nodes[joints], weights)
+        else:
+            matrix = self.get_world_matrix(node_index)
+            positions = positions @ matrix[:3, :3].T + matrix[:3, 3]
+            if normals is not None:
+                normals = normals @ np.linalg.inv(matrix[:3, :3])
+
+        first = len(self.vertices.children)
+        position_rows = format_rows(y_up_to_z_up(positions))
+        leaves = []
+        if normals is not None:
+            normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+            leaves.append(("Normal", None, format_rows(y_up_to_z_up(normals))))
+        set_index = 0
+        while f"TEXCOORD_{set_index}" in attributes:
+            uvs = self.document.read_accessor(attributes[f"TEXCOORD_{set_index}"]).astype(float)
+            # glTF has the origin of the UVs at the top left corner, egg at the bottom left
+            uvs[:, 1] = 1 - uvs[:, 1]
+            leaves.append(("UV", f"uv{set_index}" if set_index else None, format_rows(uvs)))
+            set_index += 1
+        if "COLOR_0" in attributes:
+            colors = self.document.read_accessor(attributes["COLOR_0"]).astype(float)
+            if colors.shape[1] == 3:
+                colors = np.hstack([colors, np.ones((len(colors), 1))])
+            leaves.append(("RGBA", None, format_rows(colors)))
+
+        for vertex_index, position in enumerate(position_rows):
+            children = [eggparse.EggString(position)]
+            children += [eggparse.EggLeaf(kind, name, rows[vertex_index]) for kind, name, rows in leaves]
+            self.vertices += eggparse.EggBranch("Vertex", str(first + vertex_index), eggparse.EggTree(*children))
+
+        if joint_weights is not None:
+            vertex_joints, weights = joint_weights
+            for vertex_index, joint in zip(*np.nonzero(weights > 1e-6)):
+                memberships = self.joint_memberships.setdefault(int(vertex_joints[vertex_index, joint]), {})
+                memberships.setdefault(round(float(weights[vertex_index, joint]), 6), []).append(first + vertex_index)
+        elif (joint := self.get_joint_ancestor(node_index)) is not None:
+            # Rigid geometry parented to a bone follows that bone
+            memberships = self.joint_memberships.setdefault(joint, {})
+            memberships.setdefault(1.0, []).extend(range(first, first + len(positions)))
+        return first
+
+    def make_mesh(self, node_index: int) -> list[eggparse.EggNode]:
+        node = self.nodes[node_index]
+        mesh = self.document.get("meshes", node["mesh"])
+        skin = self.document.get("skins", node["skin"]) if "skin" in node else None
+        flip = skin is None and np.linalg.det(self.get_world_matrix(node_index)[:3, :3]) < 0
+        polygons = []
+        for primitive in mesh["primitives"]:
+            mode = primitive.get("mode", TRIANGLES)
+            count = self.document.get("accessors", primitive["attributes"]["POSITION"])["count"]
+            if "indices" in primitive:
+                indices = self.document.read_accessor(primitive["indices"])[:, 0].astype(int)
+            else:
+                indices = np.arange(count)
+            triangles = triangulate(indices, mode)
+            if triangles is None:
+                logger.warning("Skipping a primitive of mesh %s with unsupported mode %d", mesh.get("name"), mode)
+                continue
+
+            first = self.add_vertices(primitive, node_index, skin)
+            if flip:
+                triangles = triangles[:, ::-1]
+            attributes = self.get_primitive_attributes(primitive)
+            for triangle in triangles + first:
+                vertex_ref = eggparse.EggLeaf(
+                    "VertexRef", None, f"{' '.join(map(str, triangle))} <Ref> {{ {self.pool_name} }}"
+                )
+                polygons.append(eggparse.EggBranch("Polygon", None, eggparse.EggTree(*attributes, vertex_ref)))
+
+        if mesh.get("name"):
+            return [eggparse.EggBranch("Group", mesh["name"], eggparse.EggTree(*polygons))]
+        return polygons
+
+    def make_joint(self, index: int) -> eggparse.EggBranch:
+        node = self.nodes[index]
+        children = []
+        transform = make_transform(get_node_matrix(node))
+        if transform is not None:
+            children.append(transform)
+        for weight, vertices in sorted(self.joint_memberships.get(index, {}).items()):
+            vertex_ref = eggparse.EggTree(
+                eggparse.EggString(" ".join(map(str, vertices))),
+                eggparse.EggLeaf("Scalar", "membership", geometry.format_float(weight)),
+                eggparse.EggLeaf("Ref", None, self.pool_name),
+            )
+            children.append(eggparse.EggBranch("VertexRef", None, vertex_ref))
+        children += [self.make_joint(child) for child in node.get("children", []) if child in self.joint_nodes]
+        return eggparse.EggBranch("Joint", node.get("name") or f"joint{index}", eggparse.EggTree(*children))
+
+    def make_node(self, index: int, dart_roots: dict[int, list[int]], transform: bool = True) -> eggparse.EggBranch:
+        node = self.nodes[index]
+        name = node.get("name") or f"node{index}"
+        children = []
+        if index in dart_roots:
+            children.append(eggparse.EggLeaf("Dart", None, "structured"))
+        if transform and (node_transform := make_transform(get_node_matrix(node))) is not None:
+            children.append(node_transform)
+        if "mesh" in node:
+            children += self.make_mesh(index)
+        for child in node.get("children", []):
+            if child not in self.joint_nodes:
+                children.append(self.make_node(child, dart_roots))
+        group = eggparse.EggBranch("Group", name, eggparse.EggTree(*children))
+        self.group_nodes[index] = group
+        return group
+
+    def make_attached_nodes(self, index: int, dart_roots) -> list[eggparse.EggBranch]:
+        """
+        The nodes parented to bones are moved next to the joints, their vertices are bound to the bones instead.
+        """
+        attached = []
+        for child in self.nodes[index].get("children", []):
+            if child in self.joint_nodes:
+                attached += self.make_attached_nodes(child, dart_roots)
+            else:
+                attached.append(self.make_node(child, dart_roots, transform=False))
+        return attached
+
+    def build(self, name: str) -> eggparse.EggTree:
+        self.pool_name = name
+        scenes = self.document.data.get("scenes")
+        scene = scenes[self.document.data.get("scene", 0)] if scenes else {}
+        roots = scene.get("nodes", [index for index in range(len(self.nodes)) if index not in self.parents])
+
+        # Like gltf2bam, the character is the parent of the root bones, or a new group around the scene
+        dart_roots: dict[int, list[int]] = {}
+        top_joints = []
+        for joint in sorted(self.joint_nodes):
+            if self.get_joint_ancestor(joint) is None:
+                if joint in self.parents:
+                    dart_roots.setdefault(self.parents[joint], []).append(joint)
+                else:
+                    top_joints.append(joint)
+
+        # The joints are made last, once the memberships of every mesh are known
+        groups = [self.make_node(index, dart_roots) for index in roots if index not in self.joint_nodes]
+        attached = {
+            dart: [node for joint in joints for node in self.make_attached_nodes(joint, dart_roots)]
+            for dart, joints in dart_roots.items()
+        }
+        top_attached = [node for joint in top_joints for node in self.make_attached_nodes(joint, dart_roots)]
+        for dart, joints in dart_roots.items():
+            if dart in self.group_nodes:
+                self.group_nodes[dart].add_child([*attached[dart], *(self.make_joint(joint) for joint in joints)])
+        if top_joints:
+            children = eggparse.EggTree(eggparse.EggLeaf("Dart", None, "structured"), *groups, *top_attached)
+            children += [self.make_joint(joint) for joint in top_joints]
+            groups = [eggparse.EggBranch("Group", name, children)]
+
+        tree = eggparse.EggTree(eggparse.EggLeaf("CoordinateSystem", None, "Z-Up"))
+        tree += self.texture_nodes
+        tree += self.material_nodes
+        tree += eggparse.EggBranch("VertexPool", self.pool_name, self.vertices)
+        tree += groups
+        return tree
+
+
+def load_gltf(path, name: str | None = None, srgb: bool = False, legacy_materials: bool = False) -> eggparse.EggTree:
+    """
+    Reads a glTF file into an egg tree. Texture paths stay relative to the folder of the file.
+    """
+    path = pathlib.Path(path)
+    document = GltfDocument.load(path)
+    return GltfEggBuilder(document, srgb, legacy_materials).build(name or path.stem)
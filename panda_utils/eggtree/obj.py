@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import logging
+import os
+import pathlib
+from collections.abc import Iterable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse
+from panda_utils.eggtree.gltf import format_rows, make_scalars, y_up_to_z_up
+
+logger = logging.getLogger("panda_utils.eggtree.obj")
+# The number of values that follow each option of a texture map statement
+MAP_OPTION_ARGUMENTS = {
+    "-blendu": 1,
+    "-blendv": 1,
+    "-bm": 1,
+    "-boost": 1,
+    "-cc": 1,
+    "-clamp": 1,
+    "-imfchan": 1,
+    "-mm": 2,
+    "-o": 3,
+    "-s": 3,
+    "-t": 3,
+    "-texres": 1,
+    "-type": 1,
+}
+
+
+def parse_map_path(arguments: list[str]) -> str:
+    """
+    Strips the options from a texture map statement, the rest is the file name (which may contain spaces).
+    """
+    index = 0
+    while index < len(arguments) and arguments[index] in MAP_OPTION_ARGUMENTS:
+        index += 1 + MAP_OPTION_ARGUMENTS[arguments[index]]
+    return " ".join(arguments[index:]).replace("\\", "/")
+
+
+class ObjMaterial:
+    def __init__(self, name: str):
+        self.name = name
+        self.diffuse = (0.8, 0.8, 0.8)
+        self.emission = None
+        self.alpha = 1.0
+        self.textures: dict[str, str] = {}
+
+
+def read_mtl(path: pathlib.Path) -> dict[str, ObjMaterial]:
+    materials, material = {}, None
+    with open(path, errors="replace") as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            keyword, *arguments = parts
+            if not arguments or keyword.startswith("#"):
+                continue
+            keyword = keyword.lower()
+            if keyword == "newmtl":
+                material = materials[" ".join(arguments)] = ObjMaterial(" ".join(arguments))
+            elif material is None:
+                continue
+            elif keyword == "kd":
+                material.diffuse = tuple(float(value) for value in arguments[:3])
+            elif keyword == "ke":
+                material.emission = tuple(float(value) for value in arguments[:3])
+            elif keyword == "d":
+                material.alpha = float(arguments[-1])
+            elif keyword == "tr":
+                material.alpha = 1 - float(arguments[-1])
+            elif keyword in ("map_kd", "map_d", "map_bump", "bump", "norm", "map_ke"):
+                material.textures[keyword] = parse_map_path(arguments)
+    return materials
+
+
+class ObjReader:
+    """
+    Streams the statements of one or more OBJ files. The faces are stored as corner indices,
+    the vertices are only made once all the files were read.
+    """
+
+    def __init__(self):
+        self.positions: list[str] = []
+        self.uvs: list[str] = []
+        self.normals: list[str] = []
+        self.position_count = self.uv_count = self.normal_count = 0
+        # For every corner: position, uv and normal indices (-1 if missing)
+        self.corners: list[tuple[int, int, int]] = []
+        # For every face: group name, material name, first corner, number of corners
+        self.faces: list[tuple[str, str | None, int, int]] = []
+        self.materials: dict[str, ObjMaterial] = {}
+        self.material_folders: dict[str, pathlib.Path] = {}
+
+    def read(self, path) -> None:
+        path = pathlib.Path(path)
+        group, material = path.stem, None
+        seen_objects = False
+        with open(path, errors="replace") as f:
+            for line in f:
+                keyword, _, rest = line.strip().partition(" ")
+                if keyword == "v":
+                    self.positions.append(rest)
+                    self.position_count += 1
+                elif keyword == "vt":
+                    self.uvs.append(rest)
+                    self.uv_count += 1
+                elif keyword == "vn":
+                    self.normals.append(rest)
+                    self.normal_count += 1
+                elif keyword == "f":
+                    self.read_face(rest.split(), group, material)
+                elif keyword == "o":
+                    group, seen_objects = rest.strip() or group, True
+                elif keyword == "g" and not seen_objects:
+                    # Groups only split the model when the file has no objects, like the Blender importer
+                    group = rest.strip() or group
+                elif keyword == "usemtl":
+                    material = rest.strip()
+                elif keyword == "mtllib":
+                    self.read_mtllib(path.parent, rest.strip())
+
+    def read_mtllib(self, folder: pathlib.Path, filename: str) -> None:
+        mtl_path = folder / filename
+        if not mtl_path.exists():
+            logger.warning("Material library %s was not found", mtl_path)
+            return
+        for name, material in read_mtl(mtl_path).items():
+            self.materials.setdefault(name, material)
+            self.material_folders.setdefault(name, folder)
+
+    def read_face(self, corners: list[str], group: str, material: str | None) -> None:
+        counts = (self.position_count, self.uv_count, self.normal_count)
+        first = len(self.corners)
+        for corner in corners:
+            indices = [-1, -1, -1]
+            for slot, value in enumerate(corner.split("/")[:3]):
+                if value:
+                    index = int(value)
+                    # Negative indices count back from the last element read so far
+                    indices[slot] = index - 1 if index > 0 else counts[slot] + index
+            self.corners.append(tuple(indices))
+        if len(corners) >= 3:
+            self.faces.append((group, material, first, len(corners)))
+
+
+def parse_values(lines: list[str], size: int) -> np.ndarray:
+    try:
+        # Fast path: every statement has the same number of values
+        values = np.array(" ".join(lines).split(), dtype=float).reshape(len(lines), -1)
+        if values.shape[1] >= size:
+            return values[:, :size]
+        return np.hstack([values, np.zeros((len(lines), size - values.shape[1]))])
+    except ValueError:
+        pass
+
+    values = np.zeros((len(lines), size))
+    for index, line in enumerate(lines):
+        row = line.split()[:size]
+        values[index, : len(row)] = [float(value) for value in row]
+    return values
+
+
+class ObjEggBuilder:
+    def __init__(self, reader: ObjReader, root: pathlib.Path, srgb: bool = False, legacy_materials: bool = False):
+        self.reader = reader
+        self.root = root
+        self.srgb = srgb
+        self.legacy_materials = legacy_materials
+        self.texture_nodes: dict[str, eggparse.EggBranch] = {}
+        self.material_nodes: dict[str, eggparse.EggBranch] = {}
+
+    def get_texture(self, material: ObjMaterial, filename: str, envtype: str | None = None) -> str:
+        path = pathlib.Path(os.path.relpath(self.reader.material_folders[material.name] / filename, self.root))
+        name = path.stem
+        if name not in self.texture_nodes:
+            scalars = {}
+            if self.srgb and envtype is None:
+                scalars["format"] = "srgb-alpha"
+            if envtype:
+                scalars["envtype"] = envtype
+            texture_path = eggparse.EggString(eggparse.EggNode.convert_string_to_egg(path.as_posix()))
+            children = [texture_path, *make_scalars(scalars)]
+            self.texture_nodes[name] = eggparse.EggBranch("Texture", name, eggparse.EggTree(*children))
+        return name
+
+    def get_attributes(self, material_name: str | None) -> list[eggparse.EggNode]:
+        material = self.reader.materials.get(material_name) if material_name else None
+        if material is None:
+            return []
+
+        attributes = []
+        if "map_kd" in material.textures:
+            texture = self.get_texture(material, material.textures["map_kd"])
+            attributes.append(eggparse.EggLeaf("TRef", None, eggparse.EggNode.convert_string_to_egg(texture)))
+        for keyword in ("map_bump", "bump", "norm"):
+            if keyword in material.textures:
+                texture = self.get_texture(material, material.textures[keyword], "normal")
+                attributes.append(eggparse.EggLeaf("TRef", None, eggparse.EggNode.convert_string_to_egg(texture)))
+                break
+
+        if material.name not in self.material_nodes:
+            if self.legacy_materials:
+                scalars = dict(zip(("diffr", "diffg", "diffb"), material.diffuse))
+                scalars["diffa"] = material.alpha
+            else:
+                scalars = dict(zip(("baser", "baseg", "baseb"), material.diffuse))
+                if material.alpha != 1:
+                    scalars["basea"] = material.alpha
+            if material.emission:
+                scalars.update(zip(("emitr", "emitg", "emitb"), material.emission))
+            scalars = make_scalars({key: float(value) for key, value in scalars.items()})
+            node = eggparse.EggBranch("Material", material.name, eggparse.EggTree(*scalars))
+            self.material_nodes[material.name] = node
+        attributes.append(eggparse.EggLeaf("MRef", None, eggparse.EggNode.convert_string_to_egg(material.name)))
+
+        if material.alpha < 1 or "map_d" in material.textures:
+            attributes.append(eggparse.EggLeaf("Scalar", "alpha", "blend"))
+        return attributes
+
+    def build(self, name: str) -> eggparse.EggTree:
+        reader = self.reader
+        corners = np.array(reader.corners, dtype=np.int64).reshape(-1, 3)
+        # Every distinct combination of position, uv and normal becomes one egg vertex
+        unique_corners, corner_vertices = np.unique(corners, axis=0, return_inverse=True)
+        corner_vertices = corner_vertices.reshape(-1)
+
+        positions = parse_values(reader.positions, 6)
+        has_colors = bool(reader.positions) and len(reader.positions[0].split()) >= 6
+        position_rows = format_rows(y_up_to_z_up(positions[unique_corners[:, 0], :3]))
+        # Vertices of faces without normals or UVs are simply left without them
+        leaves = []
+        if reader.normals:
+            normals = y_up_to_z_up(parse_values(reader.normals, 3)[unique_corners[:, 2]])
+            normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+            leaves.append(("Normal", format_rows(normals), unique_corners[:, 2] >= 0))
+        if reader.uvs:
+            uvs = parse_values(reader.uvs, 2)[unique_corners[:, 1]]
+            leaves.append(("UV", format_rows(uvs), unique_corners[:, 1] >= 0))
+        if has_colors:
+            colors = np.hstack([positions[unique_corners[:, 0], 3:6], np.ones((len(unique_corners), 1))])
+            leaves.append(("RGBA", format_rows(colors), np.ones(len(unique_corners), dtype=bool)))
+
+        vertices = eggparse.EggTree()
+        for index, position in enumerate(position_rows):
+            children = [eggparse.EggString(position)]
+            children += [eggparse.EggLeaf(kind, None, rows[index]) for kind, rows, valid in leaves if valid[index]]
+            vertices += eggparse.EggBranch("Vertex", str(index), eggparse.EggTree(*children))
+
+        groups: dict[str, list[eggparse.EggBranch]] = {}
+        attributes = {}
+        for group, material, first, count in reader.faces:
+            if material not in attributes:
+                attributes[material] = self.get_attributes(material)
+            indices = " ".join(str(index) for index in corner_vertices[first : first + count])
+            vertex_ref = eggparse.EggLeaf("VertexRef", None, f"{indices} <Ref> {{ {name} }}")
+            polygon = eggparse.EggBranch("Polygon", None, eggparse.EggTree(*attributes[material], vertex_ref))
+            groups.setdefault(group, []).append(polygon)
+
+        tree = eggparse.EggTree(eggparse.EggLeaf("CoordinateSystem", None, "Z-Up"))
+        tree += list(self.texture_nodes.values())
+        tree += list(self.material_nodes.values())
+        tree += eggparse.EggBranch("VertexPool", name, vertices)
+        tree += [eggparse.EggBranch("Group", group, eggparse.EggTree(*polygons)) for group, polygons in groups.items()]
+        return tree
+
+
+def load_obj(
+    paths: Iterable, name: str, root=None, srgb: bool = False, legacy_materials: bool = False
+) -> eggparse.EggTree:
+    """
+    Reads OBJ files into a single egg tree. OBJ is Y-up, like the Blender importer assumes.
+    Texture paths are made relative to the root folder, which defaults to the folder of the first file.
+    """
+    paths = [pathlib.Path(path) for path in paths]
+    reader = ObjReader()
+    for path in paths:
+        reader.read(path)
+    return ObjEggBuilder(reader, pathlib.Path(root or paths[0].parent), srgb, legacy_materials).build(name)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import logging
+from collections.abc import Iterable
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.optchar")
+# Scale, shear, rotation and translation channels of a joint table
+CHANNELS = "ijkabchprxyz"
+
+
+def find_joints(tree, name: str) -> list[eggparse.EggBranch]:
+    return [joint for joint in tree.findall("Joint") if joint.node_name == name]
+
+
+def find_joint_tables(tree, name: str | None = None) -> list[eggparse.EggBranch]:
+    """
+    Returns the animation tables of the joints (the tables with a transform), optionally only those with this name.
+    """
+    return [
+        table
+        for table in tree.findall("Table")
+        if (name is None or table.node_name == name)
+        and (geometry.get_child_nodes(table, "Xfm$Anim_S$") or geometry.get_child_nodes(table, "Xfm$Anim"))
+    ]
+
+
+def get_channel_values(channel) -> list[str]:
+    values = geometry.get_child_nodes(channel, "V")
+    if not values:
+        return []
+    if isinstance(values[0], eggparse.EggLeaf):
+        return values[0].node_value.split()
+    return " ".join(child.value for child in values[0].children if isinstance(child, eggparse.EggString)).split()
+
+
+def is_static_table(table) -> bool:
+    """
+    Whether the transform of the joint is the same on every frame. Matrix tables are assumed to move.
+    """
+    if geometry.get_child_nodes(table, "Xfm$Anim"):
+        return False
+    for transform in geometry.get_child_nodes(table, "Xfm$Anim_S$"):
+        for channel in geometry.get_child_nodes(transform, "S$Anim"):
+            if len(set(map(float, get_channel_values(channel)))) > 1:
+                return False
+    return True
+
+
+def expose_joints(tree, names: Iterable[str]) -> int:
+    """
+    Same as egg-optchar -expose: the joints get a DCS flag, so they are available to exposeJoint.
+    """
+    count = 0
+    for name in names:
+        joints = find_joints(tree, name)
+        if not joints:
+            logger.warning("Joint %s was not found, it cannot be exposed", name)
+        for joint in joints:
+            if not geometry.get_child_nodes(joint, "DCS"):
+                joint.children.children.insert(0, eggparse.EggLeaf("DCS", None, "1"))
+            count += 1
+    return count
+
+
+def flag_groups(tree, flags: dict[str, str]) -> int:
+    """
+    Same as egg-optchar -flag group=name: the primitives under the groups are named, so they stay in their own Geom.
+    """
+    count = 0
+    for group in tree.findall("Group"):
+        flag_name = flags.get(group.node_name)
+        if flag_name is None:
+            continue
+        for primitive in geometry.find_primitives(group):
+            primitive.node_name = flag_name
+            count += 1
+    return count
+
+
+def zero_channels(tree, name: str, components: str = "") -> int:
+    """
+    Same as egg-optchar -zero joint,components: the animation channels of the joint are reset to their default value.
+    Every channel is reset without components. The channels are removed, like egg-optchar does,
+    but in the channel order of the table rather than after converting it to the default one.
+    """
+    components = components or CHANNELS
+    count = 0
+    for table in find_joint_tables(tree, name):
+        for transform in geometry.get_child_nodes(table, "Xfm$Anim_S$"):
+            channels = geometry.get_child_nodes(transform, "S$Anim")
+            channels = [channel for channel in channels if channel.node_name in components]
+            transform.remove_nodes(set(channels))
+            count += len(channels)
+    return count
+
+
+def set_dart_type(tree, dart_type: str) -> None:
+    """
+    Same as egg-optchar -dart: changes the type of every character root.
+    """
+    for dart in tree.findall("Dart"):
+        dart.node_value = dart_type
+
+
+def is_joint_used(joint, tables: dict[str, list[eggparse.EggBranch]], keep: set[str], memo: dict[int, bool]) -> bool:
+    """
+    A joint is used when it has vertices, moves, must be kept, or has a used joint below it.
+    """
+    if id(joint) not in memo:
+        used = bool(geometry.get_child_nodes(joint, "VertexRef")) or joint.node_name in keep
+        used = used or not all(is_static_table(table) for table in tables.get(joint.node_name, []))
+        for child in geometry.get_child_nodes(joint, "Joint"):
+            used = is_joint_used(child, tables, keep, memo) or used
+        memo[id(joint)] = used
+    return memo[id(joint)]
+
+
+def prune_joints(model, animations: Iterable = (), keep: Iterable[str] = ()) -> list[str]:
+    """
+    Removes the joints that have no vertices and never move, along with their animation tables,
+    as long as their whole subtree can go (unused joints in the middle of the hierarchy are kept).
+    Exposed joints and the joints in keep always stay. Returns the names of the removed joints.
+    """
+    animations = list(animations)
+    tables = {}
+    for animation in animations:
+        for table in find_joint_tables(animation):
+            tables.setdefault(table.node_name, []).append(table)
+
+    joints = model.findall("Joint")
+    keep = set(keep) | {joint.node_name for joint in joints if geometry.get_child_nodes(joint, "DCS")}
+    memo = {}
+    removed = [joint for joint in joints if not is_joint_used(joint, tables, keep, memo)]
+    if not removed:
+        return []
+
+    model.remove_nodes(set(removed))
+    removed_names = {joint.node_name for joint in removed}
+    for animation in animations:
+        animation.remove_nodes({table for table in find_joint_tables(animation) if table.node_name in removed_names})
+    return sorted(removed_names)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import logging
+from collections.abc import Iterable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from panda_utils.eggtree import eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.tangents")
+
+
+def read_vector(node) -> str | None:
+    if node is None:
+        return None
+    if isinstance(node, eggparse.EggLeaf):
+        return node.node_value
+    for child in node.children:
+        if isinstance(child, eggparse.EggString):
+            return child.value
+    return None
+
+
+def parse_vectors(values: list[str | None], size: int):
+    """
+    Returns the vectors as an array, along with a mask of the values that were present.
+    """
+    present = np.array([value is not None for value in values], dtype=bool)
+    vectors = np.zeros((len(values), size))
+    for index, value in enumerate(values):
+        if value is not None:
+            row = value.split()[:size]
+            vectors[index, : len(row)] = [float(x) for x in row]
+    return vectors, present
+
+
+def normalize(vectors):
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
+
+
+def set_tangent_binormal(vertex, uv_name: str, tangent: str, binormal: str) -> None:
+    children = vertex.children.children
+    for index, child in enumerate(children):
+        if getattr(child, "node_type", None) == "UV" and child.node_name == (uv_name or ""):
+            break
+    else:
+        return
+
+    others = []
+    if isinstance(child, eggparse.EggBranch):
+        others = [node for node in child.children if getattr(node, "node_type", None) not in ("Tangent", "Binormal")]
+    else:
+        others = [eggparse.EggString(child.node_value)]
+    uv = eggparse.EggTree(
+        others[0], eggparse.EggLeaf("Tangent", None, tangent), eggparse.EggLeaf("Binormal", None, binormal), *others[1:]
+    )
+    children[index] = eggparse.EggBranch("UV", uv_name or None, uv)
+
+
+def compute_tangent_binormals(tree, uv_names: Iterable[str] | None = None) -> int:
+    """
+    Adds tangents and binormals to the vertices of every polygon, for the given UV sets or all of them.
+    Like egg-trans, corners that share a position, normal, UV and UV winding are smoothed together,
+    vertices shared by corners of different groups are split, and vertices without any normal are skipped.
+    Returns the number of vertices that were changed.
+    """
+    pools = geometry.get_vertex_pools(tree)
+    keys = [(pool, index) for pool, vertices in pools.items() for index in vertices]
+    if not keys:
+        return 0
+    vertex_ids = {key: vertex_id for vertex_id, key in enumerate(keys)}
+    vertex_nodes = [pools[pool][index] for pool, index in keys]
+
+    positions, _ = parse_vectors([vertex.get_child(0).value for vertex in vertex_nodes], 3)
+    normal_nodes = [geometry.get_child_nodes(vertex, "Normal") for vertex in vertex_nodes]
+    normals, has_normal = parse_vectors([read_vector(nodes[0]) if nodes else None for nodes in normal_nodes], 3)
+
+    if uv_names is None:
+        uv_names = sorted({uv.node_name for vertex in vertex_nodes for uv in geometry.get_child_nodes(vertex, "UV")})
+    uv_names = list(uv_names)
+
+    # Every corner of every polygon, with the two vertices that follow it
+    corner_ids, next_ids, last_ids, polygon_ids, polygon_normals = [], [], [], [], []
+    polygon_refs = []
+    for polygon in tree.findall("Polygon"):
+        ref, indices, pool = geometry.get_primitive_vertices(polygon)
+        if len(indices) < 3 or pool not in pools:
+            continue
+        ids = [vertex_ids[(pool, index)] for index in indices]
+        corner_ids += ids
+        next_ids += ids[1:] + ids[:1]
+        last_ids += ids[2:] + ids[:2]
+        polygon_ids += [len(polygon_refs)] * len(ids)
+        polygon_normal = geometry.get_child_nodes(polygon, "Normal")
+        polygon_normals.append(read_vector(polygon_normal[0]) if polygon_normal else None)
+        polygon_refs.append((ref, ids))
+    if not corner_ids:
+        return 0
+
+    corner_ids, next_ids, last_ids = np.array(corner_ids), np.array(next_ids), np.array(last_ids)
+    polygon_ids = np.array(polygon_ids)
+    polygon_normals, has_polygon_normal = parse_vectors(polygon_normals, 3)
+    first_corners = np.searchsorted(polygon_ids, np.arange(len(polygon_refs)))
+
+    # The vertex normal wins over the polygon normal
+    corner_normals = np.where(has_normal[corner_ids, None], normals[corner_ids], polygon_normals[polygon_ids])
+    has_corner_normal = has_normal[corner_ids] | has_polygon_normal[polygon_ids]
+    p1, p2, p3 = positions[corner_ids], positions[next_ids], positions[last_ids]
+
+    # For each UV set, the TBN group of every corner (-1 when it is not computed) and the results per group
+    corner_groups = np.full((len(uv_names), len(corner_ids)), -1)
+    results: list[dict[int, tuple]] = []
+    for uv_slot, uv_name in enumerate(uv_names):
+        uv_values = [read_vector(geometry.get_uv_node(vertex, uv_name)) for vertex in vertex_nodes]
+        uvs, has_uv = parse_vectors(uv_values, 2)
+        valid = has_corner_normal & has_uv[corner_ids]
+        if not valid.any():
+            results.append({})
+            continue
+
+        # The winding of the UVs of the first three vertices of each polygon
+        w0, w1, w2 = (uvs[corner_ids[first_corners + offset]] for offset in range(3))
+        (a_u, a_v), (b_u, b_v) = (w1 - w0).T, (w2 - w1).T
+        facing = a_u * b_v - a_v * b_u > 0
+
+        w1, w2, w3 = uvs[corner_ids], uvs[next_ids], uvs[last_ids]
+        group_keys = np.column_stack([p1, corner_normals, w1, facing[polygon_ids]])[valid]
+        unique_keys, groups = np.unique(group_keys, axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+
+        x1, x2 = (p2 - p1)[valid], (p3 - p1)[valid]
+        s1, t1 = (w2 - w1)[valid].T
+        s2, t2 = (w3 - w1)[valid].T
+        denominator = s1 * t2 - s2 * t1
+        # Corners with degenerate UVs do not contribute anything
+        r = np.divide(1.0, denominator, out=np.zeros_like(denominator), where=denominator != 0)
+        sdir = np.zeros((len(unique_keys), 3))
+        tdir = np.zeros((len(unique_keys), 3))
+        np.add.at(sdir, groups, (t2[:, None] * x1 - t1[:, None] * x2) * r[:, None])
+        np.add.at(tdir, groups, (s1[:, None] * x2 - s2[:, None] * x1) * r[:, None])
+
+        # Gram-Schmidt against the normal, the binormal follows the V direction
+        group_normals = unique_keys[:, 3:6]
+        tangents = normalize(sdir - group_normals * np.sum(group_normals * sdir, axis=1, keepdims=True))
+        binormals = normalize(np.cross(group_normals, tangents))
+        binormals[np.sum(binormals * tdir, axis=1) < 0] *= -1
+
+        corner_groups[uv_slot, valid] = groups
+        results.append(dict(enumerate(zip(geometry.format_rows(tangents), geometry.format_rows(binormals)))))
+
+    # Corners of the same vertex with different groups need their own copy of the vertex
+    signatures = np.column_stack([corner_ids, corner_groups.T])
+    unique_signatures, first_corners_seen, corner_targets = np.unique(
+        signatures, axis=0, return_index=True, return_inverse=True
+    )
+    corner_targets = corner_targets.reshape(-1)
+    duplicator = geometry.VertexDuplicator(tree)
+    target_vertices = [0] * len(unique_signatures)
+    seen_vertices = set()
+    # The first corner of each vertex keeps the original, in polygon order
+    for target in np.argsort(first_corners_seen, kind="stable"):
+        signature = unique_signatures[target]
+        vertex_id = int(signature[0])
+        pool, index = keys[vertex_id]
+        if vertex_id in seen_vertices:
+            index = duplicator.duplicate(pool, index)
+        seen_vertices.add(vertex_id)
+        vertex = duplicator.vertices[pool][index]
+        for uv_slot, group in enumerate(signature[1:]):
+            if group >= 0:
+                set_tangent_binormal(vertex, uv_names[uv_slot], *results[uv_slot][int(group)])
+        target_vertices[target] = index
+    duplicator.finish()
+
+    for (ref, ids), first in zip(polygon_refs, first_corners):
+        geometry.set_vertex_ref(ref, [target_vertices[target] for target in corner_targets[first : first + len(ids)]])
+    return int((unique_signatures[:, 1:] >= 0).any(axis=1).sum())
@@ -0,0 +1,209 @@
+import logging
+from collections.abc import Iterable
+
+from panda_utils.eggtree import cleanup, eggparse, geometry
+
+logger = logging.getLogger("panda_utils.eggtree.vcache")
+# The cache that the polygons are ordered for, and the FIFO cache that the miss ratio is measured with
+CACHE_SIZE = 32
+ACMR_CACHE_SIZE = 16
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+# The order of these polygons is visible: blending, explicit bins and decals draw them in the order they come in
+ORDERED_SCALARS = {"bin", "draw_order", "decal"}
+ORDERED_ALPHA_MODES = {"on", "blend", "blend_no_occlude", "dual", "premultiplied"}
+
+CACHE_SCORES = [
+    LAST_TRIANGLE_SCORE if position < 3 else (1 - (position - 3) / (CACHE_SIZE - 3)) ** CACHE_DECAY_POWER
+    for position in range(CACHE_SIZE)
+]
+
+
+def get_vertex_score(position: int, remaining: int) -> float:
+    if not remaining:
+        return -1.0
+    score = CACHE_SCORES[position] if 0 <= position < CACHE_SIZE else 0.0
+    return score + VALENCE_BOOST_SCALE * remaining**-VALENCE_BOOST_POWER
+
+
+def order_polygons(polygons: list[list]) -> list[int]:
+    """
+    Returns the order in which the polygons (given as lists of vertex ids) use the vertex cache best.
+    Each step emits the best scoring polygon that uses a cached vertex, or the next one in the original order.
+    """
+    vertex_polygons: dict[int, list[int]] = {}
+    for polygon, vertices in enumerate(polygons):
+        for vertex in set(vertices):
+            vertex_polygons.setdefault(vertex, []).append(polygon)
+    remaining = {vertex: len(users) for vertex, users in vertex_polygons.items()}
+    scores = {vertex: get_vertex_score(-1, count) for vertex, count in remaining.items()}
+    polygon_scores = [sum(scores[vertex] for vertex in set(vertices)) for vertices in polygons]
+
+    emitted = [False] * len(polygons)
+    order = []
+    cache: list[int] = []
+    next_polygon = 0
+    best = max(range(len(polygons)), key=polygon_scores.__getitem__, default=None)
+    while len(order) < len(polygons):
+        if best is None:
+            while emitted[next_polygon]:
+                next_polygon += 1
+            best = next_polygon
+
+        emitted[best] = True
+        order.append(best)
+        vertices = list(dict.fromkeys(polygons[best]))
+        for vertex in vertices:
+            remaining[vertex] -= 1
+            vertex_polygons[vertex].remove(best)
+
+        # The vertices of the polygon move to the front, the ones that fall off the end lose their cache score
+        new_cache = vertices + [vertex for vertex in cache if vertex not in vertices]
+        cache, evicted = new_cache[:CACHE_SIZE], new_cache[CACHE_SIZE:]
+        for position, vertex in enumerate(cache):
+            scores[vertex] = get_vertex_score(position, remaining[vertex])
+        for vertex in evicted:
+            scores[vertex] = get_vertex_score(-1, remaining[vertex])
+
+        best, best_score = None, None
+        for vertex in cache + evicted:
+            for polygon in vertex_polygons[vertex]:
+                score = polygon_scores[polygon] = sum(scores[other] for other in set(polygons[polygon]))
+                if vertex in cache and (best_score is None or score > best_score):
+                    best, best_score = polygon, score
+    return order
+
+
+def count_cache_misses(polygons: Iterable[list], cache_size: int = ACMR_CACHE_SIZE) -> tuple[int, int]:
+    """
+    Returns the number of vertex cache misses and of triangles, for the polygons triangulated as fans and a FIFO cache.
+    """
+    cache, cached = [], set()
+    misses = triangles = 0
+    for vertices in polygons:
+        for offset in range(1, len(vertices) - 1):
+            triangles += 1
+            for vertex in (vertices[0], vertices[offset], vertices[offset + 1]):
+                if vertex in cached:
+                    continue
+                misses += 1
+                cache.append(vertex)
+                cached.add(vertex)
+                if len(cache) > cache_size:
+                    cached.discard(cache.pop(0))
+    return misses, triangles
+
+
+def get_polygon_vertices(polygon) -> list[tuple[str, int]]:
+    _, indices, pool = geometry.get_primitive_vertices(polygon)
+    return [(pool, index) for index in indices]
+
+
+def get_acmr(tree, cache_size: int = ACMR_CACHE_SIZE) -> float:
+    """
+    The average number of cache misses per triangle, for the polygons in the order of the tree.
+    Around 0.5 is perfect for a large mesh, 3 means no vertex is ever reused.
+    """
+    misses, triangles = count_cache_misses(map(get_polygon_vertices, tree.findall("Polygon")), cache_size)
+    return misses / triangles if triangles else 0.0
+
+
+def is_ordered(node, textures: dict[str, eggparse.EggBranch]) -> bool:
+    """
+    Whether the node (a group or a polygon) asks for its polygons to be drawn in order.
+    """
+    nodes = [node]
+    for tref in geometry.get_child_nodes(node, "TRef"):
+        if texture := textures.get(eggparse.sanitize_string(tref.node_value)):
+            nodes.append(texture)
+    for item in nodes:
+        for scalar in geometry.get_child_nodes(item, "Scalar"):
+            if scalar.node_name in ORDERED_SCALARS:
+                return True
+            if scalar.node_name == "alpha" and scalar.node_value.strip().lower() in ORDERED_ALPHA_MODES:
+                return True
+    return False
+
+
+def reorder_children(tree, textures: dict[str, eggparse.EggBranch], ordered: bool = False) -> int:
+    """
+    Reorders every run of consecutive polygons with the same attributes, in every group that may be reordered.
+    Returns the number of polygons that moved.
+    """
+    moved = 0
+    runs, run, run_key = [], [], None
+    for index, child in enumerate(tree.children):
+        if isinstance(child, eggparse.EggBranch) and child.node_type == "Polygon" and not ordered:
+            ref, indices, _ = geometry.get_primitive_vertices(child)
+            key = "".join(repr(node) for node in child.children if node is not ref)
+            if len(indices) >= 3 and not is_ordered(child, textures):
+                if key != run_key:
+                    runs.append(run)
+                    run, run_key = [], key
+                run.append(index)
+                continue
+        runs.append(run)
+        run, run_key = [], None
+        if isinstance(child, eggparse.EggBranch) and child.node_type != "Polygon":
+            moved += reorder_children(child.children, textures, ordered or is_ordered(child, textures))
+    runs.append(run)
+
+    for run in runs:
+        if len(run) < 3:
+            continue
+        polygons = [tree.children[index] for index in run]
+        vertices = [get_polygon_vertices(polygon) for polygon in polygons]
+        order = order_polygons(vertices)
+        # Exporters sometimes write a good order already, it is kept unless the new one is better
+        if count_cache_misses([vertices[position] for position in order])[0] >= count_cache_misses(vertices)[0]:
+            continue
+        for index, position in zip(run, order):
+            moved += polygons[position] is not tree.children[index]
+            tree.children[index] = polygons[position]
+    return moved
+
+
+def renumber_vertices(tree) -> int:
+    """
+    Renumbers the vertices of every pool in the order the primitives first use them, so they are fetched in order.
+    The vertices no primitive uses go last. Returns the number of vertices that got a new index.
+    """
+    first_uses: dict[str, dict[int, int]] = {}
+    for ref in cleanup.get_primitive_refs(tree):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        uses = first_uses.setdefault(pool, {})
+        for index in indices:
+            uses.setdefault(index, len(uses))
+
+    remaps: dict[str, dict[int, int]] = {}
+    for pool in tree.findall("VertexPool"):
+        vertices = geometry.get_child_nodes(pool, "Vertex")
+        uses = first_uses.get(pool.node_name, {})
+        unused = [int(vertex.node_name) for vertex in vertices if int(vertex.node_name) not in uses]
+        remap = {index: new_index for new_index, index in enumerate([*uses, *unused])}
+        if all(index == new_index for index, new_index in remap.items()):
+            continue
+        remaps[pool.node_name] = remap
+        for vertex in vertices:
+            vertex.node_name = str(remap[int(vertex.node_name)])
+        others = [child for child in pool.children if getattr(child, "node_type", None) != "Vertex"]
+        pool.children = eggparse.EggTree(*others, *sorted(vertices, key=lambda vertex: int(vertex.node_name)))
+
+    for ref in tree.findall("VertexRef"):
+        indices, pool = geometry.parse_vertex_ref(ref)
+        if pool in remaps:
+            geometry.set_vertex_ref(ref, [remaps[pool][index] for index in indices])
+    return sum(sum(index != new_index for index, new_index in remap.items()) for remap in remaps.values())
+
+
+def optimize_vertex_cache(tree) -> tuple[int, int]:
+    """
+    Reorders the polygons for the vertex cache, then renumbers the vertices in the new order.
+    Only runs of polygons with the same attributes are reordered, and never where the order can be seen.
+    Returns the number of polygons that moved and of vertices that were renumbered.
+    """
+    textures = {texture.node_name: texture for texture in tree.findall("Texture")}
+    moved = reorder_children(tree, textures)
+    return moved, renumber_vertices(tree)
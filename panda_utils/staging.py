@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import logging
+import os
+import pathlib
+import shutil
+import sys
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("panda_utils.staging")
+PathLike = Union[str, os.PathLike]
+# ioctl(FICLONE) clones the extents of one file into another on btrfs, xfs and other CoW filesystems
+FICLONE = 0x40049409
+
+
+class StagingMode(Enum):
+    AUTO = "auto"
+    """Use a reflink if the filesystem supports it, then a hardlink, then a regular copy."""
+
+    REFLINK = "reflink"
+    """Use a reflink, falling back to a regular copy."""
+
+    HARDLINK = "hardlink"
+    """Use a hardlink, falling back to a regular copy."""
+
+    COPY = "copy"
+    """Always copy the file contents."""
+
+
+def get_staging_mode() -> StagingMode:
+    value = os.getenv("PANDA_UTILS_STAGING", StagingMode.AUTO.value).lower()
+    try:
+        return StagingMode(value)
+    except ValueError:
+        logger.warning("Unknown staging mode: %s, using auto instead", value)
+        return StagingMode.AUTO
+
+
+def _reflink(source: PathLike, target: PathLike) -> bool:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        pathlib.Path(target).unlink(missing_ok=True)
+        return False
+
+    shutil.copystat(source, target)
+    return True
+
+
+def stage_file(source: PathLike, target: PathLike, mode: StagingMode | None = None) -> str:
+    """
+    Makes the target have the same contents as the source, as cheaply as the filesystem allows.
+    Returns the method that was used: reflink, hardlink or copy.
+    Hardlinked files share the data with the source, so they must be detached before being modified in place.
+    """
+    mode = mode or get_staging_mode()
+    target = pathlib.Path(target)
+    # Never write through an existing target, it may be a hardlink to something else
+    target.unlink(missing_ok=True)
+
+    if mode in (StagingMode.AUTO, StagingMode.REFLINK) and _reflink(source, target):
+        return "reflink"
+
+    if mode in (StagingMode.AUTO, StagingMode.HARDLINK):
+        try:
+            os.link(source, target)
+        except OSError:
+            pass
+        else:
+            return "hardlink"
+
+    shutil.copy2(source, target)
+    return "copy"
+
+
+def stage_files(pairs: Iterable[tuple[PathLike, PathLike]], mode: StagingMode | None = None) -> None:
+    """
+    Stages multiple files at once. Files that have to be copied are copied in a thread pool.
+    """
+    mode = mode or get_staging_mode()
+    pairs = list(pairs)
+    if len(pairs) < 2:
+        for source, target in pairs:
+            stage_file(source, target, mode)
+        return
+
+    with ThreadPoolExecutor() as pool:
+        # list() makes sure that exceptions are raised here
+        list(pool.map(lambda pair: stage_file(*pair, mode), pairs))
+
+
+def stage_tree(source: PathLike, target: PathLike, mode: StagingMode | None = None) -> None:
+    """
+    A replacement for shutil.copytree that stages the files instead of copying them when possible.
+    """
+    source, target = pathlib.Path(source), pathlib.Path(target)
+    pairs = []
+    for dirpath, dirs, files in os.walk(source):
+        relative = pathlib.Path(dirpath).relative_to(source)
+        (target / relative).mkdir(parents=True, exist_ok=True)
+        for file in files:
+            pairs.append((pathlib.Path(dirpath, file), target / relative / file))
+    stage_files(pairs, mode)
+
+
+def detach(path: PathLike, keep_contents: bool = True) -> None:
+    """
+    Must be called before a file is modified in place. If the file is hardlinked, it gets a private copy,
+    so the modification does not leak into the other links (for example, into the input folder).
+    If the file is about to be rewritten from scratch, keep_contents=False skips copying the data.
+    """
+    path = pathlib.Path(path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return
+
+    if stat.st_nlink <= 1:
+        return
+
+    if not keep_contents:
+        path.unlink()
+        return
+
+    temp_path = path.with_name(f".{path.name}.detached")
+    shutil.copy2(path, temp_path)
+    os.replace(temp_path, path)
+
+
+def detach_tree(path: PathLike) -> None:
+    for dirpath, dirs, files in os.walk(path):
+        for file in files:
+            detach(pathlib.Path(dirpath, file))
@@ -1,18 +1,43 @@
+from __future__ import annotations
+
 import logging
+import os
+import pathlib
+import re
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from panda3d.core import BamFile, Filename, NodePath
+except ImportError:
+    BamFile = None
 
-from panda_utils import util
-from panda_utils.eggtree import eggparse, operations
+from panda_utils import staging, util
+from panda_utils.eggtree import animation, eggparse, operations
 
 logger = logging.getLogger("panda_utils.animconvert")
+# The start of a table header: the indentation and the keyword, then the name (quoted or not) before the brace
+TABLE_HEADER = re.compile(r'^(\s*<Table>\s+)("[^"]*"|[^\s{"]+)(?=\s*\{)')
 
 
-def animation_names(ctx: util.Context, path: str, output: str, conversion_names: dict[str, str]):
+def animation_names(
+    ctx: util.Context,
+    path: str,
+    output: str,
+    conversion_names: dict[str, str],
+    fps: float = 0,
+    tolerance: float = 0,
+    angle_tolerance: float = 0,
+    scale_tolerance: float = 0,
+    interpolated: bool = False,
+):
     eggpath = path.replace(".bam", ".egg")
 
     util.run_panda(ctx, "bam2egg", "-o", eggpath, path)
     logger.info("Converted file %s to egg, reading data...", path)
 
-    with open(eggpath) as f:
+    with open(f"{ctx.working_path}/{eggpath}") as f:
         data = f.readlines()
 
     logger.info("Data read, converting names...")
@@ -23,16 +48,158 @@ def animation_names(ctx: util.Context, path: str, output: str, conversion_names:
             logger.info("Converting %s to %s", node.node_name, converted_name)
             node.node_name = converted_name
 
+    if fps or tolerance or angle_tolerance or scale_tolerance or interpolated:
+        if interpolated:
+            logger.info(animation.INTERPOLATION_NOTE)
+        frames, channels = animation.count_frames_and_channels(eggtree)
+        animation.compress_animation(eggtree, fps, tolerance, angle_tolerance, scale_tolerance, interpolated)
+        new_frames, new_channels = animation.count_frames_and_channels(eggtree)
+        logger.info(
+            "Compressed the animation from %d to %d frames and from %d to %d channels",
+            frames,
+            new_frames,
+            channels,
+            new_channels,
+        )
+
     operations.add_comment(eggtree, "Toontown-Event-Horizon/PandaUtils Animation converter")
     logger.info("Finished converting names, creating new .bam file...")
-    with open(eggpath, "w") as f:
+    with open(f"{ctx.working_path}/{eggpath}", "w") as f:
         f.write(str(eggtree))
 
     util.run_panda(ctx, "egg2bam", "-o", output, eggpath)
 
 
-def animation_rename_bulk(ctx: util.Context, path: str, output: str, conversion_names: dict[str, str]):
-    for file in util.get_file_list(ctx.working_path, path):
-        if file.endswith(".bam"):
-            file = f"{path}/{file}"
-            animation_names(ctx, file, file.replace(path, output), conversion_names)
+def rename_table_headers(lines: Iterable[str], conversion_names: dict[str, str], renamed: list[str]) -> Iterator[str]:
+    """
+    Renames the tables by rewriting their header lines only, every other line is passed through unchanged.
+    The original names of the renamed tables are appended to renamed.
+    """
+    for line in lines:
+        if "<Table>" not in line or not (match := TABLE_HEADER.match(line)):
+            yield line
+            continue
+
+        name = eggparse.EggNode.convert_string_from_egg(match.group(2))
+        converted_name = conversion_names.get(name)
+        if not converted_name:
+            yield line
+            continue
+
+        renamed.append(name)
+        yield match.group(1) + eggparse.EggNode.convert_string_to_egg(converted_name) + line[match.end() :]
+
+
+def rename_egg_file(source: str, target: str, conversion_names: dict[str, str]) -> list[str]:
+    """
+    Streams the egg file into the target, renaming the tables. The source and the target may be the same file.
+    """
+    renamed = []
+    temp_path = pathlib.Path(target).with_name(f".{pathlib.Path(target).name}.renamed")
+    temp_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(source) as f, open(temp_path, "w") as out:
+        out.writelines(rename_table_headers(f, conversion_names, renamed))
+    os.replace(temp_path, target)
+    return renamed
+
+
+def iterate_anim_groups(group):
+    yield group
+    for index in range(group.get_num_children()):
+        yield from iterate_anim_groups(group.get_child(index))
+
+
+def rename_bam_file(source: str, target: str, conversion_names: dict[str, str]) -> list[str]:
+    """
+    Renames the tables of every animation bundle inside a bam file, without going through egg.
+    """
+    bam = BamFile()
+    if not bam.open_read(Filename.from_os_specific(source)):
+        raise OSError(f"Unable to read {source}")
+    root = bam.read_object()
+    if root is None or not bam.resolve():
+        raise OSError(f"Unable to read {source}")
+    bam.close()
+
+    renamed = []
+    for bundle_node in NodePath(root).find_all_matches("**/+AnimBundleNode"):
+        # The bundle itself is named after the character, only the tables below it are joints and sliders
+        bundle = bundle_node.node().get_bundle()
+        for index in range(bundle.get_num_children()):
+            for group in iterate_anim_groups(bundle.get_child(index)):
+                if converted_name := conversion_names.get(group.name):
+                    renamed.append(group.name)
+                    group.set_name(converted_name)
+
+    pathlib.Path(target).parent.mkdir(parents=True, exist_ok=True)
+    staging.detach(target, keep_contents=False)
+    bam = BamFile()
+    if not bam.open_write(Filename.from_os_specific(target)) or not bam.write_object(root):
+        raise OSError(f"Unable to write {target}")
+    bam.close()
+    return renamed
+
+
+def animation_rename(ctx: util.Context, path: str, output: str, conversion_names: dict[str, str]) -> list[str]:
+    """
+    Renames the joints of a single animation without parsing it. Bam files are handled by Panda3D in-process
+    when it can be imported, and go through bam2egg and egg2bam otherwise.
+    """
+    source, target = f"{ctx.working_path}/{path}", f"{ctx.working_path}/{output}"
+    if path.endswith(".egg"):
+        return rename_egg_file(source, target, conversion_names)
+    if BamFile is not None:
+        return rename_bam_file(source, target, conversion_names)
+
+    eggpath = path.replace(".bam", ".egg")
+    util.run_panda(ctx, "bam2egg", "-o", eggpath, path)
+    renamed = rename_egg_file(f"{ctx.working_path}/{eggpath}", f"{ctx.working_path}/{eggpath}", conversion_names)
+    util.run_panda(ctx, "egg2bam", "-o", output, eggpath)
+    return renamed
+
+
+def animation_rename_bulk(
+    ctx: util.Context,
+    path: str,
+    output: str,
+    conversion_names: dict[str, str],
+    fps: float = 0,
+    tolerance: float = 0,
+    angle_tolerance: float = 0,
+    scale_tolerance: float = 0,
+    interpolated: bool = False,
+    workers: int | None = None,
+):
+    """
+    Renames the joints of every animation in the folder, in parallel. Egg files are renamed as well as bam files.
+    Compressing the animations needs the whole tree, so the files are parsed when any compression option is given.
+    """
+    compression = {
+        "fps": fps,
+        "tolerance": tolerance,
+        "angle_tolerance": angle_tolerance,
+        "scale_tolerance": scale_tolerance,
+        "interpolated": interpolated,
+    }
+    compress = any(compression.values())
+    files = [f"{path}/{file}" for file in util.get_file_list(ctx.working_path, path)]
+    files = [file for file in files if file.endswith(".bam") or (file.endswith(".egg") and not compress)]
+
+    def rename_job(file):
+        start = time.perf_counter()
+        target = file.replace(path, output)
+        if compress:
+            animation_names(ctx, file, target, conversion_names, **compression)
+            return file, None, time.perf_counter() - start
+        return file, animation_rename(ctx, file, target, conversion_names), time.perf_counter() - start
+
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    if workers <= 1:
+        results = [rename_job(file) for file in files]
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(rename_job, files))
+
+    for file, renamed, elapsed in results:
+        if renamed is not None:
+            logger.info("Renamed %d joints in %s (%.1f ms)", len(renamed), file, elapsed * 1000)
@@ -4,14 +4,15 @@ import shutil
 import logging
 from typing import List
 
-from panda_utils import util
+from panda_utils import staging, util
+from panda_utils.eggtree import decimate, eggparse, tangents
 
 LODs = ["-1000", "-500", "-250"]
 
 logger = logging.getLogger("panda_utils.converter")
 
 
-def copy_single(source_path: pathlib.Path, target_path: pathlib.Path) -> None:
+def copy_single(source_path: pathlib.Path, target_path: pathlib.Path, stage: bool = False) -> None:
     if not source_path.exists():
         return
 
@@ -21,16 +22,19 @@ def copy_single(source_path: pathlib.Path, target_path: pathlib.Path) -> None:
     target_path.parent.mkdir(parents=True, exist_ok=True)
     if source_path.is_dir():
         shutil.copytree(source_path, target_path, dirs_exist_ok=True)
+    elif stage:
+        # The copies are edited by hand afterwards, so they may share extents with the source but never its inode
+        staging.stage_file(source_path, target_path, staging.StagingMode.REFLINK)
     else:
         shutil.copy(source_path, target_path)
 
 
-def copy(source: str, target: str, path: str, target_fn: str = None) -> None:
+def copy(source: str, target: str, path: str, target_fn: str = None, stage: bool = False) -> None:
     if target_fn is None:
         target_fn = path
     source_path = pathlib.Path(source, path)
     target_path = pathlib.Path(target, target_fn)
-    copy_single(source_path, target_path)
+    copy_single(source_path, target_path, stage)
 
     for lod in LODs:
         if lod not in path:
@@ -42,7 +46,7 @@ def copy(source: str, target: str, path: str, target_fn: str = None) -> None:
 
             new_source = str(source_path).replace(lod, other_lod)
             new_target = str(target_path).replace(lod, other_lod)
-            copy_single(pathlib.Path(new_source), pathlib.Path(new_target))
+            copy_single(pathlib.Path(new_source), pathlib.Path(new_target), stage)
 
 
 def patch_egg(ctx: util.Context, path: str) -> None:
@@ -53,6 +57,7 @@ def patch_egg(ctx: util.Context, path: str) -> None:
         return
 
     data = data.replace(f"{ctx.working_path}/", "").replace(ctx.working_path, "")
+    staging.detach(f"{ctx.working_path}/{path}", keep_contents=False)
     with open(f"{ctx.working_path}/{path}", "w") as f:
         f.write(data)
     logger.info("Patched absolute source paths!")
@@ -61,16 +66,25 @@ def patch_egg(ctx: util.Context, path: str) -> None:
 def patch_pipeline(ctx: util.Context, path: str) -> None:
     oppath = f"{path}-operated"
     copy(ctx.working_path, ctx.working_path, path, oppath)
-    for i in range(2):  # sometimes issues happen when running one time
-        bam2egg(ctx, oppath)
-        eggpath = oppath.replace(".bam", ".egg")
-        eggtrans(ctx, eggpath)
-        egg2bam(ctx, eggpath)
+    bam2egg(ctx, oppath)
+    eggpath = oppath.replace(".bam", ".egg")
+    eggtrans(ctx, eggpath)
+    egg2bam(ctx, eggpath)
     copy(ctx.working_path, ctx.resources_path, oppath, path)
 
 
 def eggtrans(ctx: util.Context, path: str) -> None:
-    util.run_panda(ctx, "egg-trans", "-tbnall", path, "-o", path)
+    """
+    Same as egg-trans -tbnall, without leaving the process.
+    """
+    with open(f"{ctx.working_path}/{path}") as f:
+        eggtree = eggparse.egg_tokenize(f.readlines())
+
+    count = tangents.compute_tangent_binormals(eggtree)
+    staging.detach(f"{ctx.working_path}/{path}", keep_contents=False)
+    with open(f"{ctx.working_path}/{path}", "w") as f:
+        f.write(str(eggtree))
+    logger.info("Computed tangents and binormals of %d vertices", count)
 
 
 def copy_errors(ctx: util.Context, path: str, errored_files: List[str]) -> bool:
@@ -110,8 +124,8 @@ def egg2bam(ctx: util.Context, path: str, triplicate: bool = False, flags=()) ->
         command.append("-txo")
     if "rawtex" in flags:
         command.append("-rawtex")
-    output = util.run_panda(ctx, *command)
-    errored_files = ctx.regex_collection.not_found.findall(output)
+    errored_files = []
+    util.run_panda(ctx, *command, missing_textures=errored_files)
     if errored_files:
         if "no-copyerrors" in flags:
             logger.error("Textures are missing: %s! Aborting.", errored_files)
@@ -125,7 +139,7 @@ def egg2bam(ctx: util.Context, path: str, triplicate: bool = False, flags=()) ->
 
 
 def bam2egg(ctx: util.Context, path: str, flags=()) -> None:
-    abspath, need_copy = pathlib.Path(path), False
+    abspath, need_copy = pathlib.Path(ctx.working_path, path), False
     if not abspath.exists():
         abspath, need_copy = pathlib.Path(ctx.resources_path, path), True
     if not abspath.exists():
@@ -134,8 +148,8 @@ def bam2egg(ctx: util.Context, path: str, flags=()) -> None:
     if need_copy:
         copy(ctx.resources_path, ctx.working_path, path)
 
-    output = util.run_panda(ctx, "bam2egg", path, "-o", path.replace(".bam", ".egg"))
-    errored_files = ctx.regex_collection.not_found.findall(output)
+    errored_files = []
+    util.run_panda(ctx, "bam2egg", path, "-o", path.replace(".bam", ".egg"), missing_textures=errored_files)
     if not errored_files:
         logger.info("Recompilation not needed!")
         patch_egg(ctx, path.replace("bam", "egg"))
@@ -151,19 +165,72 @@ def bam2egg(ctx: util.Context, path: str, flags=()) -> None:
     patch_egg(ctx, path.replace(".bam", ".egg"))
 
 
-def build_lods(ctx: util.Context, path: str) -> None:
+def check_lod_ratios(ratios: list[float]) -> None:
+    """
+    The LOD ratios need one per LOD, in descending order, each above 0 and at most 1.
+    """
+    if len(ratios) != len(LODs):
+        raise ValueError(f"Expected {len(LODs)} LOD ratios (one per LOD), got {len(ratios)}: {ratios}")
+    if not all(0 < ratio <= 1 for ratio in ratios):
+        raise ValueError(f"Every LOD ratio must be above 0 and at most 1: {ratios}")
+    if any(later > earlier for earlier, later in zip(ratios, ratios[1:])):
+        raise ValueError(f"The LOD ratios must be in descending order: {ratios}")
+
+
+def parse_lod_ratios(ratios: str) -> list[float]:
+    try:
+        values = [float(ratio) for ratio in str(ratios).split(",")]
+    except ValueError:
+        raise ValueError(f"The LOD ratios must be comma-separated numbers: {ratios}") from None
+    check_lod_ratios(values)
+    return values
+
+
+def decimate_lods(ctx: util.Context, path: str, ratios: list[float]) -> None:
+    """
+    Writes the LOD files with their triangles reduced to the given ratios of the original model.
+    Each LOD is simplified from the previous one, bam files go through egg files that are removed afterwards.
+    """
+    check_lod_ratios(ratios)
+    eggpath = path.replace(".bam", ".egg")
+    is_bam = path.endswith(".bam")
+    if is_bam:
+        staging.detach(f"{ctx.working_path}/{eggpath}", keep_contents=False)
+        bam2egg(ctx, path)
+    with open(f"{ctx.working_path}/{eggpath}") as f:
+        eggtree = eggparse.egg_tokenize(f.readlines())
+
+    for lod, (original, after) in zip(LODs, decimate.decimate_levels(eggtree, ratios)):
+        target_name = f"{eggpath[:-4]}{lod}.egg"
+        staging.detach(f"{ctx.working_path}/{target_name}", keep_contents=False)
+        with open(f"{ctx.working_path}/{target_name}", "w") as f:
+            f.write(str(eggtree))
+        if is_bam:
+            util.run_panda(ctx, "egg2bam", "-o", target_name.replace(".egg", ".bam"), target_name)
+            os.remove(f"{ctx.working_path}/{target_name}")
+        logger.info("Decimated %s to %d of %d triangles", target_name, after, original)
+
+    if is_bam:
+        os.remove(f"{ctx.working_path}/{eggpath}")
+
+
+def build_lods(ctx: util.Context, path: str, ratios: str = "") -> None:
     if not path.endswith(".egg") and not path.endswith(".bam"):
         raise Exception("Only .egg and .bam files can be triplicated!")
 
     if any(f"{lod}." in path for lod in LODs):
         raise Exception("This file is already triplicated!")
 
-    abspath = pathlib.Path(path)
+    abspath = pathlib.Path(ctx.working_path, path)
     if not abspath.exists():
         raise Exception(f"Path {path} not found in the working directory")
 
+    if ratios:
+        decimate_lods(ctx, path, parse_lod_ratios(ratios))
+        return
+
     extension = path[-3:]
     base_name = path[:-4]
     target_names = [f"{base_name}{lod}.{extension}" for lod in LODs]
     for target_name in target_names:
-        copy(ctx.working_path, ctx.working_path, path, target_name)
+        copy(ctx.working_path, ctx.working_path, path, target_name, stage=True)
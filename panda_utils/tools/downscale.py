@@ -1,17 +1,177 @@
+from __future__ import annotations
+
+import dataclasses
 import fnmatch
+import hashlib
+import json
 import logging
-import shutil
-import pathlib
+import multiprocessing
 import os
+import pathlib
+import shutil
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
 try:
+    import numpy as np
     from PIL import Image
 except ImportError:
-    Image = None
+    np = Image = None
 
+from panda_utils import staging, util
 from panda_utils.util import Context
 
 logger = logging.getLogger("panda_utils.downscale")
+# Pillow first shrinks by an integer factor while the image stays this many times larger than the target
+REDUCING_GAP = 3.0
+
+
+@dataclasses.dataclass
+class DownscaleOptions:
+    scale: int
+    force: bool = False
+    bbox: int = -1
+    truecenter: bool = True
+    ignore_current_scale: bool = False
+    pattern: str | None = None
+
+    def get_cache_key(self, source_hash: str) -> str:
+        data = {"version": 1, "source": source_hash, **dataclasses.asdict(self)}
+        return hashlib.blake2b(json.dumps(data, sort_keys=True).encode("utf-8"), digest_size=20).hexdigest()
+
+
+def get_bbox(pixels: np.ndarray) -> tuple[int, int, int, int] | None:
+    """
+    Same as Image.getbbox: the box of the non-zero pixels, only looking at the alpha channel when there is one.
+    """
+    if pixels.ndim == 3:
+        pixels = pixels[..., -1] if pixels.shape[2] in (2, 4) else pixels.any(axis=2)
+    rows, columns = np.flatnonzero(pixels.any(axis=1)), np.flatnonzero(pixels.any(axis=0))
+    if not rows.size:
+        return None
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def pad_to_square(pixels: np.ndarray, truecenter: bool) -> np.ndarray:
+    """
+    Adds space around the image, centering it horizontally, but pushing it to the bottom vertically
+    unless truecenter is set.
+    """
+    height, width = pixels.shape[:2]
+    if width > height and not truecenter:
+        canvas = np.zeros((width, width, pixels.shape[2]), pixels.dtype)
+        canvas[width - height :] = pixels
+        return canvas
+
+    # pixel-perfect operations moment
+    height_delta = (height + width) % 2
+    size = max(height, width) + height_delta
+    offset = (size - min(height, width)) // 2
+    canvas = np.zeros((size, size, pixels.shape[2]), pixels.dtype)
+    if height > width:
+        canvas[height_delta:, offset : offset + width] = pixels
+    else:
+        canvas[offset : offset + height, height_delta:] = pixels
+    return canvas
+
+
+def backup_image(source: str, backup_folder: str, source_hash: str) -> None:
+    """
+    Keeps a copy of the source before it is overwritten. The first version keeps the original name,
+    later versions get the content hash in their name, so the same contents are never backed up twice.
+    """
+    name = os.path.basename(source)
+    backup_path = os.path.join(backup_folder, name)
+    if os.path.exists(backup_path):
+        if util.hash_file(backup_path) == source_hash:
+            return
+        stem, ext = name.rsplit(".", 1)
+        backup_path = os.path.join(backup_folder, f"{stem}-{source_hash[:16]}.{ext}")
+        if os.path.exists(backup_path):
+            return
+    shutil.copy(source, backup_path)
+
+
+def store_cached_image(source: str, cache_path: str) -> None:
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    # The cache must never share its data with the image, which may be modified later
+    staging.stage_file(source, temp_path, staging.StagingMode.REFLINK)
+    os.replace(temp_path, cache_path)
+
+
+def downscale_image(
+    source: str, backup_folder: str | None, options: DownscaleOptions, cache_folder: str | None = None
+) -> tuple[str, float]:
+    """
+    Rescales a single image in place. Runs in the worker processes, so the result is only a message for the parent
+    to log, together with the time it took.
+    With a cache folder, the result of a previous run on the same contents with the same options is restored instead.
+    """
+    start = time.perf_counter()
+    name = os.path.basename(source)
+    scale = options.scale
+    source_hash = cache_path = None
+    if cache_folder is not None or backup_folder is not None:
+        source_hash = util.hash_file(source)
+    if cache_folder is not None:
+        cache_path = os.path.join(cache_folder, f"{options.get_cache_key(source_hash)}.png")
+        if os.path.exists(cache_path):
+            if backup_folder is not None:
+                backup_image(source, backup_folder, source_hash)
+            staging.stage_file(cache_path, source, staging.StagingMode.REFLINK)
+            # Marks the entry as used, the composer prunes the entries that were not used for a while
+            os.utime(cache_path)
+            return f"Restored {name} from the cache", time.perf_counter() - start
+
+    with Image.open(source) as img:
+        img.load()
+    if not options.ignore_current_scale and img.width == scale and img.height == scale:
+        return f"Skipping {name} as it is already resized", time.perf_counter() - start
+
+    if backup_folder is not None:
+        backup_image(source, backup_folder, source_hash)
+
+    pixels = None
+    if options.bbox >= 0:
+        box = get_bbox(np.asarray(img))
+        pixels = np.asarray(img.convert("RGBA"))
+        if box is None:
+            return f"Skipping {name} as it is fully transparent", time.perf_counter() - start
+        left, top, right, bottom = box
+        bbox_w, bbox_h = (right - left) * options.bbox // 100, (bottom - top) * options.bbox // 100
+        canvas = np.zeros((bottom - top + 2 * bbox_h, right - left + 2 * bbox_w, 4), np.uint8)
+        canvas[bbox_h : bbox_h + bottom - top, bbox_w : bbox_w + right - left] = pixels[top:bottom, left:right]
+        pixels = canvas
+
+    height, width = pixels.shape[:2] if pixels is not None else (img.height, img.width)
+    if width != height:
+        if not options.force and options.bbox == -1:
+            return f"Skipping {name} due to invalid size: width {width}, height {height}", time.perf_counter() - start
+
+        pixels = pad_to_square(pixels if pixels is not None else np.asarray(img.convert("RGBA")), options.truecenter)
+
+    if pixels is not None:
+        img = Image.fromarray(pixels, "RGBA")
+    if img.width < scale:
+        message = f"Skipping {name} due to size {img.width} being smaller than the target {scale}"
+        return message, time.perf_counter() - start
+
+    staging.detach(source, keep_contents=False)
+    img.resize((scale, scale), reducing_gap=REDUCING_GAP).save(source)
+    if cache_path is not None:
+        store_cached_image(source, cache_path)
+    return f"Rescaled {name}", time.perf_counter() - start
+
+
+def _downscale_job(job):
+    return downscale_image(*job)
+
+
+def make_executor(workers: int) -> Executor:
+    # The warm pipeline workers are daemonic and cannot start processes, Pillow releases the GIL for the heavy parts
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(workers)
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
 
 
 def downscale(
@@ -22,8 +182,10 @@ def downscale(
     bbox: int = -1,
     truecenter: bool = True,
     ignore_current_scale: bool = False,
-    pattern: str = None,
+    pattern: str | None = None,
     do_backup: bool = True,
+    workers: int | None = None,
+    cache_folder: str | None = None,
 ) -> None:
     if Image is None:
         logger.error("Install PIL to use downscaler: pip install panda_utils[imagery]")
@@ -31,68 +193,28 @@ def downscale(
 
     original_path = f"{ctx.working_path}/{path}"
 
-    backup_path = f"{ctx.working_path}/backup/{path}-{scale}"
+    backup_path = None
     if do_backup:
-        backup_obj = pathlib.Path(backup_path)
-        backup_obj.mkdir(exist_ok=True, parents=True)
+        backup_path = f"{ctx.working_path}/backup/{path}-{scale}"
+        pathlib.Path(backup_path).mkdir(exist_ok=True, parents=True)
 
     files = os.listdir(original_path)
-    files = [file for file in files if file.endswith(".png")]
+    files = sorted(file for file in files if file.endswith(".png"))
     if pattern:
         files = [file for file in files if fnmatch.fnmatch(file, pattern)]
-    for x in files:
-        img = Image.open(f"{original_path}/{x}")
-        if not ignore_current_scale and img.width == scale and img.height == scale:
-            logger.info("Skipping %s as it is already resized", x)
-            continue
-
-        if do_backup:
-            if not os.path.exists(f"{backup_path}/{x}"):
-                shutil.copy(f"{original_path}/{x}", f"{backup_path}/{x}")
-            else:
-                name, ext = x.rsplit(".", 1)
-                index = 1
-                while os.path.exists(f"{backup_path}/{name}-{index}.{ext}"):
-                    index += 1
-                shutil.copy(f"{original_path}/{x}", f"{backup_path}/{name}-{index}.{ext}")
-
-        if bbox >= 0:
-            left, top, right, bottom = img.getbbox()
-            bbox_w, bbox_h = (right - left) * bbox // 100, (bottom - top) * bbox // 100
-            needed_width = right - left + bbox_w
-            needed_height = bottom - top + bbox_h
-            needed_size = max(needed_width, needed_height) * 2
-            canvas = Image.new("RGBA", (needed_size, needed_size), (0, 0, 0, 0))
-            canvas.paste(img.crop((left, top, right, bottom)), (bbox_w, bbox_h))
-            img = canvas.crop((0, 0, right - left + 2 * bbox_w, bottom - top + 2 * bbox_h))
-
-        if img.width != img.height:
-            if not force and bbox == -1:
-                logger.info("Skipping %s due to invalid size: width %d, height %d", x, img.width, img.height)
-                continue
-
-            # if we are asked to force downscale, try to add space, and center the image horizontally
-            # but push it to the bottom vertically
-            logger.info("Force mode active, trying to add space...")
-            if img.width > img.height and not truecenter:
-                img2 = Image.new("RGBA", (img.width, img.width))
-                img2.paste(img, (0, img.width - img.height, img.width, img.width))
-            else:
-                # pixel-perfect operations moment
-                height_delta = (img.height + img.width) % 2
-                fh, fw = max(img.height, img.width), min(img.height, img.width)
-                even_fheight = fh + height_delta
-                img2 = Image.new("RGBA", (even_fheight, even_fheight))
-                x_coord = (even_fheight - fw) // 2
-                if fh == img.height:
-                    img2.paste(img, (x_coord, height_delta, even_fheight - x_coord, even_fheight))
-                else:
-                    img2.paste(img, (height_delta, x_coord, even_fheight, even_fheight - x_coord))
-            img = img2
-
-        if img.width < scale:
-            logger.info("Skipping %s due to size %d being smaller than the target %d", x, img.width, scale)
-            continue
-
-        logger.info("Rescaling %s", x)
-        img.resize((scale, scale)).save(f"{original_path}/{x}")
+
+    if cache_folder is not None:
+        cache_folder = str(cache_folder)
+        os.makedirs(cache_folder, exist_ok=True)
+
+    options = DownscaleOptions(int(scale), force, int(bbox), truecenter, ignore_current_scale, pattern)
+    jobs = [(f"{original_path}/{file}", backup_path, options, cache_folder) for file in files]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        results = [_downscale_job(job) for job in jobs]
+    else:
+        with make_executor(workers) as pool:
+            results = list(pool.map(_downscale_job, jobs))
+
+    for message, elapsed in results:
+        logger.info("%s (%.1f ms)", message, elapsed * 1000)
@@ -1,21 +1,34 @@
+from __future__ import annotations
+
+import hashlib
+import json
 import logging
 import os
 import pathlib
 import shutil
+from collections.abc import Iterable
+from dataclasses import dataclass
 
-from panda_utils import util
-from panda_utils.eggtree import eggparse
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
 
-logger = logging.getLogger("panda_utils.palettize")
+from panda_utils import staging, util
+from panda_utils.eggtree import cards, eggparse, geometry
 
+logger = logging.getLogger("panda_utils.palettize")
+# The same texture attributes that the `force-rgba dual linear` TXA line used to apply
+PALETTE_SCALARS = {"format": "rgba", "minfilter": "linear", "magfilter": "linear", "alpha": "dual"}
+UV_EPSILON = 1e-3
 
-def remove_palette_indices(egg_path):
-    with open(egg_path) as f:
-        data = f.readlines()
 
-    eggtree = eggparse.egg_tokenize(data)
-    all_groups = eggtree.findall("Group")
-    for group in all_groups:
+def strip_palette_indices(eggtree: eggparse.EggTree) -> None:
+    """
+    Removes the ordering prefixes (`0-name`) from the group names.
+    """
+    for group in eggtree.findall("Group"):
         if "-" not in group.node_name:
             continue
 
@@ -27,16 +40,464 @@ def remove_palette_indices(egg_path):
         else:
             group.node_name = name_split[1]
 
+
+def remove_palette_indices(egg_path):
+    with open(egg_path) as f:
+        data = f.readlines()
+
+    eggtree = eggparse.egg_tokenize(data)
+    strip_palette_indices(eggtree)
+    staging.detach(egg_path, keep_contents=False)
     with open(egg_path, "w") as f:
         f.write(str(eggtree))
 
 
+@dataclass
+class PalettePlacement:
+    page: int
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class MaxRectsBin:
+    """
+    MaxRects bin packing with the best short side fit heuristic. Rectangles are never rotated.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+
+    def find_position(self, width: int, height: int) -> tuple[int, int] | None:
+        best = None
+        for fx, fy, fw, fh in self.free:
+            if width <= fw and height <= fh:
+                score = (min(fw - width, fh - height), max(fw - width, fh - height), fy, fx)
+                if best is None or score < best[0]:
+                    best = (score, fx, fy)
+        return None if best is None else best[1:]
+
+    def place(self, x: int, y: int, width: int, height: int) -> None:
+        free = []
+        for fx, fy, fw, fh in self.free:
+            if x >= fx + fw or x + width <= fx or y >= fy + fh or y + height <= fy:
+                free.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:
+                free.append((x + width, fy, fx + fw - x - width, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:
+                free.append((fx, y + height, fw, fy + fh - y - height))
+
+        def contains(outer, inner):
+            return (
+                outer[0] <= inner[0]
+                and outer[1] <= inner[1]
+                and outer[0] + outer[2] >= inner[0] + inner[2]
+                and outer[1] + outer[3] >= inner[1] + inner[3]
+            )
+
+        unique = sorted(set(free), key=lambda rect: (rect[1], rect[0], rect[2], rect[3]))
+        self.free = [
+            rect
+            for i, rect in enumerate(unique)
+            if not any(j != i and contains(other, rect) for j, other in enumerate(unique))
+        ]
+
+
+def next_power_of_two(value: int) -> int:
+    return 1 << max(0, value - 1).bit_length()
+
+
+def pack_page(items: list[tuple[str, int, int]], width: int, height: int):
+    """
+    Packs as many items (name, width, height) as possible into a single page, returns the positions and the leftovers.
+    """
+    page = MaxRectsBin(width, height)
+    positions, leftovers = {}, []
+    for name, item_width, item_height in items:
+        position = page.find_position(item_width, item_height)
+        if position is None:
+            leftovers.append((name, item_width, item_height))
+        else:
+            page.place(*position, item_width, item_height)
+            positions[name] = position
+    return positions, leftovers
+
+
+class Palette:
+    """
+    The placement of a set of images on one or more palette pages.
+    """
+
+    def __init__(
+        self, name: str, margin: int, pages: dict[int, tuple[int, int]], placements: dict[str, PalettePlacement]
+    ):
+        self.name = name
+        self.margin = margin
+        self.pages = pages
+        self.placements = placements
+
+    @classmethod
+    def pack(cls, name: str, sizes: dict[str, tuple[int, int]], palette_size: int, margin: int) -> Palette:
+        """
+        Packs the images into pages of at most palette_size, every page is shrunk to the smallest power of two.
+        The result only depends on the names and the sizes of the images.
+        """
+        items = []
+        for image, (width, height) in sorted(sizes.items()):
+            item_width, item_height = width + 2 * margin, height + 2 * margin
+            if item_width > palette_size or item_height > palette_size:
+                logger.warning("%s does not fit into a %dpx palette, leaving it out", image, palette_size)
+                continue
+            items.append((image, item_width, item_height))
+        items.sort(key=lambda item: (-max(item[1], item[2]), -item[1] * item[2], item[0]))
+
+        pages, placements = {}, {}
+        while items:
+            positions, leftovers = pack_page(items, palette_size, palette_size)
+            if not leftovers:
+                # This is the last page, find the smallest power of two page that still holds all the images
+                area = sum(width * height for _, width, height in items)
+                powers = [1 << power for power in range(palette_size.bit_length())]
+                sizes_to_try = sorted(
+                    ((width, height) for width in powers for height in powers if width * height >= area),
+                    key=lambda size: (size[0] * size[1], max(size), size[0]),
+                )
+                for width, height in sizes_to_try:
+                    smaller_positions, smaller_leftovers = pack_page(items, width, height)
+                    if not smaller_leftovers:
+                        positions = smaller_positions
+                        break
+
+            dimensions = {name: (width, height) for name, width, height in items}
+            page_width = next_power_of_two(max(x + dimensions[name][0] for name, (x, y) in positions.items()))
+            page_height = next_power_of_two(max(y + dimensions[name][1] for name, (x, y) in positions.items()))
+            for image, (x, y) in positions.items():
+                width, height = dimensions[image]
+                placements[image] = PalettePlacement(len(pages), x, y, width - 2 * margin, height - 2 * margin)
+            pages[len(pages)] = (page_width, page_height)
+            items = leftovers
+
+        return cls(name, margin, pages, placements)
+
+    def page_name(self, page: int) -> str:
+        return f"{self.name}_palette_4allc_{page + 1}.png"
+
+    def uv_transform(self, image: str) -> tuple[float, float, float, float]:
+        """
+        Returns the scale and the offset that map the UVs of the image into its palette page.
+        """
+        placement = self.placements[image]
+        page_width, page_height = self.pages[placement.page]
+        scale_u, scale_v = placement.width / page_width, placement.height / page_height
+        offset_u = (placement.x + self.margin) / page_width
+        offset_v = 1 - (placement.y + self.margin + placement.height) / page_height
+        return scale_u, scale_v, offset_u, offset_v
+
+    def images_on_page(self, page: int) -> list[str]:
+        return sorted(image for image, placement in self.placements.items() if placement.page == page)
+
+    def subset(self, images: dict[str, str]) -> Palette:
+        """
+        Returns the placement of some of the images (renamed through the images dict), and only the pages they are on.
+        """
+        placements = {new_name: self.placements[image] for new_name, image in images.items()}
+        pages = {page: self.pages[page] for page in sorted({placement.page for placement in placements.values()})}
+        return Palette(self.name, self.margin, pages, placements)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "margin": self.margin,
+            "pages": {str(page): list(size) for page, size in self.pages.items()},
+            "placements": {
+                image: [placement.page, placement.x, placement.y, placement.width, placement.height]
+                for image, placement in sorted(self.placements.items())
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Palette:
+        pages = {int(page): tuple(size) for page, size in data["pages"].items()}
+        placements = {image: PalettePlacement(*values) for image, values in data["placements"].items()}
+        return cls(data["name"], data["margin"], pages, placements)
+
+    def save_page(self, page: int, sources: dict[str, pathlib.Path], target_folder) -> pathlib.Path:
+        """
+        Writes a single palette page, the margins are filled by repeating the edge pixels of every image.
+        """
+        width, height = self.pages[page]
+        page_data = np.zeros((height, width, 4), dtype=np.uint8)
+        for image in self.images_on_page(page):
+            placement = self.placements[image]
+            with Image.open(sources[image]) as img:
+                data = np.asarray(img.convert("RGBA"))
+            margin = self.margin
+            if margin:
+                data = np.pad(data, ((margin, margin), (margin, margin), (0, 0)), mode="edge")
+            x, y = placement.x, placement.y
+            page_data[y : y + data.shape[0], x : x + data.shape[1]] = data
+
+        target = pathlib.Path(target_folder, self.page_name(page))
+        staging.detach(target, keep_contents=False)
+        Image.fromarray(page_data).save(target)
+        return target
+
+    def save(self, source_folder, target_folder) -> list[str]:
+        sources = {image: pathlib.Path(source_folder, image) for image in self.placements}
+        return [self.save_page(page, sources, target_folder).name for page in self.pages]
+
+
+def read_image_sizes(folder, images: Iterable[str]) -> dict[str, tuple[int, int]]:
+    sizes = {}
+    for image in images:
+        # Only the header is read here
+        with Image.open(pathlib.Path(folder, image)) as img:
+            sizes[image] = img.size
+    return sizes
+
+
+class TextureResolver:
+    """
+    Matches the texture paths of the egg files with the images that can be palettized.
+    """
+
+    def __init__(self, folder, images: Iterable[str]):
+        self.folder = pathlib.Path(folder)
+        self.by_path, by_name = {}, {}
+        for image in images:
+            self.by_path[os.path.normcase(os.path.normpath(self.folder / image))] = image
+            by_name.setdefault(pathlib.Path(image).name, []).append(image)
+        self.by_name = {name: matches[0] for name, matches in by_name.items() if len(matches) == 1}
+
+    def resolve(self, filename: str) -> str | None:
+        path = os.path.normcase(os.path.normpath(self.folder / filename))
+        if path in self.by_path:
+            return self.by_path[path]
+        return self.by_name.get(pathlib.PurePosixPath(filename.replace("\\", "/")).name)
+
+
+def get_palette_textures(tree, resolver: TextureResolver) -> dict[str, tuple[eggparse.EggBranch, str]]:
+    """
+    Returns the textures of the tree that can be moved into a palette, as name -> (texture node, image).
+    """
+    textures = {}
+    for texture in tree.findall("Texture"):
+        image = resolver.resolve(eggparse.sanitize_string(texture.get_child(0).value))
+        if image is None:
+            continue
+        if geometry.get_child_nodes(texture, "Transform") or geometry.get_scalar(texture, "alpha-file"):
+            logger.info("%s uses a texture transform or a separate alpha file, leaving it out", image)
+            continue
+        textures[texture.node_name] = (texture, image)
+    return textures
+
+
+def find_unpalettizable_images(tree, textures: dict[str, tuple[eggparse.EggBranch, str]]) -> set:
+    """
+    Returns the images with UVs outside the [0, 1] range (repeating textures), or UV sets shared with other images,
+    as these can not be moved into a palette.
+    """
+    vertices = geometry.get_vertex_pools(tree)
+    uv_names = {name: geometry.get_scalar(texture, "uv-name") for name, (texture, _) in textures.items()}
+    rejected = set()
+    for primitive in geometry.find_primitives(tree):
+        used = {}
+        for tref in geometry.get_trefs(primitive):
+            if tref not in textures:
+                continue
+            image = textures[tref][1]
+            if used.setdefault(uv_names[tref], image) != image:
+                rejected.update({image, used[uv_names[tref]]})
+
+        if not used:
+            continue
+        _, indices, pool = geometry.get_primitive_vertices(primitive)
+        for index in indices:
+            for uv_name, image in used.items():
+                uv = geometry.get_uv(vertices[pool][index], uv_name)
+                if uv is None or not all(-UV_EPSILON <= value <= 1 + UV_EPSILON for value in uv[:2]):
+                    rejected.add(image)
+    return rejected
+
+
+def apply_palette(
+    tree, palette: Palette, textures: dict[str, tuple[eggparse.EggBranch, str]], texture_folder: str = "", scalars=None
+) -> None:
+    """
+    Points the textures at their palette pages and moves the UVs into the palette.
+    Vertices shared between primitives that end up in different places of the palette are duplicated.
+    """
+    textures = {name: value for name, value in textures.items() if value[1] in palette.placements}
+    uv_names = {name: geometry.get_scalar(texture, "uv-name") for name, (texture, _) in textures.items()}
+    duplicator = geometry.VertexDuplicator(tree)
+    claimed, copies = {}, {}
+    for primitive in geometry.find_primitives(tree):
+        used = {}
+        for tref in geometry.get_trefs(primitive):
+            if tref in textures:
+                used.setdefault(uv_names[tref], textures[tref][1])
+        key = tuple(sorted(used.items(), key=lambda item: item[0] or ""))
+
+        ref, indices, pool = geometry.get_primitive_vertices(primitive)
+        new_indices = []
+        for index in indices:
+            owner = claimed.setdefault((pool, index), key)
+            if owner != key:
+                if (pool, index, key) not in copies:
+                    new_index = copies[(pool, index, key)] = duplicator.duplicate(pool, index)
+                    claimed[(pool, new_index)] = key
+                index = copies[(pool, index, key)]
+            new_indices.append(index)
+        if new_indices != indices:
+            geometry.set_vertex_ref(ref, new_indices)
+    duplicator.finish()
+
+    transforms = {image: palette.uv_transform(image) for image in palette.placements}
+    for (pool, index), key in claimed.items():
+        vertex = duplicator.vertices[pool][index]
+        for uv_name, image in key:
+            scale_u, scale_v, offset_u, offset_v = transforms[image]
+            u, v, *rest = geometry.get_uv(vertex, uv_name)
+            geometry.set_uv(vertex, [offset_u + u * scale_u, offset_v + v * scale_v, *rest], uv_name)
+
+    for texture, image in textures.values():
+        page = palette.page_name(palette.placements[image].page)
+        texture.get_child(0).value = eggparse.EggNode.convert_string_to_egg(
+            f"{texture_folder}/{page}" if texture_folder else page
+        )
+        for name, value in (scalars or PALETTE_SCALARS).items():
+            geometry.set_scalar(texture, name, value)
+
+
+def get_palette_cache_key(folder, images: Iterable[str], name: str, palette_size: int, margin: int) -> str:
+    """
+    The palette only depends on the contents of the images and the options, not on the geometry that uses them.
+    """
+    data = {
+        "version": 1,
+        "name": name,
+        "palette_size": palette_size,
+        "margin": margin,
+        "images": {image: util.hash_file(pathlib.Path(folder, image)) for image in sorted(images)},
+    }
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode("utf-8"), digest_size=20).hexdigest()
+
+
+def load_cached_palette(cache_path: pathlib.Path, target_folder) -> Palette | None:
+    """
+    Stages the pages of a cached palette into the target folder, and returns the placements.
+    The pages are never hardlinked, since the files in the target folder may be modified later.
+    """
+    manifest = cache_path / "palette.json"
+    if not manifest.exists():
+        return None
+
+    with open(manifest) as f:
+        palette = Palette.from_dict(json.load(f))
+    # Marks the entry as used, the composer prunes the entries that were not used for a while
+    os.utime(cache_path)
+    staging.stage_files(
+        (
+            (cache_path / palette.page_name(page), pathlib.Path(target_folder, palette.page_name(page)))
+            for page in palette.pages
+        ),
+        staging.StagingMode.REFLINK,
+    )
+    return palette
+
+
+def store_cached_palette(cache_path: pathlib.Path, palette: Palette, target_folder) -> None:
+    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temp_path, ignore_errors=True)
+    temp_path.mkdir(parents=True)
+    for page in palette.pages:
+        page_name = palette.page_name(page)
+        staging.stage_file(pathlib.Path(target_folder, page_name), temp_path / page_name, staging.StagingMode.REFLINK)
+    with open(temp_path / "palette.json", "w") as f:
+        json.dump(palette.to_dict(), f, indent=2)
+
+    try:
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # Another process stored the same palette first
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def palettize_trees(
+    trees: Iterable[eggparse.EggTree],
+    folder,
+    images: Iterable[str],
+    name: str,
+    palette_size: int = 1024,
+    margin: int = 5,
+    target_folder=None,
+    texture_folder: str = "",
+    scalars=None,
+    cache_folder=None,
+) -> list[str]:
+    """
+    Moves the images used by the trees into palette pages, and remaps the trees to use them.
+    The images are read from the folder, the pages are written into target_folder (the same folder by default).
+    With a cache folder, the pages of a previous run with the same images and options are reused as they are.
+    Returns the file names of the pages.
+    """
+    if Image is None:
+        raise RuntimeError("Install PIL and NumPy to use the palettizer: pip install panda_utils[imagery]")
+
+    trees = list(trees)
+    resolver = TextureResolver(folder, images)
+    tree_textures = [get_palette_textures(tree, resolver) for tree in trees]
+    rejected = set()
+    for tree, textures in zip(trees, tree_textures):
+        rejected |= find_unpalettizable_images(tree, textures)
+    for image in sorted(rejected):
+        logger.info("%s has UVs outside of the texture, leaving it out of the palette", image)
+
+    used_images = {image for textures in tree_textures for _, image in textures.values()} - rejected
+    if not used_images:
+        logger.warning("No textures could be palettized for %s", name)
+        return []
+
+    target_folder = target_folder or folder
+    palette = cache_path = None
+    if cache_folder is not None:
+        cache_path = pathlib.Path(cache_folder, get_palette_cache_key(folder, used_images, name, palette_size, margin))
+        palette = load_cached_palette(cache_path, target_folder)
+        if palette is not None:
+            logger.info("Reusing the cached palette pages of %s", name)
+
+    if palette is None:
+        palette = Palette.pack(name, read_image_sizes(folder, sorted(used_images)), palette_size, margin)
+        palette.save(folder, target_folder)
+        logger.info("Packed %d textures into %d palette pages", len(palette.placements), len(palette.pages))
+        if cache_path is not None:
+            store_cached_palette(cache_path, palette, target_folder)
+
+    for tree, textures in zip(trees, tree_textures):
+        apply_palette(tree, palette, textures, texture_folder, scalars)
+    return [palette.page_name(page) for page in palette.pages]
+
+
 def palettize(
-    ctx: util.Context, output: str, phase: str, subdir: str, poly: int = None, margin: int = 0, ordered: bool = False
+    ctx: util.Context,
+    output: str,
+    phase: str,
+    subdir: str,
+    poly: int | None = None,
+    margin: int = 0,
+    ordered: bool = False,
 ) -> None:
     map_path, model_path = f"{phase}/maps", f"{phase}/models/{subdir}"
-    pathlib.Path(map_path).mkdir(exist_ok=True, parents=True)
-    pathlib.Path(model_path).mkdir(exist_ok=True, parents=True)
+    pathlib.Path(ctx.working_path, map_path).mkdir(exist_ok=True, parents=True)
+    pathlib.Path(ctx.working_path, model_path).mkdir(exist_ok=True, parents=True)
 
     file_list = set(util.get_file_list(ctx.resources_path, f"{map_path}/{output}"))
     existing_file_list = set(util.get_file_list(ctx.working_path, f"{map_path}/{output}"))
@@ -44,54 +505,36 @@ def palettize(
     for x in file_list:
         if not os.path.exists(f"{ctx.working_path}/{map_path}/{output}/{x}"):
             shutil.copy(f"{ctx.resources_path}/{map_path}/{output}/{x}", f"{ctx.working_path}/{map_path}/{output}/{x}")
-    logger.info("Running egg-texture-cards...")
+    logger.info("Making texture cards...")
     egg_path = f"{model_path}/{output}.egg"
     union = file_list.union(existing_file_list)
-    args = ["-o", egg_path]
-    if poly:
-        args += ["-p", f"{poly},{poly}"]
-    args += [f"{map_path}/{output}/{x}" for x in union]
-    util.run_panda(ctx, "egg-texture-cards", *args)
-
-    logger.info("Creating a TXA file...")
-    # txa_text = self.create_txa(2048, file_list)
-    txa_text = (
-        ":palette 2048 2048\n"
-        ":imagetype png\n"
-        ":powertwo 1\n"
-        f":group {output} dir {phase}/maps\n"
-        f"*.png : force-rgba dual linear clamp_u clamp_v margin {margin}\n"
-    )
-    with open("textures.txa", "w") as txa_file:
-        txa_file.write(txa_text)
+    images = [f"{map_path}/{output}/{x}" for x in sorted(union)]
+    pixel_size = (int(poly), int(poly)) if poly else None
+    sizes = read_image_sizes(ctx.working_path, images) if pixel_size else None
+    eggtree = cards.make_texture_cards(images, sizes, pixel_size)
 
     logger.info("Palettizing...")
-    util.run_panda(
-        ctx,
-        "egg-palettize",
-        "-opt",
-        "-redo",
-        "-noabs",
-        "-nodb",
-        "-inplace",
-        egg_path,
-        "-dm",
-        map_path,
-        "-tn",
-        f"mk2_{output}_palette_%p_%i",
-        timeout=60,
+    scalars = {**PALETTE_SCALARS, "wrapu": "clamp", "wrapv": "clamp"}
+    palettize_trees(
+        [eggtree],
+        ctx.working_path,
+        images,
+        f"mk2_{output}",
+        2048,
+        margin,
+        target_folder=f"{ctx.working_path}/{map_path}",
+        texture_folder=map_path,
+        scalars=scalars,
     )
-    logger.info("Transforming eggs...")
-    util.run_panda(ctx, "egg-trans", egg_path, "-pc", map_path, "-o", egg_path)
 
     if ordered:
         logger.info("Removing ordering indices from the egg...")
-        remove_palette_indices(egg_path)
+        strip_palette_indices(eggtree)
+
+    staging.detach(f"{ctx.working_path}/{egg_path}", keep_contents=False)
+    with open(f"{ctx.working_path}/{egg_path}", "w") as f:
+        f.write(str(eggtree))
 
     logger.info("Converting to BAM...")
     util.run_panda(ctx, "egg2bam", egg_path, "-o", egg_path.replace(".egg", ".bam"), timeout=10)
-    logger.info("Cleaning up...")
-    shutil.rmtree(f"{model_path}/{phase}", ignore_errors=True)  # happens due to a bug
-    # os.unlink(egg_path)
-    os.unlink("textures.txa")
     logger.info("Palettizing complete.")
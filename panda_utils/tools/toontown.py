@@ -1,19 +1,18 @@
 import logging
 
 from panda_utils import util
-from panda_utils.eggtree import eggparse, operations
+from panda_utils.eggtree import eggparse, operations, optchar
 from panda_utils.tools import convert
 
 logger = logging.getLogger("panda_utils.toontown")
 
 
 def toon_head(ctx: util.Context, path: str, triplicate: bool = False) -> None:
-    util.run_panda(ctx, "egg-optchar", "-keepall", "-inplace", "-dart", "structured", path)
-
     with open(f"{ctx.working_path}/{path}") as f:
         data = f.readlines()
 
     eggtree = eggparse.egg_tokenize(data)
+    optchar.set_dart_type(eggtree, "structured")
     operations.set_texture_prefix(eggtree, f"{util.toon_head_phase}/maps")
 
     nodes_for_removal = (
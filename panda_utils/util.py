@@ -1,13 +1,22 @@
-import shutil
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import hashlib
 import importlib.resources
 import logging
 import os
 import pathlib
-import subprocess
 import re
+import shutil
+import subprocess
 import sys
+import threading
+import time
+from collections.abc import Awaitable, Iterable
+from contextlib import contextmanager
 from enum import Enum
-from typing import List
+from typing import Callable
 
 logger = logging.getLogger("panda_utils.palettize")
 
@@ -49,7 +58,7 @@ class Context:
         self.regex_collection = RegexCollection()
 
     @classmethod
-    def from_config(cls, cfg: dict) -> "Context":
+    def from_config(cls, cfg: dict) -> Context:
         obj = cls()
         obj.working_path = os.getcwd()
         cfg_paths = cfg.get("paths", {})
@@ -78,7 +87,7 @@ class Context:
         return obj
 
 
-def get_file_list(init_path: str, base_path: str) -> List[str]:
+def get_file_list(init_path: str, base_path: str) -> list[str]:
     path = f"{init_path}/{base_path}"
     if not os.path.exists(path):
         return []
@@ -104,18 +113,179 @@ def choose_binary(*filename):
         raise RuntimeError(f"Unable to find binary (not on PATH): {filename}")
 
 
-def run_panda(ctx: Context, command: str, *args: str, timeout: int = 10, debug: bool = False) -> str:
-    process = subprocess.Popen(
-        [choose_binary(ctx.panda_path, command), *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+class SubprocessStats:
+    """
+    Counts the external tools (Panda3D, Blender) that were started by this process, and the time spent waiting on them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.wall_time = 0.0
+
+    def record(self, wall_time: float) -> None:
+        with self.lock:
+            self.count += 1
+            self.wall_time += wall_time
+
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return self.count, self.wall_time
+
+
+subprocess_stats = SubprocessStats()
+# The stats of the count_subprocesses blocks the current thread or asyncio task is in
+_context_stats = contextvars.ContextVar("context_stats", default=())
+
+
+@contextmanager
+def count_subprocesses():
+    """
+    Counts the external tools started from the current thread or asyncio task (and the tasks it creates)
+    while in the block, unlike subprocess_stats, which counts every one started by the process.
+    """
+    stats = SubprocessStats()
+    token = _context_stats.set((*_context_stats.get(), stats))
+    try:
+        yield stats
+    finally:
+        _context_stats.reset(token)
+
+
+@contextmanager
+def track_subprocess():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start
+        subprocess_stats.record(wall_time)
+        for stats in _context_stats.get():
+            stats.record(wall_time)
+
+
+def run_panda(
+    ctx: Context, command: str, *args: str, timeout: int = 10, debug: bool = False, missing_textures: list | None = None
+) -> str:
+    """
+    Runs a Panda3D tool and returns its stderr. Textures that the tool was unable to read are appended
+    to missing_textures.
+    """
+    return asyncio.run(
+        run_panda_async(ctx, command, *args, timeout=timeout, debug=debug, missing_textures=missing_textures)
     )
-    out = process.communicate(timeout=timeout)
-    bts = out[1] if isinstance(out, tuple) else out
-    out_str = bts.decode("utf-8")
-    if process.returncode or debug or get_debug(LoggingScope.PANDA3D):
+
+
+async def stream_process(
+    args: list[str],
+    *,
+    cwd=None,
+    timeout: float | None = None,
+    stdout=subprocess.DEVNULL,
+    capture_stderr: bool = True,
+    line_callback: Callable[[str], None] | None = None,
+) -> tuple[int, str]:
+    """
+    Runs a process without blocking the event loop. If capture_stderr is set, stderr is read line by line
+    as it arrives, every line is passed to line_callback, and the whole output is returned with the exit code.
+    Raises subprocess.TimeoutExpired, like Popen.communicate, if the process does not finish in time.
+    """
+    with track_subprocess():
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=stdout, stderr=subprocess.PIPE if capture_stderr else None, cwd=cwd
+        )
+        lines = []
+
+        async def communicate():
+            if capture_stderr:
+                while line := await process.stderr.readline():
+                    text = line.decode("utf-8", errors="replace")
+                    lines.append(text)
+                    if line_callback is not None:
+                        line_callback(text)
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(args, timeout, stderr="".join(lines).encode("utf-8"))
+    return returncode, "".join(lines)
+
+
+def run_process(args: list[str], **kwargs) -> tuple[int, str]:
+    """
+    The blocking version of stream_process, for the callers that are not running an event loop.
+    """
+    return asyncio.run(stream_process(args, **kwargs))
+
+
+async def run_panda_async(
+    ctx: Context, command: str, *args: str, timeout: int = 10, debug: bool = False, missing_textures: list | None = None
+) -> str:
+    """
+    The asyncio version of run_panda, the missing textures are appended as soon as the tool reports them.
+    """
+
+    def check_line(line):
+        if missing_textures is not None:
+            missing_textures.extend(ctx.regex_collection.not_found.findall(line))
+
+    returncode, out_str = await stream_process(
+        [choose_binary(ctx.panda_path, command), *args],
+        cwd=ctx.working_path,
+        timeout=timeout,
+        line_callback=check_line,
+    )
+    if returncode or debug or get_debug(LoggingScope.PANDA3D):
         logger.warning(out_str)
     return out_str
 
 
+async def run_concurrently(awaitables: Iterable[Awaitable], limit: int | None = None) -> list:
+    """
+    Awaits all of the given awaitables, with at most limit of them running at the same time.
+    The results are returned in the same order as the awaitables.
+    """
+    semaphore = asyncio.Semaphore(limit or os.cpu_count() or 1)
+
+    async def run_one(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(run_one(awaitable) for awaitable in awaitables))
+
+
+def hash_file(path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prune_cache(folder, max_age: float) -> int:
+    """
+    Removes the entries of a cache folder that were not used for max_age seconds, the caches refresh the mtime
+    of an entry whenever they reuse it. Returns the number of removed entries.
+    """
+    if not os.path.isdir(folder):
+        return 0
+
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(folder):
+        if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+        removed += 1
+    return removed
+
+
 def get_data_file_path(filename):
     return importlib.resources.files("panda_utils").joinpath(filename)
 
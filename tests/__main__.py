@@ -1,7 +1,12 @@
 import unittest
 
-from tests.eggtree import *  # noqa: F401
-from tests.pipeline import *  # noqa: F401
+from tests.animconvert import *
+from tests.downscale import *
+from tests.eggtree import *
+from tests.palettize import *
+from tests.pipeline import *
+from tests.staging import *
 from tests.test_base import ImprovedTestLoader
+from tests.util import *
 
 unittest.main(testLoader=ImprovedTestLoader())
@@ -0,0 +1,87 @@
+import pathlib
+import tempfile
+import unittest
+
+from panda_utils.tools import animconvert
+from panda_utils.util import Context
+
+ANIMATION = """<CoordinateSystem> { Z-up }
+
+<Table> {
+  <Bundle> character {
+    <Table> "<skeleton>" {
+      <Table> Hips {
+        <Xfm$Anim_S$> xform {
+          <Scalar> fps { 24 }
+          <S$Anim> x { <V> { 0 1 2 } }
+        }
+        <Table> "Left Leg" {
+          <Xfm$Anim_S$> xform {
+            <Scalar> fps { 24 }
+            <S$Anim> z { <V> { 1 1 1 } }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def read_bam(path):
+    from panda3d.core import BamFile, Filename
+
+    bam = BamFile()
+    bam.open_read(Filename.from_os_specific(str(path)))
+    root = bam.read_object()
+    bam.resolve()
+    bam.close()
+    return root
+
+
+class AnimconvertTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tempdir.name)
+        (self.root / "anims").mkdir()
+        self.ctx = Context()
+        self.ctx.working_path = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_rename_headers(self):
+        renamed = []
+        lines = ANIMATION.splitlines(keepends=True)
+        converted = list(animconvert.rename_table_headers(lines, {"Hips": "Pelvis", "Left Leg": "LeftLeg"}, renamed))
+        self.assertEqual(renamed, ["Hips", "Left Leg"])
+        self.assertIn("      <Table> Pelvis {\n", converted)
+        self.assertIn("        <Table> LeftLeg {\n", converted)
+        # Everything else is copied as it was
+        changed = [index for index, (old, new) in enumerate(zip(lines, converted)) if old != new]
+        self.assertEqual(len(changed), 2)
+
+    def test_rename_bulk_egg(self):
+        for name in ("walk.egg", "run.egg"):
+            (self.root / "anims" / name).write_text(ANIMATION)
+        animconvert.animation_rename_bulk(self.ctx, "anims", "renamed", {"Hips": "Pelvis"}, workers=2)
+        for name in ("walk.egg", "run.egg"):
+            self.assertEqual((self.root / "renamed" / name).read_text(), ANIMATION.replace("Hips", "Pelvis"))
+        # The source files are left alone
+        self.assertEqual((self.root / "anims" / "walk.egg").read_text(), ANIMATION)
+
+    @unittest.skipIf(animconvert.BamFile is None, "requires Panda3D")
+    def test_rename_bam(self):
+        from panda3d.core import Filename, NodePath
+        from panda3d.egg import load_egg_file
+
+        (self.root / "walk.egg").write_text(ANIMATION)
+        node = load_egg_file(Filename.from_os_specific(str(self.root / "walk.egg")))
+        NodePath(node).write_bam_file(Filename.from_os_specific(str(self.root / "anims" / "walk.bam")))
+
+        renamed = animconvert.animation_rename(self.ctx, "anims/walk.bam", "anims/walk.bam", {"Left Leg": "LeftLeg"})
+        self.assertEqual(renamed, ["Left Leg"])
+        node = NodePath(read_bam(self.root / "anims" / "walk.bam"))
+        bundle = node.find("**/+AnimBundleNode").node().get_bundle()
+        names = [group.name for group in animconvert.iterate_anim_groups(bundle)]
+        self.assertEqual(names, ["character", "<skeleton>", "Hips", "LeftLeg"])
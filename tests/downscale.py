@@ -0,0 +1,77 @@
+import os
+import pathlib
+import tempfile
+import unittest
+
+from panda_utils.tools import downscale
+from panda_utils.util import Context
+
+
+@unittest.skipIf(downscale.Image is None, "requires Pillow and NumPy")
+class DownscaleTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tempdir.name)
+        (self.root / "maps").mkdir()
+        self.ctx = Context()
+        self.ctx.working_path = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_bbox_matches_pillow(self):
+        img = downscale.Image.new("RGBA", (40, 30), (255, 255, 255, 0))
+        img.paste((255, 0, 0, 255), (5, 7, 12, 20))
+        self.assertEqual(downscale.get_bbox(downscale.np.asarray(img)), img.getbbox())
+        rgb = img.convert("RGB")
+        self.assertEqual(downscale.get_bbox(downscale.np.asarray(rgb)), rgb.getbbox())
+
+    def test_pad_to_square(self):
+        pixels = downscale.np.ones((3, 6, 4), downscale.np.uint8)
+        bottom = downscale.pad_to_square(pixels, truecenter=False)
+        self.assertEqual(bottom.shape, (6, 6, 4))
+        self.assertEqual(bottom[:3].max(), 0)
+        centered = downscale.pad_to_square(pixels, truecenter=True)
+        self.assertEqual(centered.shape, (7, 7, 4))
+        self.assertEqual(centered[:, 0].max(), 0)
+        self.assertEqual(centered[2:5, 1:].min(), 1)
+        self.assertEqual(centered.sum(), pixels.sum())
+
+    def test_parallel(self):
+        for i in range(3):
+            downscale.Image.new("RGBA", (64, 32 + 32 * (i % 2)), (255, 0, 0, 255)).save(self.root / "maps" / f"{i}.png")
+
+        with self.assertLogs("panda_utils.downscale", "INFO") as logs:
+            downscale.downscale(self.ctx, "maps", 16, workers=2)
+        self.assertIn("Rescaled 1.png", logs.output[1])
+        self.assertIn("invalid size", logs.output[0])
+        with downscale.Image.open(self.root / "maps" / "1.png") as img:
+            self.assertEqual(img.size, (16, 16))
+        self.assertEqual(sorted(os.listdir(self.root / "backup" / "maps-16")), ["0.png", "1.png", "2.png"])
+
+    def test_cache(self):
+        source = self.root / "maps" / "a.png"
+        cache = self.root / "cache"
+        downscale.Image.new("RGBA", (64, 64), (255, 0, 0, 255)).save(source)
+        original = source.read_bytes()
+        downscale.downscale(self.ctx, "maps", 16, cache_folder=cache)
+        rescaled = source.read_bytes()
+
+        source.write_bytes(original)
+        (entry,) = os.listdir(cache)
+        os.utime(cache / entry, (0, 0))
+        with self.assertLogs("panda_utils.downscale", "INFO") as logs:
+            downscale.downscale(self.ctx, "maps", 16, cache_folder=cache)
+        self.assertIn("Restored a.png", logs.output[0])
+        # Restoring the image marks the entry as used, so it is not pruned
+        self.assertNotEqual((cache / entry).stat().st_mtime, 0)
+        self.assertEqual(source.read_bytes(), rescaled)
+        # The same contents are only backed up once
+        self.assertEqual(os.listdir(self.root / "backup" / "maps-16"), ["a.png"])
+
+        downscale.Image.new("RGBA", (64, 64), (0, 255, 0, 255)).save(source)
+        with self.assertLogs("panda_utils.downscale", "INFO") as logs:
+            downscale.downscale(self.ctx, "maps", 16, cache_folder=cache)
+        self.assertIn("Rescaled a.png", logs.output[0])
+        self.assertEqual(len(os.listdir(self.root / "backup" / "maps-16")), 2)
+        self.assertEqual(len(os.listdir(cache)), 2)
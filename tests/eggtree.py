@@ -1,8 +1,40 @@
+import json
 import pathlib
+import re
+import struct
+import tempfile
 import unittest
 
-from panda_utils.eggtree import eggparse
+from panda_utils.eggtree import (
+    animation,
+    cards,
+    cleanup,
+    collision,
+    decimate,
+    eggparse,
+    flatten,
+    geometry,
+    gltf,
+    obj,
+    optchar,
+    tangents,
+    vcache,
+)
 from panda_utils.eggtree.eggparse import EggString, EggBranch, EggLeaf
+from panda_utils.tools import convert
+
+
+def make_glb(document: dict, *arrays: bytes) -> bytes:
+    buffer, views, accessors = b"", [], []
+    for data, accessor in arrays:
+        views.append({"buffer": 0, "byteOffset": len(buffer), "byteLength": len(data)})
+        accessors.append({"bufferView": len(views) - 1, **accessor})
+        buffer += data + b"\0" * (-len(data) % 4)
+    document = {**document, "buffers": [{"byteLength": len(buffer)}], "bufferViews": views, "accessors": accessors}
+    text = json.dumps(document).encode()
+    text += b" " * (-len(text) % 4)
+    header = struct.pack("<4sII", b"glTF", 2, 28 + len(text) + len(buffer))
+    return header + struct.pack("<I4s", len(text), b"JSON") + text + struct.pack("<I4s", len(buffer), b"BIN\0") + buffer
 
 
 class EggtreeTest(unittest.TestCase):
@@ -131,3 +163,480 @@ class EggtreeTest(unittest.TestCase):
         reverted_tree = str(tree)
         self.assertIn("1.0 0.0 0.0 0.0", reverted_tree, "transforms are reverted correctly")
         self.assertNotIn('"1.0 0.0 0.0 0.0"', reverted_tree, "and without syntax errors related to quotes")
+
+    def test_texture_cards(self):
+        images = ["maps/wide.png", "maps/small.png", "maps/other.png"]
+        sizes = {"maps/wide.png": (64, 32), "maps/small.png": (16, 16), "maps/other.png": (16, 16)}
+        tree = cards.make_texture_cards(images, sizes, (32, 32))
+        # The tree must survive a round trip through the parser
+        tree = eggparse.egg_tokenize(repr(tree).splitlines())
+        self.assertEqual([texture.node_name for texture in tree.findall("Texture")], ["wide", "small", "other"])
+        self.assertEqual(tree.findall("Texture")[0].get_child(0).value, "maps/wide.png")
+
+        vertices = geometry.get_vertex_pools(tree)["vpool"]
+        self.assertEqual(len(vertices), 8)
+        self.assertEqual(vertices[0].get_child(0).value, "-1 0.5 0")
+        self.assertEqual(vertices[6].get_child(0).value, "0.25 -0.25 0")
+        refs = [geometry.get_primitive_vertices(polygon)[1] for polygon in tree.findall("Polygon")]
+        self.assertEqual(refs, [[0, 1, 2, 3], [4, 5, 6, 7], [4, 5, 6, 7]])
+
+        self.assertEqual(len(tree.findall("Switch")), 1)
+        self.assertEqual(geometry.get_scalar(tree.findall("Group")[0], "fps"), "2")
+
+        tree = cards.make_texture_cards(images)
+        self.assertEqual(len(geometry.get_vertex_pools(tree)["vpool"]), 4)
+
+        # A single card has nothing to switch between
+        tree = cards.make_texture_cards(images[:1])
+        self.assertEqual(tree.findall("Switch"), [])
+        self.assertIsNone(geometry.get_scalar(tree.findall("Group")[0], "fps"))
+
+    @unittest.skipIf(gltf.np is None, "requires NumPy")
+    def test_gltf(self):
+        positions = struct.pack("<9f", 0, 0, 0, 1, 0, 0, 0, 1, 0)
+        uvs = struct.pack("<6f", 0, 1, 1, 1, 0, 0)
+        joints, weights = struct.pack("<12B", *[0, 1, 0, 0] * 3), struct.pack("<12f", *[0.25, 0.75, 0, 0] * 3)
+        document = {
+            "asset": {"version": "2.0"},
+            "scenes": [{"nodes": [0, 1]}],
+            "nodes": [
+                {"name": "Card", "mesh": 0, "translation": [0, 2, 0]},
+                {"name": "Armature", "children": [2, 4]},
+                {"name": "Root", "children": [3]},
+                {"name": "Tip", "translation": [0, 1, 0]},
+                {"name": "Body", "mesh": 1, "skin": 0},
+            ],
+            "skins": [{"joints": [2, 3]}],
+            "meshes": [
+                {"name": "CardMesh", "primitives": [{"attributes": {"POSITION": 0, "TEXCOORD_0": 1}, "material": 0}]},
+                {"primitives": [{"attributes": {"POSITION": 0, "JOINTS_0": 2, "WEIGHTS_0": 3}}]},
+            ],
+            "materials": [{"name": "Paper", "pbrMetallicRoughness": {"baseColorTexture": {"index": 0}}}],
+            "textures": [{"source": 0}],
+            "images": [{"uri": "maps/card.png"}],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, "card.glb")
+            path.write_bytes(
+                make_glb(
+                    document,
+                    (positions, {"componentType": 5126, "count": 3, "type": "VEC3"}),
+                    (uvs, {"componentType": 5126, "count": 3, "type": "VEC2"}),
+                    (joints, {"componentType": 5121, "count": 3, "type": "VEC4"}),
+                    (weights, {"componentType": 5126, "count": 3, "type": "VEC4"}),
+                )
+            )
+            tree = eggparse.egg_tokenize(repr(gltf.load_gltf(path)).splitlines())
+
+        self.assertEqual(tree.findall("Texture")[0].get_child(0).value, "maps/card.png")
+        vertices = geometry.get_vertex_pools(tree)["card"]
+        # The glTF Y axis becomes the Z axis, and the V coordinates are flipped
+        self.assertEqual([vertices[i].get_child(0).value for i in range(3)], ["0 0 2", "1 0 2", "0 0 3"])
+        self.assertEqual([geometry.get_uv(vertices[i]) for i in range(3)], [[0, 0], [1, 0], [0, 1]])
+        card, mesh = [group for group in tree.findall("Group") if group.node_name in ("Card", "CardMesh")]
+        self.assertEqual(card.findall("Matrix4")[0].get_child(3).value, "0 0 2 1")
+        self.assertEqual([ref.node_value for ref in mesh.findall("TRef")], ["card"])
+
+        armature = next(group for group in tree.findall("Group") if group.node_name == "Armature")
+        self.assertEqual(armature.findall("Dart")[0].node_value, "structured")
+        root, tip = armature.findall("Joint")
+        self.assertEqual(geometry.parse_vertex_ref(root.findall("VertexRef")[0]), ([3, 4, 5], "card"))
+        self.assertEqual(geometry.get_scalar(root.findall("VertexRef")[0], "membership"), "0.25")
+        self.assertEqual(geometry.get_scalar(tip.findall("VertexRef")[0], "membership"), "0.75")
+
+    def test_obj(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pathlib.Path(tmp, "crate.mtl").write_text(
+                "# Blender MTL File: 'crate.blend'\n# Material Count: 1\n\n"
+                "newmtl Wood\nKd 1 0.5 0.25\nmap_Kd -s 1 1 1 maps/wood.png\n\n"
+            )
+            pathlib.Path(tmp, "crate.obj").write_text(
+                "mtllib crate.mtl\no Lid\nv 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nvt 0 0\nvt 1 1\nvn 0 0 1\n"
+                "usemtl Wood\nf 1/1/1 2/2/1 3/2/1 4/1/1\nf -4/-2/-1 -2/-1/-1 -1/-2/-1\n"
+                "o Bottom\nusemtl None\nf 1 2 3\n"
+            )
+            tree = eggparse.egg_tokenize(repr(obj.load_obj([pathlib.Path(tmp, "crate.obj")], "crate")).splitlines())
+
+        self.assertEqual(tree.findall("Texture")[0].get_child(0).value, "maps/wood.png")
+        self.assertEqual(geometry.get_scalar(tree.findall("Material")[0], "baseg"), "0.5")
+        vertices = geometry.get_vertex_pools(tree)["crate"]
+        # Same corners share a vertex, and the OBJ Y axis becomes the Z axis
+        self.assertEqual(len(vertices), 7)
+        lid, bottom = tree.findall("Group")
+        refs = [geometry.parse_vertex_ref(ref)[0] for ref in lid.findall("VertexRef")]
+        self.assertEqual(len(refs[0]), 4)
+        self.assertEqual(refs[1], [refs[0][0], refs[0][2], refs[0][3]])
+        self.assertEqual(vertices[refs[0][2]].get_child(0).value, "1 0 1")
+        self.assertEqual([ref.node_value for ref in lid.findall("TRef")], ["wood", "wood"])
+        self.assertEqual(bottom.findall("MRef"), [])
+
+    def test_tangents(self):
+        # Two quads sharing an edge, the second one has its U coordinates mirrored
+        corners = ["0 0 0", "1 0 0", "1 1 0", "0 1 0", "2 0 0", "2 1 0", "-1 0 0"]
+        uvs = ["0 0", "1 0", "1 1", "0 1", "0 0", "0 1", "1 0"]
+        vertices = []
+        for index, (position, uv) in enumerate(zip(corners, uvs)):
+            normal = [EggLeaf("Normal", None, "0 0 1")] if index < 6 else []
+            vertex = eggparse.EggTree(EggString(position), *normal, EggLeaf("UV", None, uv))
+            vertices.append(EggBranch("Vertex", str(index), vertex))
+        polygons = []
+        for refs, attributes in (("0 1 2 3", []), ("1 4 5 2", []), ("6 0 3", [EggLeaf("Normal", None, "0 0 1")])):
+            vertex_ref = EggLeaf("VertexRef", None, f"{refs} <Ref> {{ pool }}")
+            polygons.append(EggBranch("Polygon", None, eggparse.EggTree(*attributes, vertex_ref)))
+        data = repr(eggparse.EggTree(EggBranch("VertexPool", "pool", eggparse.EggTree(*vertices)), *polygons))
+        tree = eggparse.egg_tokenize(data.splitlines())
+        self.assertEqual(tangents.compute_tangent_binormals(tree), 11)
+
+        tree = eggparse.egg_tokenize(repr(tree).splitlines())
+        vertices = geometry.get_vertex_pools(tree)["pool"]
+        first, second, third = [geometry.parse_vertex_ref(ref)[0] for ref in tree.findall("VertexRef")]
+
+        def get_tbn(index):
+            uv = geometry.get_uv_node(vertices[index])
+            return [geometry.get_child_nodes(uv, kind)[0].node_value for kind in ("Tangent", "Binormal")]
+
+        self.assertEqual(first, [0, 1, 2, 3])
+        self.assertEqual(get_tbn(0), ["1 0 0", "0 1 0"])
+        # The shared edge is split, since the mirrored quad has its tangent flipped
+        self.assertNotIn(second[0], first)
+        self.assertEqual(vertices[second[0]].get_child(0).value, "1 0 0")
+        self.assertEqual(get_tbn(second[0]), ["-1 0 0", "0 1 0"])
+        self.assertEqual(get_tbn(4), ["-1 0 0", "0 1 0"])
+        # The polygon normal is used for vertices without one
+        self.assertEqual(get_tbn(third[0]), ["-1 0 0", "0 1 0"])
+
+    def test_optchar(self):
+        model = eggparse.egg_tokenize(
+            """<Group> character {
+              <Dart> { 1 }
+              <Group> body {
+                <Polygon> {
+                  <VertexRef> { 0 1 2 <Ref> { pool } }
+                }
+              }
+              <Joint> root {
+                <Joint> spine {
+                  <VertexRef> { 0 1 2 <Ref> { pool } }
+                  <Joint> nub {
+                  }
+                }
+                <Joint> prop {
+                }
+              }
+            }""".splitlines()
+        )
+        animation = eggparse.egg_tokenize(
+            """<Table> {
+              <Bundle> character {
+                <Table> "<skeleton>" {
+                  <Table> root {
+                    <Xfm$Anim_S$> xform {
+                      <S$Anim> x { <V> { 1 2 } }
+                      <S$Anim> i { <V> { 2 } }
+                    }
+                    <Table> spine {
+                      <Xfm$Anim_S$> xform { <S$Anim> z { <V> { 1 1 } } }
+                      <Table> nub {
+                        <Xfm$Anim_S$> xform { <S$Anim> z { <V> { 3 3 } } }
+                      }
+                    }
+                    <Table> prop {
+                      <Xfm$Anim_S$> xform { <S$Anim> y { <V> { 0 1 } } }
+                    }
+                  }
+                }
+              }
+            }""".splitlines()
+        )
+        self.assertEqual(optchar.flag_groups(model, {"body": "flagged"}), 1)
+        self.assertEqual(model.findall("Polygon")[0].node_name, "flagged")
+        optchar.set_dart_type(model, "structured")
+        self.assertEqual(model.findall("Dart")[0].node_value, "structured")
+
+        self.assertEqual(optchar.zero_channels(animation, "root", "ijk"), 1)
+        transform = geometry.get_child_nodes(optchar.find_joint_tables(animation, "root")[0], "Xfm$Anim_S$")[0]
+        self.assertEqual([channel.node_name for channel in geometry.get_child_nodes(transform, "S$Anim")], ["x"])
+
+        # The nub has no vertices and does not move, the prop moves
+        self.assertEqual(optchar.prune_joints(model, [animation]), ["nub"])
+        self.assertEqual([joint.node_name for joint in model.findall("Joint")], ["root", "spine", "prop"])
+        self.assertEqual([table.node_name for table in optchar.find_joint_tables(animation)], ["root", "spine", "prop"])
+        optchar.expose_joints(model, ["spine"])
+        self.assertEqual(model.findall("DCS")[0].node_value, "1")
+
+    def test_animation_compress(self):
+        def make_animation(**replacements):
+            text = """<Table> {
+                  <Bundle> character {
+                    <Table> "<skeleton>" {
+                      <Table> root {
+                        <Xfm$Anim_S$> xform {
+                          <Scalar> fps { 30 }
+                          <S$Anim> i { <V> { 1 1 1 1 1 } }
+                          <S$Anim> x { <V> { 2 2 2 2 2 } }
+                          <S$Anim> h { <V> { 170 -170 -150 -130 -110 } }
+                          <S$Anim> y { <V> { 0 1 2 3 4 } }
+                        }
+                      }
+                    }
+                  }
+                }"""
+            for component, values in replacements.items():
+                text = re.sub(rf"(<S\$Anim> {component} {{ <V> {{ )[^}}]*", rf"\g<1>{values} ", text)
+            return eggparse.egg_tokenize(text.splitlines())
+
+        def get_values(tree):
+            return {channel.component: list(channel.values) for channel in animation.get_channels(tree)}
+
+        # Constant channels collapse, and are removed at their default value
+        tree = make_animation()
+        self.assertEqual(animation.count_frames_and_channels(tree), (5, 4))
+        self.assertEqual(animation.compress_animation(tree), 1)
+        self.assertEqual(get_values(tree), {"x": [2], "h": [170, -170, -150, -130, -110], "y": [0, 1, 2, 3, 4]})
+        self.assertEqual(animation.count_frames_and_channels(tree), (5, 3))
+
+        # Halving the frame rate keeps the first and last frames, and unwraps the angles
+        tree = make_animation()
+        animation.compress_animation(tree, fps=15)
+        values = get_values(tree)
+        self.assertEqual(values["y"], [0, 2, 4])
+        self.assertEqual([value % 360 for value in values["h"]], [170, 210, 250])
+        self.assertEqual(geometry.get_scalar(tree.findall("Xfm$Anim_S$")[0], "fps"), "15")
+
+        # Held frames cannot stand in for a moving channel, interpolated ones rebuild it exactly from its end frames
+        tree = make_animation()
+        animation.compress_animation(tree, tolerance=0.01)
+        self.assertEqual(animation.count_frames_and_channels(tree), (5, 3))
+        tree = make_animation()
+        animation.compress_animation(tree, tolerance=0.01, interpolated=True)
+        self.assertEqual(get_values(tree)["y"], [0, 4])
+        self.assertEqual(animation.count_frames_and_channels(tree), (2, 3))
+
+        # Repeated frames are dropped even without interpolation, they play back the same
+        tree = make_animation(y="0 0 1 1 2", h="10 10 10 10 10")
+        animation.compress_animation(tree)
+        self.assertEqual(get_values(tree), {"x": [2], "h": [10], "y": [0, 1, 2]})
+        self.assertEqual(geometry.get_scalar(tree.findall("Xfm$Anim_S$")[0], "fps"), "15")
+
+        # Each kind of channel has its own tolerance, a translation tolerance leaves the scales alone
+        tree = make_animation(i="1 1 1.005 1 1")
+        animation.compress_animation(tree, tolerance=0.01)
+        self.assertEqual(get_values(tree)["i"], [1, 1, 1.005, 1, 1])
+        animation.compress_animation(tree, tolerance=0.01, scale_tolerance=0.01)
+        self.assertNotIn("i", get_values(tree))
+
+    def test_decimate(self):
+        # A flat 4x4 grid of quads, the right half uses a texture
+        vertices = [
+            EggBranch("Vertex", str(y * 5 + x), eggparse.EggTree(EggString(f"{x} {y} 0")))
+            for y in range(5)
+            for x in range(5)
+        ]
+        polygons = []
+        for y in range(4):
+            for x in range(4):
+                index = y * 5 + x
+                vertex_ref = EggLeaf("VertexRef", None, f"{index} {index + 1} {index + 6} {index + 5} <Ref> {{ pool }}")
+                attributes = [EggLeaf("TRef", None, "right")] if x >= 2 else []
+                polygons.append(EggBranch("Polygon", None, eggparse.EggTree(*attributes, vertex_ref)))
+        data = repr(eggparse.EggTree(EggBranch("VertexPool", "pool", eggparse.EggTree(*vertices)), *polygons))
+        tree = eggparse.egg_tokenize(data.splitlines())
+
+        before, after = decimate.decimate(tree, 0.25)
+        self.assertEqual(before, 32)
+        self.assertLess(after, 32)
+        self.assertEqual(after, len(tree.findall("Polygon")))
+
+        pool = geometry.get_vertex_pools(tree)["pool"]
+        positions = {index: [float(value) for value in pool[index].get_child(0).value.split()] for index in pool}
+        used, area = set(), 0.0
+        for polygon in tree.findall("Polygon"):
+            indices = geometry.get_primitive_vertices(polygon)[1]
+            used.update(indices)
+            (x0, y0, _), (x1, y1, _), (x2, y2, _) = (positions[index] for index in indices)
+            signed_area = ((x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)) / 2
+            # Nothing flipped over, and the surface is still covered
+            self.assertGreater(signed_area, 0)
+            area += signed_area
+        self.assertAlmostEqual(area, 16)
+        # The borders and the edge between the two materials stay
+        kept = {index for index in range(25) if index % 5 in (0, 2, 4) or index < 5 or index >= 20}
+        self.assertLessEqual(kept, used)
+        self.assertEqual(used - kept, set())
+
+    def test_lod_ratios(self):
+        self.assertEqual(convert.parse_lod_ratios("1,0.5,0.25"), [1, 0.5, 0.25])
+        for ratios in ("1,0.5", "1,0.5,0.25,0.1", "1,0.5,0", "2,1,0.5", "0.5,1,0.25", "1,half,0.25"):
+            with self.assertRaises(ValueError):
+                convert.parse_lod_ratios(ratios)
+
+    def test_weld(self):
+        tree = eggparse.egg_tokenize(
+            """<Texture> used { used.png }
+            <Texture> unused { unused.png }
+            <Material> unused { <Scalar> diffr { 1 } }
+            <VertexPool> pool {
+              <Vertex> 0 {
+                0 0 0
+                <UV> { 0 0 }
+              }
+              <Vertex> 1 {
+                1 0 0
+                <UV> { 1 0 }
+              }
+              <Vertex> 2 {
+                1 1 0
+                <UV> { 1 1 }
+              }
+              <Vertex> 3 {
+                1.0 0 0
+                <UV> { 1 0.0 }
+              }
+              <Vertex> 4 {
+                0 1 0
+                <UV> { 0 1 }
+              }
+              <Vertex> 5 {
+                1 0 0
+                <UV> { 0.5 0 }
+              }
+              <Vertex> 6 {
+                5 5 5
+              }
+            }
+            <Group> model {
+              <Polygon> {
+                <TRef> { used }
+                <VertexRef> { 0 1 2 <Ref> { pool } }
+              }
+              <Polygon> {
+                <VertexRef> { 3 2 4 5 <Ref> { pool } }
+              }
+              <Joint> root {
+                <VertexRef> { 1 3 6 <Ref> { pool } }
+              }
+            }""".splitlines()
+        )
+        # The third vertex has the same numbers written differently, the fifth has other UVs
+        self.assertEqual(cleanup.weld_vertices(tree), 1)
+        refs = [geometry.parse_vertex_ref(ref)[0] for ref in tree.findall("VertexRef")]
+        self.assertEqual(refs, [[0, 1, 2], [1, 2, 4, 5], [1, 6]])
+        self.assertEqual(cleanup.prune_vertices(tree), 1)
+        self.assertEqual(sorted(geometry.get_vertex_pools(tree)["pool"]), [0, 1, 2, 4, 5])
+        self.assertEqual(geometry.parse_vertex_ref(tree.findall("VertexRef")[2])[0], [1])
+        self.assertEqual(cleanup.prune_textures(tree), ["unused", "unused"])
+        self.assertEqual([texture.node_name for texture in tree.findall("Texture")], ["used"])
+        self.assertEqual(tree.findall("Material"), [])
+
+    def test_vcache(self):
+        size = 6
+        vertices = "".join(f"<Vertex> {y * size + x} {{\n  {x} {y} 0\n}}\n" for y in range(size) for x in range(size))
+        quads = [
+            f"{y * size + x} {y * size + x + 1} {(y + 1) * size + x + 1} {(y + 1) * size + x}"
+            for y in range(size - 1)
+            for x in range(size - 1)
+        ]
+        # Every other row first, the shared vertices have left the cache when the rows in between come
+        quads = quads[::2] + quads[1::2]
+        opaque = "<Polygon> {\n  <VertexRef> { %s <Ref> { pool } }\n}\n"
+        blended = "<Polygon> {\n  <Scalar> alpha { blend }\n  <VertexRef> { %s <Ref> { pool } }\n}\n"
+        tree = eggparse.egg_tokenize(
+            f"""<VertexPool> pool {{\n{vertices}}}
+            <Group> grid {{\n{"".join(opaque % quad for quad in quads)}}}
+            <Group> glass {{\n{"".join(blended % quad for quad in quads)}}}""".splitlines()
+        )
+
+        def get_corners():
+            pool = geometry.get_vertex_pools(tree)["pool"]
+            return [
+                [repr(pool[index].children) for index in geometry.get_primitive_vertices(polygon)[1]]
+                for polygon in tree.findall("Polygon")
+            ]
+
+        before, acmr = get_corners(), vcache.get_acmr(tree)
+        moved, renumbered = vcache.optimize_vertex_cache(tree)
+        self.assertGreater(moved, 0)
+        self.assertGreater(renumbered, 0)
+        self.assertLess(vcache.get_acmr(tree), acmr)
+        # The same polygons are left, and the blended ones are still in their order
+        after = get_corners()
+        self.assertEqual(sorted(after), sorted(before))
+        self.assertEqual(after[len(quads) :], before[len(quads) :])
+        # The vertices are numbered in the order they are first used
+        indices = [index for ref in tree.findall("VertexRef") for index in geometry.parse_vertex_ref(ref)[0]]
+        self.assertEqual(list(dict.fromkeys(indices)), list(range(size * size)))
+
+    def test_flatten(self):
+        def group(name, pool, *extra):
+            ref = f"<VertexRef> {{ 0 1 2 <Ref> {{ {pool} }} }}"
+            return "\n".join([f"<Group> {name} {{", "<Polygon> {", *extra, ref, "}", "}"])
+
+        pools = "".join(
+            f"<VertexPool> {name} {{\n<Vertex> 0 {{\n0 0 {z}\n}}\n<Vertex> 1 {{\n1 0 {z}\n}}\n"
+            f"<Vertex> 2 {{\n1 1 {z}\n}}\n}}\n"
+            for z, name in enumerate(["a", "b", "c", "d", "e", "f", "g", "h"])
+        )
+        tree = eggparse.egg_tokenize(
+            f"""<Texture> wood {{ wood.png }}
+            <Texture> glass {{
+              glass.png
+              <Scalar> alpha {{ blend }}
+            }}
+            {pools}
+            <Group> scene {{
+              {group("a", "a", "<TRef> { wood }")}
+              {group("b", "b", "<TRef> { wood }")}
+              <Group> dim {{
+                <Scalar> bin {{ background }}
+                {group("c", "c")}
+                {group("d", "d")}
+              }}
+              <Group> door {{
+                <DCS> {{ 1 }}
+                {group("e", "e")}
+                {group("f", "f")}
+              }}
+              {group("window", "g", "<TRef> { glass }")}
+              {group("sign", "h")}
+              <Group> locator {{ }}
+            }}""".splitlines()
+        )
+        self.assertEqual(flatten.flatten_groups(tree, ["sign"]), 6)
+        groups = {group.node_name: group for group in tree.findall("Group")}
+        self.assertEqual(list(groups), ["scene", "door", "window", "sign", "locator", "dim"])
+        scene, dim, door = groups["scene"], groups["dim"], groups["door"]
+        # The geometry with no state of its own goes into the groups that stay, the rest keeps its state
+        self.assertEqual([flatten.get_node_type(child) for child in scene.children][:2], ["Polygon", "Polygon"])
+        self.assertEqual(geometry.get_scalar(dim, "bin"), "background")
+        self.assertEqual(len(dim.findall("Polygon")), 2)
+        self.assertEqual(len(geometry.get_child_nodes(door, "Polygon")), 2)
+
+        # The pools used only by the polygons of one group are combined
+        self.assertEqual(flatten.combine_pools(tree), 3)
+        pools = geometry.get_vertex_pools(tree)
+        self.assertEqual(sorted(pools), ["a", "c", "e", "g", "h"])
+        self.assertEqual(len(pools["a"]), 6)
+        polygons = geometry.get_child_nodes(door, "Polygon")
+        refs = [geometry.parse_vertex_ref(geometry.get_primitive_vertices(polygon)[0]) for polygon in polygons]
+        self.assertEqual(refs, [([0, 1, 2], "e"), ([3, 4, 5], "e")])
+        self.assertEqual(pools["e"][4].children[0].value, "1 0 5")
+
+    def test_collision_shapes(self):
+        np = collision.np
+        points = np.random.default_rng(0).normal(size=(500, 3)) * [4, 1, 1]
+        vertices, faces = collision.convex_hull(points)
+        # Every point is inside every face of the hull, and the hull is closed
+        triangles = vertices[np.array(faces)]
+        normals = decimate.get_normals(triangles)
+        offsets = np.einsum("ij,ij->i", normals, triangles[:, 0])
+        self.assertLessEqual((points @ normals.T - offsets).max(), 1e-9)
+        self.assertEqual(len(vertices) - len(faces) * 3 // 2 + len(faces), 2)
+        self.assertIsNone(collision.convex_hull(points * [1, 1, 0]))
+
+        start, end, radius = collision.fit_capsule(points)
+        axis = end - start
+        along = np.clip((points - start) @ axis / (axis @ axis), 0, 1)
+        distances = np.linalg.norm(points - start - np.outer(along, axis), axis=1)
+        self.assertLessEqual(distances.max(), radius + 1e-9)
+        # The capsule follows the longest axis of the points
+        self.assertGreater(abs(axis[0]), abs(axis[1]) + abs(axis[2]))
@@ -0,0 +1,237 @@
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+
+from panda_utils import util
+from panda_utils.assetpipeline import palettes, target_parser
+from panda_utils.eggtree import eggparse, geometry
+from panda_utils.tools import palettize
+
+SHARED_QUAD_EGG = [
+    "<Texture> first {",
+    "  first.png",
+    "}",
+    "<Texture> second {",
+    "  second.png",
+    "}",
+    "<VertexPool> vpool {",
+    "  <Vertex> 0 {",
+    "    0 0 0",
+    "    <UV> { 0 0 }",
+    "  }",
+    "  <Vertex> 1 {",
+    "    1 0 0",
+    "    <UV> { 1 0 }",
+    "  }",
+    "  <Vertex> 2 {",
+    "    1 1 0",
+    "    <UV> { 1 1 }",
+    "  }",
+    "}",
+    "<Group> quads {",
+    "  <Joint> root {",
+    "    <VertexRef> { 0 1 2 <Ref> { vpool } }",
+    "  }",
+    "  <Group> 0-first {",
+    "    <Polygon> {",
+    "      <TRef> { first }",
+    "      <VertexRef> { 0 1 2 <Ref> { vpool } }",
+    "    }",
+    "  }",
+    "  <Group> 1-second {",
+    "    <Polygon> {",
+    "      <TRef> { second }",
+    "      <VertexRef> { 0 1 2 <Ref> { vpool } }",
+    "    }",
+    "  }",
+    "}",
+]
+
+
+class PalettizeTest(unittest.TestCase):
+    def test_pack_no_overlap(self):
+        sizes = {f"{i}.png": (16 + 8 * (i % 5), 16 + 4 * (i % 7)) for i in range(40)}
+        palette = palettize.Palette.pack("test", sizes, 128, 2)
+        self.assertEqual(palette.pages, palettize.Palette.pack("test", dict(reversed(sizes.items())), 128, 2).pages)
+        self.assertEqual(set(palette.placements), set(sizes))
+        for page, (width, height) in palette.pages.items():
+            self.assertLessEqual(width, 128)
+            self.assertEqual(width & (width - 1), 0)
+            self.assertEqual(height & (height - 1), 0)
+            rects = [
+                (p.x, p.y, p.x + p.width + 4, p.y + p.height + 4) for p in palette.placements.values() if p.page == page
+            ]
+            for i, a in enumerate(rects):
+                self.assertLessEqual(a[2], width)
+                self.assertLessEqual(a[3], height)
+                for b in rects[i + 1 :]:
+                    self.assertTrue(a[2] <= b[0] or b[2] <= a[0] or a[3] <= b[1] or b[3] <= a[1])
+
+    def test_shared_vertices(self):
+        tree = eggparse.egg_tokenize(SHARED_QUAD_EGG)
+        resolver = palettize.TextureResolver(".", ["first.png", "second.png"])
+        textures = palettize.get_palette_textures(tree, resolver)
+        self.assertEqual(palettize.find_unpalettizable_images(tree, textures), set())
+
+        placements = {
+            "first.png": palettize.PalettePlacement(0, 0, 0, 16, 16),
+            "second.png": palettize.PalettePlacement(0, 16, 0, 16, 16),
+        }
+        palette = palettize.Palette("test", 0, {0: (32, 16)}, placements)
+        palettize.apply_palette(tree, palette, textures)
+        palettize.strip_palette_indices(tree)
+
+        vertices = geometry.get_vertex_pools(tree)["vpool"]
+        first, second = [geometry.get_primitive_vertices(polygon)[1] for polygon in tree.findall("Polygon")]
+        self.assertEqual(first, [0, 1, 2])
+        self.assertEqual(second, [3, 4, 5])
+        self.assertEqual(geometry.get_uv(vertices[2]), [0.5, 1])
+        self.assertEqual(geometry.get_uv(vertices[5]), [1, 1])
+        self.assertEqual(geometry.parse_vertex_ref(tree.findall("Joint")[0].get_child(0))[0], [0, 1, 2, 3, 4, 5])
+        texture_paths = [texture.get_child(0).value for texture in tree.findall("Texture")]
+        self.assertEqual(texture_paths, ["test_palette_4allc_1.png"] * 2)
+        self.assertEqual([group.node_name for group in tree.findall("Group")], ["quads", "first", "second"])
+
+    def test_repeating_uvs(self):
+        data = [line.replace("<UV> { 1 1 }", "<UV> { 2 1 }") for line in SHARED_QUAD_EGG]
+        tree = eggparse.egg_tokenize(data)
+        textures = palettize.get_palette_textures(tree, palettize.TextureResolver(".", ["first.png", "second.png"]))
+        self.assertEqual(palettize.find_unpalettizable_images(tree, textures), {"first.png", "second.png"})
+
+    @unittest.skipIf(palettize.Image is None, "requires Pillow and NumPy")
+    def test_save_pages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            for name, color in (("first.png", (255, 0, 0, 255)), ("second.png", (0, 0, 255, 255))):
+                palettize.Image.new("RGBA", (16, 16), color).save(root / name)
+
+            tree = eggparse.egg_tokenize(SHARED_QUAD_EGG)
+            pages = palettize.palettize_trees([tree], root, ["first.png", "second.png"], "test", 64, margin=2)
+            self.assertEqual(pages, ["test_palette_4allc_1.png"])
+            with palettize.Image.open(root / pages[0]) as img:
+                self.assertEqual(img.size, (32, 64))
+                colors = {color for _, color in img.getcolors()}
+            self.assertEqual(colors, {(255, 0, 0, 255), (0, 0, 255, 255), (0, 0, 0, 0)})
+
+    @unittest.skipIf(palettize.Image is None, "requires Pillow and NumPy")
+    def test_shared_palette(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            members = {}
+            for model in ("first", "second"):
+                folder = pathlib.Path("input", model)
+                folder.mkdir(parents=True)
+                palettize.Image.new("RGBA", (16, 16), (255, 0, 0, 255)).save(folder / "a.png")
+                palettize.Image.new("RGBA", (32, 16), (0, 255, 0, 255)).save(folder / "b.png")
+                members[palettes.get_member_key("phase_3/models", model)] = palettes.find_palette_images(folder)
+
+            palettes.build_shared_palette("phase_3/maps", members, 256)
+            page = pathlib.Path("built", "phase_3", "maps", "phase_3_maps_palette_4allc_1.png")
+            member_manifest = palettes.get_member_manifest_path("phase_3__maps", "phase_3__models__second")
+            placements = json.loads(member_manifest.read_text())["placements"]
+            self.assertEqual(sorted(placements), ["a.png", "b.png"])
+            self.assertEqual(palettes.get_shared_page_names("phase_3/maps"), {page.name})
+            self.assertEqual(palettes.get_shared_page_names("phase_4/maps"), set())
+
+            # Nothing changed, so neither the page nor the manifests are written again
+            os.utime(page, (0, 0))
+            os.utime(member_manifest, (0, 0))
+            palettes.build_shared_palette("phase_3/maps", members, 256)
+            self.assertEqual(page.stat().st_mtime, 0)
+            self.assertEqual(member_manifest.stat().st_mtime, 0)
+
+            palettize.Image.new("RGBA", (16, 16), (0, 0, 255, 255)).save("input/first/a.png")
+            palettes.build_shared_palette("phase_3/maps", members, 256)
+            self.assertNotEqual(page.stat().st_mtime, 0)
+            self.assertEqual(member_manifest.stat().st_mtime, 0)
+
+    @unittest.skipIf(palettize.Image is None, "requires Pillow and NumPy")
+    def test_shared_palette_downscale(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            members, downscales = {}, {}
+            for model, steps in (("first", ["downscale:16", "shared_palette{}"]), ("second", ["downscale[]"])):
+                folder = pathlib.Path("input", model)
+                folder.mkdir(parents=True)
+                palettize.Image.new("RGBA", (64, 64), (255, 0, 0, 255)).save(folder / "a.png")
+                palettize.Image.new("RGBA", (64, 64), (0, 255, 0, 255)).save(folder / "b.png")
+                (folder / "model-config.yml").write_text("downscale:\n  - size: 32\n    name: a.png\n")
+                member = palettes.get_member_key("phase_3/models", model)
+                members[member] = palettes.find_palette_images(folder)
+                downscales[member] = palettes.get_palette_downscales(folder, steps)
+
+            palettes.build_shared_palette("phase_3/maps", members, 256, downscales)
+            sizes = {}
+            for model in ("first", "second"):
+                manifest = palettes.get_member_manifest_path("phase_3__maps", f"phase_3__models__{model}")
+                for image, placement in json.loads(manifest.read_text())["placements"].items():
+                    sizes[f"{model}/{image}"] = placement[3:]
+            self.assertEqual(
+                sizes,
+                {"first/a.png": [16, 16], "first/b.png": [16, 16], "second/a.png": [32, 32], "second/b.png": [64, 64]},
+            )
+            # The input images are left alone
+            with palettize.Image.open("input/first/a.png") as img:
+                self.assertEqual(img.size, (64, 64))
+
+    def test_shared_palette_step(self):
+        step = target_parser.Palettize("palettize")
+        settings = target_parser.TFSettings()
+
+        def make_string(parameter):
+            ctx = target_parser.StepContext([], settings, target_parser.ImportMethod.YABEE, parameter=parameter)
+            ctx.palette_group = "phase_3__maps"
+            return step.make_string(ctx)
+
+        self.assertEqual(make_string(False), "")
+        self.assertEqual(make_string(None), "shared_palette{}")
+        self.assertEqual(make_string({}), "shared_palette{}")
+        # The flags are kept, the size and the exclusions only apply to a palette of its own
+        self.assertEqual(make_string({"flags": "ordered"}), "shared_palette:ordered")
+        with self.assertLogs("panda_utils.pipeline.target_parser", "WARNING") as logs:
+            self.assertEqual(make_string("2048:ordered:*.jpg"), "shared_palette:ordered")
+        self.assertEqual(len(logs.records), 2)
+
+    @unittest.skipIf(palettize.Image is None, "requires Pillow and NumPy")
+    def test_palette_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            cache = root / "cache"
+            for name, color in (("first.png", (255, 0, 0, 255)), ("second.png", (0, 0, 255, 255))):
+                palettize.Image.new("RGBA", (16, 16), color).save(root / name)
+
+            images = ["first.png", "second.png"]
+            tree = eggparse.egg_tokenize(SHARED_QUAD_EGG)
+            pages = palettize.palettize_trees([tree], root, images, "test", 64, 2, cache_folder=cache)
+            uvs = [geometry.get_uv(vertex) for vertex in geometry.get_vertex_pools(tree)["vpool"]]
+            contents = (root / pages[0]).read_bytes()
+            (root / pages[0]).unlink()
+
+            # Only the geometry changed, so the cached pages are reused
+            (entry,) = os.listdir(cache)
+            os.utime(cache / entry, (0, 0))
+            tree = eggparse.egg_tokenize([line.replace("1 1 0", "2 2 0") for line in SHARED_QUAD_EGG])
+            with self.assertLogs("panda_utils.palettize", "INFO") as logs:
+                palettize.palettize_trees([tree], root, images, "test", 64, 2, cache_folder=cache)
+            self.assertIn("Reusing", logs.output[-1])
+            self.assertNotEqual((cache / entry).stat().st_mtime, 0)
+            self.assertEqual((root / pages[0]).read_bytes(), contents)
+            self.assertEqual([geometry.get_uv(vertex) for vertex in geometry.get_vertex_pools(tree)["vpool"]], uvs)
+
+            palettize.Image.new("RGBA", (16, 16), (0, 255, 0, 255)).save(root / "first.png")
+            tree = eggparse.egg_tokenize(SHARED_QUAD_EGG)
+            with self.assertLogs("panda_utils.palettize", "INFO") as logs:
+                palettize.palettize_trees([tree], root, images, "test", 64, 2, cache_folder=cache)
+            self.assertIn("Packed", logs.output[-1])
+
+            # Only the entries that were not used recently are pruned
+            os.utime(cache / entry, (0, 0))
+            self.assertEqual(util.prune_cache(cache, 60), 1)
+            self.assertEqual(len(os.listdir(cache)), 1)
+            self.assertEqual(util.prune_cache(root / "missing", 60), 0)
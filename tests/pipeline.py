@@ -1,8 +1,23 @@
+import json
+import logging
+import os
 import pathlib
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock
 
+from doit.task import Task
+
+from panda_utils import util
+from panda_utils.assetpipeline import report, telemetry, workers
 from panda_utils.assetpipeline.commons import AssetContext
 from panda_utils.assetpipeline.imports import ALL_ACTIONS
+from panda_utils.assetpipeline.parallel import run_parallel
+from panda_utils.assetpipeline.runner import prepare_context, run_pipeline
 from panda_utils.eggtree import eggparse
 
 
@@ -56,3 +71,311 @@ class PipelineTest(unittest.TestCase):
         self.assertEqual(len(third.findall("Collide")), 1)
         self.assertEqual(len(dupl_third.findall("Collide")), 0)
         self.assertEqual(len(outsider.findall("Collide")), 0)
+
+    def test_collide_proxy(self):
+        corners = [(x, y, z) for z in (0, 2) for y in (0, 1) for x in (0, 1)]
+        quads = ["0 2 3 1", "4 5 7 6", "0 1 5 4", "2 6 7 3", "0 4 6 2", "1 3 7 5"]
+        eggfile = [
+            "<VertexPool> box {",
+            *(f"<Vertex> {index} {{\n{x} {y} {z}\n}}" for index, (x, y, z) in enumerate(corners)),
+            "}",
+            "<Group> box {",
+            *(f"<Polygon> {{\n<VertexRef> {{ {quad} <Ref> {{ box }} }}\n}}" for quad in quads),
+            "}",
+        ]
+        for method, collide_type, polygons in (("obb", "Polyset", 6), ("hull", "Polyset", 12), ("capsule", "Tube", 24)):
+            tree = eggparse.egg_tokenize("\n".join(eggfile).splitlines())
+            context = self.make_context(tree)
+            tree = self.run_operator(context, "collide", group_name="box", method=method, bitmask=0x10)
+            box, proxy = tree.findall("Group")
+            # The render group is left visible only
+            self.assertEqual(proxy.node_name, "box-collision")
+            self.assertIs(box.children[-1], proxy)
+            self.assertEqual([collide.node_value for collide in tree.findall("Collide")], [f"{collide_type} descend"])
+            self.assertEqual(proxy.children[1].node_value, "0x00000010")
+            self.assertEqual(len(proxy.findall("Polygon")), polygons)
+            self.assertEqual(len(proxy.findall("Vertex")), {"obb": 8, "hull": 8, "capsule": 18}[method])
+
+
+class ParallelTest(unittest.TestCase):
+    def test_deterministic_order(self):
+        logger = logging.getLogger("panda_utils.pipeline.test")
+
+        def work(item):
+            time.sleep(0.01 * (5 - item))
+            logger.info("start %d", item)
+            logger.info("end %d", item)
+            return item * 2
+
+        with self.assertLogs(logger) as logs:
+            results = run_parallel(work, range(5), workers=5)
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        expected = [f"{word} {item}" for item in range(5) for word in ("start", "end")]
+        self.assertEqual([record.getMessage() for record in logs.records], expected)
+
+    def test_first_error(self):
+        def work(item):
+            if item in (1, 3):
+                raise ValueError(item)
+            return item
+
+        with self.assertRaises(ValueError) as exc:
+            run_parallel(work, range(5), workers=3)
+        self.assertEqual(exc.exception.args, (1,))
+
+
+class RunnerTest(unittest.TestCase):
+    def test_concurrent_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            names = ["first", "second", "third"]
+            for name in names:
+                (root / "input" / name).mkdir(parents=True)
+                (root / "input" / name / f"{name}.egg").write_text(f"<Group> {name} {{\n}}\n")
+
+            def build(name):
+                ctx = prepare_context(pathlib.Path("input", name), "phase_1/models", "phase_1/maps", project_root=root)
+                return run_pipeline(ctx, ["collide", "uncache"])
+
+            cwd = os.getcwd()
+            with ThreadPoolExecutor(len(names)) as pool:
+                self.assertEqual(list(pool.map(build, names)), [True] * len(names))
+            self.assertEqual(os.getcwd(), cwd)
+
+            for name in names:
+                data = (root / "intermediate" / f"phase_1__models__{name}" / f"{name}.egg").read_text()
+                self.assertIn("<Collide>", data)
+                self.assertEqual((root / "input" / name / f"{name}.egg").read_text(), f"<Group> {name} {{\n}}\n")
+
+    def test_script_paths(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            (root / "input" / "model").mkdir(parents=True)
+            (root / "input" / "model" / "model.egg").write_text("<Group> model {\n}\n")
+            (root / "scripts").mkdir()
+            (root / "scripts" / "relative.py").write_text(
+                "import shutil\n\ndef run(ctx):\n    shutil.copy('model.egg', 'relative.egg')\n"
+            )
+            (root / "scripts" / "resolved.py").write_text(
+                "def run(ctx, name):\n    ctx.path(name).write_text(ctx.path('model.egg').read_text())\n"
+            )
+            ctx = prepare_context(pathlib.Path("input", "model"), "phase_1/models", "phase_1/maps", project_root=root)
+            cwd = os.getcwd()
+            self.assertTrue(run_pipeline(ctx, ["script:relative", "script:resolved:copy.egg"]))
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertEqual((ctx.cwd / "relative.egg").read_text(), "<Group> model {\n}\n")
+            self.assertEqual((ctx.cwd / "copy.egg").read_text(), "<Group> model {\n}\n")
+            for name in ("scripts", "scripts.relative", "scripts.resolved"):
+                sys.modules.pop(name, None)
+            sys.path.remove(str(root))
+
+
+class TelemetryTest(unittest.TestCase):
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            (root / "model.egg").write_text("<Group> model {\n}\n")
+            writer = telemetry.TelemetryWriter(root / "telemetry" / "events.jsonl")
+
+            def run_tool():
+                with util.track_subprocess():
+                    time.sleep(0.01)
+
+            with writer.record("phase_1/models/model", "collide:model", "collide", root):
+                run_tool()
+                run_tool()
+                # The tools started by other threads belong to their own actions
+                with ThreadPoolExecutor(1) as pool:
+                    pool.submit(run_tool).result()
+                (root / "model.bam").write_bytes(b"1234")
+            with self.assertRaises(ValueError), writer.record("phase_1/models/model", "uncache", "uncache", root):
+                raise ValueError
+
+            first, second = telemetry.read_events(root / "telemetry" / "events.jsonl")
+            fields = {
+                "model",
+                "step",
+                "action",
+                "status",
+                "start",
+                "wall_time",
+                "cpu_time",
+                "peak_rss_growth",
+                "process_peak_rss",
+                "child_cpu_time",
+                "child_wall_time",
+                "child_count",
+                "process_child_peak_rss",
+                "tree_before",
+                "tree_after",
+            }
+            self.assertEqual(set(first), fields)
+            self.assertEqual((first["status"], first["action"], first["child_count"]), ("ok", "collide", 2))
+            self.assertGreaterEqual(first["child_wall_time"], 0.02)
+            self.assertGreaterEqual(first["wall_time"], first["child_wall_time"])
+            self.assertEqual(first["tree_before"]["files"] + 1, first["tree_after"]["files"])
+            self.assertEqual((second["status"], second["child_count"]), ("error", 0))
+            if telemetry.resource is not None:
+                self.assertGreaterEqual(first["peak_rss_growth"], 0)
+                self.assertGreaterEqual(second["process_peak_rss"], first["process_peak_rss"])
+
+    def test_summarize(self):
+        events = [
+            {"model": "a", "action": "collide", "wall_time": 1.0, "child_count": 1, "process_peak_rss": 100},
+            {"model": "a", "action": "optimize", "wall_time": 3.0, "peak_rss_growth": 50, "process_peak_rss": 150},
+            {"model": "b", "action": "collide", "wall_time": 0.5, "peak_rss_growth": None, "process_peak_rss": 80},
+        ]
+        per_model = telemetry.summarize(events, "model")
+        self.assertEqual(list(per_model), ["a", "b"])
+        self.assertEqual(per_model["a"]["events"], 2)
+        self.assertEqual(per_model["a"]["wall_time"], 4.0)
+        self.assertEqual(per_model["a"]["peak_rss_growth"], 50)
+        self.assertEqual(per_model["a"]["process_peak_rss"], 150)
+        per_action = telemetry.summarize(events, "action")
+        self.assertEqual(list(per_action), ["optimize", "collide"])
+        self.assertEqual(per_action["collide"]["child_count"], 1)
+        self.assertEqual(len(telemetry.format_summary("Step", per_action).splitlines()), 3)
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.root = pathlib.Path(self.tempdir.name)
+        (self.root / "input" / "model").mkdir(parents=True)
+        (self.root / "input" / "model" / "model.egg").write_text("<Group> model {\n}\n")
+        (self.root / "scripts").mkdir()
+        (self.root / "scripts" / "pollute.py").write_text(
+            "import logging\n"
+            "import os\n"
+            "import sys\n"
+            "\n"
+            "def run(ctx):\n"
+            "    os.environ['PANDA_UTILS_TEST_LEAK'] = '1'\n"
+            "    sys.path.append('leaked')\n"
+            "    os.chdir(ctx.project_root / 'scripts')\n"
+            "    logging.getLogger().addHandler(logging.NullHandler())\n"
+            "    logging.getLogger().setLevel(logging.CRITICAL)\n"
+        )
+        (self.root / "scripts" / "crash.py").write_text("import os\n\ndef run(ctx):\n    os._exit(3)\n")
+        (self.root / "scripts" / "check.py").write_text(
+            "import json\n"
+            "import logging\n"
+            "import os\n"
+            "import sys\n"
+            "\n"
+            "def run(ctx):\n"
+            "    state = {\n"
+            "        'pid': os.getpid(),\n"
+            "        'leaked_environ': 'PANDA_UTILS_TEST_LEAK' in os.environ,\n"
+            "        'leaked_path': 'leaked' in sys.path,\n"
+            "        'cwd': os.getcwd(),\n"
+            "        'root_handlers': len(logging.getLogger().handlers),\n"
+            "        'root_level': logging.getLogger().level,\n"
+            "        'job_environ': os.environ.get('PANDA_UTILS_TEST_JOB'),\n"
+            "    }\n"
+            "    (ctx.project_root / 'state.json').write_text(json.dumps(state))\n"
+        )
+        self.pool = workers.WorkerPool()
+        self.addCleanup(self.pool.close)
+
+    def run_job(self, script, environ=None) -> bool:
+        argv = ["input/model", "phase_1/models", "phase_1/maps", f"script:{script}"]
+        return self.pool.run(argv, cwd=str(self.root), environ=environ)
+
+    def read_state(self) -> dict:
+        return json.loads((self.root / "state.json").read_text())
+
+    def test_state_reset(self):
+        self.assertTrue(self.run_job("check", {"PANDA_UTILS_TEST_JOB": "first"}))
+        first = self.read_state()
+        self.assertEqual(first["job_environ"], "first")
+        self.assertTrue(self.run_job("pollute"))
+        self.assertTrue(self.run_job("check"))
+        second = self.read_state()
+        # The same warm worker ran every job
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertEqual(second["pid"], first["pid"])
+        self.assertEqual(second, {**first, "job_environ": None})
+
+    def test_crash_recovery(self):
+        self.assertTrue(self.run_job("check"))
+        before = self.read_state()
+        with self.assertLogs("panda_utils.pipeline.workers", logging.ERROR) as logs:
+            self.assertFalse(self.run_job("crash"))
+        self.assertIn("exit code 3", logs.records[0].getMessage())
+        # Only the crashed job failed, the pool goes on with a fresh worker
+        self.assertTrue(self.run_job("check"))
+        after = self.read_state()
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertNotEqual(after["pid"], before["pid"])
+        self.assertFalse(after["leaked_environ"])
+
+
+class ReportTest(unittest.TestCase):
+    def test_build_report(self):
+        clock = mock.Mock(now=0.0)
+        clock.time.side_effect = lambda: clock.now
+        tasks = {
+            "copy_commons": Task("copy_commons", ["echo"]),
+            "palette:g": Task("palette:g", ["echo"], task_dep=["copy_commons"]),
+            "build:a": Task("build:a", ["echo"], task_dep=["palette:g"]),
+            "build:b": Task("build:b", ["echo"], task_dep=["copy_commons"]),
+            "build": Task("build", None, task_dep=["build:a", "build:b"]),
+            "copy": Task("copy", ["echo"], task_dep=["build"]),
+        }
+        # Two workers: build:a only gets one two seconds after palette:g is done, copy waits behind the group task
+        events = [
+            (1, "skip_uptodate", "copy_commons"),
+            (1, "execute_task", "palette:g"),
+            (2, "execute_task", "build:b"),
+            (3, "add_success", "build:b"),
+            (4, "add_success", "palette:g"),
+            (6, "execute_task", "build:a"),
+            (10, "add_success", "build:a"),
+            (10, "execute_task", "build"),
+            (10, "add_success", "build"),
+            (11, "execute_task", "copy"),
+            (12, "add_success", "copy"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(report, "time", clock):
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            output = StringIO()
+            reporter = report.BuildReporter(output, {})
+            for now, method, name in events:
+                clock.now = now
+                if method in ("skip_uptodate", "execute_task"):
+                    reporter.get_status(tasks[name])
+                getattr(reporter, method)(tasks[name])
+            reporter.complete_run()
+
+            build_report = json.loads((report.REPORT_FOLDER / "build-report.json").read_text())
+            trace = json.loads((report.REPORT_FOLDER / "build-trace.json").read_text())
+
+        self.assertEqual(build_report["statuses"], {"built": 4, "skipped": 1})
+        self.assertEqual(build_report["max_concurrency"], 2)
+        self.assertEqual(build_report["wall_time"], 12)
+        self.assertEqual(build_report["task_time"], 9)
+        tasks = {task["name"]: task for task in build_report["tasks"]}
+        self.assertNotIn("build", tasks)
+        self.assertEqual(
+            {name: task["queued"] for name, task in tasks.items() if task["status"] == "built"},
+            {"palette:g": 0, "build:b": 1, "build:a": 2, "copy": 1},
+        )
+        self.assertEqual(build_report["queued_time"], 4)
+        # The path goes through the build group task, even though it is left out of the report
+        self.assertEqual(
+            build_report["critical_path"], {"duration": 8, "tasks": ["copy_commons", "palette:g", "build:a", "copy"]}
+        )
+        self.assertIn("Critical path (8.00s): copy_commons -> palette:g -> build:a -> copy", output.getvalue())
+
+        running = {event["name"]: event for event in trace["traceEvents"] if event.get("pid") == 1 and "ts" in event}
+        queued = {event["name"]: event for event in trace["traceEvents"] if event.get("pid") == 2 and "ts" in event}
+        self.assertEqual(sorted(running), ["build:a", "build:b", "copy", "palette:g"])
+        self.assertEqual((running["build:a"]["ts"], running["build:a"]["dur"]), (6e6, 4e6))
+        self.assertNotEqual(running["palette:g"]["tid"], running["build:b"]["tid"])
+        self.assertEqual(sorted(queued), ["build:a", "build:b", "copy"])
+        self.assertEqual((queued["build:a"]["ts"], queued["build:a"]["dur"]), (4e6, 2e6))
+        self.assertEqual(queued["build:a"]["tid"], running["build:a"]["tid"])
@@ -0,0 +1,77 @@
+import os
+import pathlib
+import tempfile
+import unittest
+
+from panda_utils import staging, util
+from panda_utils.assetpipeline.sync import sync_tree
+from panda_utils.tools.convert import build_lods
+
+
+class StagingTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tempdir.name)
+        self.source = self.root / "input"
+        (self.source / "sub").mkdir(parents=True)
+        (self.source / "model.egg").write_text("<Group> a {\n}")
+        (self.source / "sub" / "texture.png").write_bytes(b"png")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_stage_tree(self):
+        for mode in staging.StagingMode:
+            target = self.root / mode.value
+            staging.stage_tree(self.source, target, mode)
+            self.assertEqual((target / "model.egg").read_text(), "<Group> a {\n}")
+            self.assertEqual((target / "sub" / "texture.png").read_bytes(), b"png")
+
+    def test_detach_keeps_source(self):
+        target = self.root / "intermediate"
+        staging.stage_tree(self.source, target, staging.StagingMode.HARDLINK)
+        staged_file = target / "model.egg"
+        staging.detach(staged_file)
+        self.assertEqual(os.stat(staged_file).st_nlink, 1)
+        staged_file.write_text("modified")
+        self.assertEqual((self.source / "model.egg").read_text(), "<Group> a {\n}")
+
+        staged_texture = target / "sub" / "texture.png"
+        staging.detach(staged_texture, keep_contents=False)
+        self.assertFalse(staged_texture.exists())
+        self.assertEqual((self.source / "sub" / "texture.png").read_bytes(), b"png")
+
+    def test_lod_copies_are_separate_files(self):
+        ctx = util.Context()
+        ctx.working_path = str(self.source)
+        build_lods(ctx, "model.egg")
+        for lod in ("1000", "500", "250"):
+            lod_file = self.source / f"model-{lod}.egg"
+            self.assertEqual(os.stat(lod_file).st_nlink, 1)
+            lod_file.write_text("modified")
+        self.assertEqual((self.source / "model.egg").read_text(), "<Group> a {\n}")
+
+
+class SyncTest(unittest.TestCase):
+    def test_incremental_sync(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            root = pathlib.Path(tempdir)
+            source, target, manifest = root / "built", root / "resources", root / "manifest.json"
+            (source / "maps").mkdir(parents=True)
+            (source / "maps" / "texture.png").write_bytes(b"png")
+            (source / "model.bam").write_bytes(b"bam")
+            target.mkdir()
+            (target / "unrelated.bam").write_bytes(b"other")
+
+            result = sync_tree(source, target, manifest)
+            self.assertEqual((result.copied, result.deleted, result.unchanged), (2, 0, 0))
+            result = sync_tree(source, target, manifest)
+            self.assertEqual((result.copied, result.deleted, result.unchanged), (0, 0, 2))
+
+            (source / "maps" / "texture.png").unlink()
+            (source / "model.bam").write_bytes(b"new bam")
+            result = sync_tree(source, target, manifest)
+            self.assertEqual((result.copied, result.deleted, result.unchanged), (1, 1, 0))
+            self.assertEqual((target / "model.bam").read_bytes(), b"new bam")
+            self.assertFalse((target / "maps").exists())
+            self.assertTrue((target / "unrelated.bam").exists())
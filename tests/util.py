@@ -0,0 +1,48 @@
+import asyncio
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from panda_utils import util
+
+
+@unittest.skipIf(sys.platform == "win32", "uses a shell script in place of a Panda3D tool")
+class AsyncProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.ctx = util.Context()
+        self.ctx.panda_path = self.ctx.working_path = self.tempdir.name
+        tool = pathlib.Path(self.tempdir.name, "egg2bam")
+        tool.write_text(
+            '#!/bin/sh\necho "couldn\'t read: maps/a.png" >&2\n[ "$1" = 0 ] || exec sleep "$1"\necho done >&2\n'
+        )
+        tool.chmod(0o755)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_missing_textures(self):
+        missing = []
+        output = asyncio.run(util.run_panda_async(self.ctx, "egg2bam", "0", missing_textures=missing))
+        self.assertEqual(missing, ["maps/a.png"])
+        self.assertIn("done", output)
+
+    def test_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            asyncio.run(util.run_panda_async(self.ctx, "egg2bam", "5", timeout=0.2))
+
+    def test_concurrency(self):
+        runs = [util.run_panda_async(self.ctx, "egg2bam", "0") for _ in range(4)]
+        outputs = asyncio.run(util.run_concurrently(runs, limit=2))
+        self.assertEqual(len(outputs), 4)
+        self.assertTrue(all("done" in output for output in outputs))
+
+    def test_blocking(self):
+        missing = []
+        output = util.run_panda(self.ctx, "egg2bam", "0", missing_textures=missing)
+        self.assertEqual(missing, ["maps/a.png"])
+        self.assertIn("done", output)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            util.run_panda(self.ctx, "egg2bam", "5", timeout=0.2)